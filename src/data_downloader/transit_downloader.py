@@ -2,6 +2,7 @@ import requests
 from bs4 import BeautifulSoup
 import re
 import os
+import sys
 import zipfile
 from urllib.parse import urljoin, urlparse
 from datetime import datetime
@@ -386,17 +387,34 @@ class TransitFeedDownloader:
         
         return 0
     
-    def download_feeds(self, feeds, output_dir="transit_feeds"):
-        """Download all feeds to the specified directory"""
+    def verify_feed(self, filepath):
+        """Check that a downloaded feed is a readable zip archive"""
+        try:
+            with zipfile.ZipFile(filepath) as zip_ref:
+                return zip_ref.testzip() is None
+        except zipfile.BadZipFile:
+            return False
+    
+    def download_feeds(self, feeds, output_dir="transit_feeds", feed_processor=None):
+        """
+        Download all feeds to the specified directory.
+        
+        If feed_processor is given (e.g. a data_processor.StreamingFeedProcessor),
+        each feed is handed over as soon as its download finishes and verifies.
+        """
         os.makedirs(output_dir, exist_ok=True)
         
         successful_downloads = []
         failed_downloads = []
         skipped_downloads = []
         
+        if feed_processor:
+            feed_processor.expect([self.generate_filename(feed)[:-4] for feed in feeds])
+        
         for i, feed in enumerate(feeds, 1):
             filename = self.generate_filename(feed)
             filepath = os.path.join(output_dir, filename)
+            feed_date = filename[:-4]
             
             # Check if file already exists
             if os.path.exists(filepath):
@@ -404,6 +422,8 @@ class TransitFeedDownloader:
                 if file_size > 0:  # Make sure it's not an empty file
                     print(f"⏭ Skipping {i}/{len(feeds)}: {filename} (already exists, {file_size:,} bytes)")
                     skipped_downloads.append(filename)
+                    if feed_processor:
+                        feed_processor.feed_ready(feed_date)
                     continue
                 else:
                     print(f"⚠ Found empty file {filename}, will re-download")
@@ -442,12 +462,19 @@ class TransitFeedDownloader:
                     os.remove(filepath)
                     raise Exception("Downloaded file is empty")
                 
+                if not self.verify_feed(filepath):
+                    raise Exception("Downloaded file is not a valid zip archive")
+                
                 print(f"✓ Downloaded: {filename} ({final_size:,} bytes)")
                 successful_downloads.append(filename)
-                
+                if feed_processor:
+                    feed_processor.feed_ready(feed_date)
+            
             except Exception as e:
                 print(f"✗ Failed to download {filename}: {e}")
                 failed_downloads.append((filename, str(e)))
+                if feed_processor:
+                    feed_processor.feed_failed(feed_date, str(e))
                 
                 # Clean up partial download
                 if os.path.exists(filepath):
@@ -499,6 +526,10 @@ def main():
                        help='Starting page number (default: 1)')
     parser.add_argument('--direction', '-d', choices=['forward', 'backward'], default='forward',
                        help='Direction to fetch pages: forward (1→2→3...) or backward (232→231→230...) (default: forward)')
+    parser.add_argument('--process', action='store_true',
+                       help='Process each feed with data_processor as soon as it is downloaded')
+    parser.add_argument('--processed-dir', default=None,
+                       help='Processed data folder used with --process (default: auto-detected data/processed)')
     
     args = parser.parse_args()
     
@@ -525,9 +556,22 @@ def main():
     
     print(f"After conflict resolution: {len(resolved_feeds)} feeds to download")
     
+    feed_processor = None
+    if args.process:
+        src_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if src_root not in sys.path:
+            sys.path.append(src_root)
+        from data_processor import StreamingFeedProcessor
+        feed_processor = StreamingFeedProcessor(args.processed_dir, args.output)
+    
     # Download all feeds to specified directory
     print("Starting downloads...")
-    successful, failed, skipped = downloader.download_feeds(resolved_feeds, args.output)
+    successful, failed, skipped = downloader.download_feeds(resolved_feeds, args.output, feed_processor)
+    
+    if feed_processor:
+        print("Waiting for queued feeds to finish processing...")
+        processed = feed_processor.close()
+        print(f"Processed: {sum(1 for r in processed.values() if r['status'] == 'success')}/{len(processed)} feeds")
     
     print(f"\nDownload Summary:")
     print(f"Downloaded to: {args.output}")
@@ -552,4 +596,5 @@ if __name__ == "__main__":
 
 ### RUN COMMAND
 # in 'budapest_time_travel\src\data_downloader' folder
-# python transit_downloader.py -o ../../data/raw -p 1 -d backward
\ No newline at end of file
+# python transit_downloader.py -o ../../data/raw -p 1 -d backward
+# add --process to process each feed as soon as it is downloaded
\ No newline at end of file
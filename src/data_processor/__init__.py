@@ -5,29 +5,84 @@ A modular package for processing GTFS transit data and managing route versions,
 shape variants, and schedule activations.
 """
 
-from .pipeline import TransitDataProcessor, process_transit_data
-from .flexible_date_processor import (
-    FlexibleDateProcessor, 
-    process_single_date, 
-    process_date_range, 
-    process_date_list
-)
-from .data_loader import load_gtfs_data, load_processed_data
-from .date_utils import get_active_dates, build_service_date_mappings
-from .route_processor import build_latest_routes, update_routes, update_route_versions
-from .shape_processor import (
-    build_service_data_without_exceptions,
-    build_service_data_with_exceptions,
-    build_shape_variant_data,
-    update_shape_variants_and_activations
-)
-from .processing_tracker import ProcessingTracker
-from .shapes_updater import update_shapes_from_variants, validate_shape_integrity, print_shape_summary
-from .data_saver import (
-    save_routes, save_route_versions, save_shape_variants, 
-    save_shape_variant_activations, save_all_processed_data, save_shapes
-)
-from .config import Config, PathManager
+from importlib import import_module
+
+# Exports are imported on first attribute access, so importing the package (or
+# a light submodule like processing_tracker) does not pull in pandas and numpy.
+_EXPORTS = {
+    'TransitDataProcessor': 'pipeline',
+    'process_transit_data': 'pipeline',
+    'FlexibleDateProcessor': 'flexible_date_processor',
+    'process_single_date': 'flexible_date_processor',
+    'process_date_range': 'flexible_date_processor',
+    'process_date_list': 'flexible_date_processor',
+    'load_gtfs_data': 'data_loader',
+    'read_gtfs_shapes': 'data_loader',
+    'load_processed_data': 'data_loader',
+    'ProcessedDataset': 'processed_dataset',
+    'SQLiteProcessedStore': 'sqlite_store',
+    'get_active_dates': 'date_utils',
+    'build_service_date_mappings': 'date_utils',
+    'build_latest_routes': 'route_processor',
+    'diff_latest_routes': 'route_processor',
+    'update_routes': 'route_processor',
+    'update_route_versions': 'route_processor',
+    'close_active_versions': 'route_processor',
+    'fix_version_overlaps': 'route_processor',
+    'validate_route_versions': 'route_processor',
+    'build_service_data_without_exceptions': 'shape_processor',
+    'build_service_data_with_exceptions': 'shape_processor',
+    'build_shape_variant_data': 'shape_processor',
+    'build_service_ranges_without_exceptions': 'shape_processor',
+    'build_shape_variant_ranges': 'shape_processor',
+    'expand_service_ranges': 'shape_processor',
+    'trim_service_ranges': 'shape_processor',
+    'expand_variant_activations': 'shape_processor',
+    'update_shape_variants_and_activations': 'shape_processor',
+    'ProcessingTracker': 'processing_tracker',
+    'FeedInventory': 'feed_inventory',
+    'list_feed_dates': 'feed_inventory',
+    'ProcessedKeyIndex': 'key_index',
+    'EncodedActivations': 'activation_encoding',
+    'ShapeVariantIndex': 'variant_index',
+    'RouteShards': 'route_shards',
+    'StringDictionary': 'string_dictionary',
+    'StreamingFeedProcessor': 'streaming_processor',
+    'BulkRebuilder': 'bulk_rebuild',
+    'FeedInserter': 'feed_insertion',
+    'FeedHistory': 'feed_history',
+    'ChangeLog': 'change_log',
+    'StageGraph': 'stage_graph',
+    'Stage': 'stage_graph',
+    'update_shapes_from_variants': 'shapes_updater',
+    'validate_shape_integrity': 'shapes_updater',
+    'print_shape_summary': 'shapes_updater',
+    'save_routes': 'data_saver',
+    'save_route_versions': 'data_saver',
+    'save_shape_variants': 'data_saver',
+    'save_shape_variant_activations': 'data_saver',
+    'save_all_processed_data': 'data_saver',
+    'save_shapes': 'data_saver',
+    'save_tables_atomic': 'data_saver',
+    'read_save_manifest': 'data_saver',
+    'recover_interrupted_save': 'data_saver',
+    'Config': 'config',
+    'PathManager': 'config',
+}
+
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(f'.{module_name}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
+
 
 __version__ = "1.1.0"
 __author__ = "Your Name"
@@ -38,6 +93,19 @@ __all__ = [
     'TransitDataProcessor',
     'FlexibleDateProcessor',
     'ProcessingTracker',
+    'FeedInventory',
+    'StreamingFeedProcessor',
+    'BulkRebuilder',
+    'FeedInserter',
+    'FeedHistory',
+    'ChangeLog',
+    'StageGraph',
+    'Stage',
+    'ProcessedKeyIndex',
+    'EncodedActivations',
+    'ShapeVariantIndex',
+    'RouteShards',
+    'StringDictionary',
     
     # High-level processing functions
     'process_transit_data',
@@ -47,7 +115,11 @@ __all__ = [
     
     # Data loading
     'load_gtfs_data',
+    'read_gtfs_shapes',
+    'list_feed_dates',
     'load_processed_data',
+    'ProcessedDataset',
+    'SQLiteProcessedStore',
     
     # Date utilities
     'get_active_dates',
@@ -55,13 +127,22 @@ __all__ = [
     
     # Route processing
     'build_latest_routes',
+    'diff_latest_routes',
     'update_routes',
     'update_route_versions',
+    'close_active_versions',
+    'fix_version_overlaps',
+    'validate_route_versions',
     
     # Shape processing
     'build_service_data_without_exceptions',
     'build_service_data_with_exceptions',
     'build_shape_variant_data',
+    'build_service_ranges_without_exceptions',
+    'build_shape_variant_ranges',
+    'expand_service_ranges',
+    'trim_service_ranges',
+    'expand_variant_activations',
     'update_shape_variants_and_activations',
     
     # Shape data management
@@ -76,6 +157,9 @@ __all__ = [
     'save_shape_variant_activations',
     'save_all_processed_data',
     'save_shapes',
+    'save_tables_atomic',
+    'read_save_manifest',
+    'recover_interrupted_save',
     
     # Configuration
     'Config',
@@ -0,0 +1,222 @@
+"""
+Command line entry point for the transit data processor.
+
+Each subcommand imports only the modules it needs, so quick commands like
+status do not load pandas or the processing pipeline.
+
+Usage:
+    python -m data_processor process 20131018 20131025
+    python -m data_processor process
+    python -m data_processor rebuild
+    python -m data_processor insert 20131022
+    python -m data_processor rollback 20131018
+    python -m data_processor status
+    python -m data_processor validate
+    python -m data_processor export ../exports --route 0050
+"""
+import os
+import sys
+import argparse
+
+
+def _process(args) -> int:
+    from .flexible_date_processor import FlexibleDateProcessor
+
+    if args.start is None:
+        # Everything since the last processed feed (or all feeds without resuming)
+        dates = {}
+    elif args.to_latest:
+        dates = {'start': args.start}
+    elif args.end is None and args.days is None:
+        dates = args.start
+    elif args.days is not None:
+        dates = {'start': args.start, 'days': args.days}
+    else:
+        dates = {'start': args.start, 'end': args.end}
+
+    with FlexibleDateProcessor(args.data_folder, args.raw_folder, use_tracker=not args.no_tracker,
+                               storage=args.storage, fix_overlaps=args.fix_overlaps,
+                               concurrent=args.concurrent, trim_horizon=args.trim_horizon,
+                               merge_shards=args.merge_shards) as processor:
+        results = processor.process_dates(dates, save_data=not args.no_save, progress=args.progress,
+                                          smart_resume=not args.no_resume)
+    failed = [date for date, info in results.items() if info['status'] == 'failed']
+    return 1 if failed else 0
+
+
+def _rebuild(args) -> int:
+    from .bulk_rebuild import BulkRebuilder
+
+    rebuilder = BulkRebuilder(args.data_folder, args.raw_folder, use_tracker=not args.no_tracker,
+                              trim_horizon=args.trim_horizon)
+    results = rebuilder.rebuild(save_data=not args.no_save)
+    failed = [date for date, info in results.items() if info['status'] == 'failed']
+    return 1 if failed or not results else 0
+
+
+def _insert(args) -> int:
+    from .flexible_date_processor import FlexibleDateProcessor
+
+    processor = FlexibleDateProcessor(args.data_folder, args.raw_folder, use_tracker=not args.no_tracker,
+                                      trim_horizon=args.trim_horizon)
+    results = processor.insert_dates(args.dates or None, save_data=not args.no_save, progress=args.progress)
+    failed = [date for date, info in results.items() if info['status'] == 'failed']
+    return 1 if failed else 0
+
+
+def _rollback(args) -> int:
+    from .flexible_date_processor import FlexibleDateProcessor
+
+    processor = FlexibleDateProcessor(args.data_folder, use_tracker=not args.no_tracker)
+    try:
+        processor.rollback_to(args.date)
+    except ValueError as e:
+        print(e)
+        return 1
+    return 0
+
+
+def _status(args) -> int:
+    from .processing_tracker import ProcessingTracker
+
+    ProcessingTracker(args.data_folder).print_summary()
+    return 0
+
+
+def _validate(args) -> int:
+    from .data_loader import read_processed_table
+    from .route_processor import validate_route_versions
+
+    route_versions_df = read_processed_table('route_versions', args.data_folder)
+    version_issues = validate_route_versions(route_versions_df, show_details=args.details)
+
+    shape_ids = set(read_processed_table('shapes', args.data_folder, columns=['shape_id'])['shape_id'])
+    variant_shape_ids = set(
+        read_processed_table('shape_variants', args.data_folder, columns=['shape_id'])['shape_id'].dropna()
+    )
+    missing_shape_ids = sorted(variant_shape_ids - shape_ids)
+
+    print(f"Route versions: {len(route_versions_df)} checked, "
+          f"{len(version_issues['invalid_date_ranges'])} invalid range(s), "
+          f"{len(version_issues['overlapping_versions'])} overlap(s), "
+          f"{len(version_issues['duplicate_active_versions'])} duplicate active version(s)")
+    print(f"Shape variants: {len(variant_shape_ids)} shape(s) referenced, {len(missing_shape_ids)} missing from shapes")
+    if missing_shape_ids and args.details:
+        print(f"   Missing: {', '.join(missing_shape_ids[:10])}")
+
+    is_valid = version_issues['is_valid'] and not missing_shape_ids
+    print("✓ Processed data is valid" if is_valid else "✗ Processed data has issues")
+    return 0 if is_valid else 1
+
+
+def _export(args) -> int:
+    from .data_loader import PROCESSED_TABLES
+    from .processed_dataset import ProcessedDataset
+
+    dataset = ProcessedDataset(args.data_folder)
+    if args.route is not None:
+        tables = dataset.route(args.route)
+        if tables['routes'].empty:
+            print(f"Route {args.route} not found")
+            return 1
+    else:
+        tables = {name: dataset.table(name) for name in PROCESSED_TABLES}
+
+    if args.format == 'sqlite':
+        from .sqlite_store import SQLiteProcessedStore
+
+        store = SQLiteProcessedStore(db_path=args.output)
+        store.import_dataframes(tables)
+        store.close()
+        print(f"Exported {len(tables)} table(s) to {args.output}")
+        return 0
+
+    os.makedirs(args.output, exist_ok=True)
+    for name, df in tables.items():
+        path = os.path.join(args.output, f'{name}.csv')
+        df.to_csv(path, index=False)
+        print(f"{name}: {len(df)} row(s) exported to {path}")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m data_processor',
+                                     description='Process BKK GTFS feeds into versioned route data')
+    parser.add_argument('--data-folder', default=None,
+                        help='Processed data folder (default: auto-detected data/processed)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    process_parser = subparsers.add_parser('process', help='Process a date or a date range')
+    process_parser.add_argument('start', nargs='?', default=None,
+                                help='Date to process, or start of the range (YYYYMMDD). '
+                                     'If omitted, processes all feeds since the last processed one')
+    process_parser.add_argument('end', nargs='?', default=None, help='End of the range (YYYYMMDD)')
+    process_parser.add_argument('--days', type=int, default=None, help='Number of days from start, instead of end')
+    process_parser.add_argument('--to-latest', action='store_true', help='Process from start up to the latest feed')
+    process_parser.add_argument('--raw-folder', default=None,
+                                help='Raw feed folder (default: auto-detected data/raw)')
+    process_parser.add_argument('--storage', choices=['csv', 'sqlite'], default='csv',
+                                help='Processed data backend (default: csv)')
+    process_parser.add_argument('--progress', choices=['none', 'full', 'minimal', 'summary', 'compact'],
+                                default='compact', help='Progress output (default: compact)')
+    process_parser.add_argument('--fix-overlaps', action='store_true', help='Repair route version overlaps')
+    process_parser.add_argument('--concurrent', action='store_true',
+                                help='Overlap independent steps, feed loading and saving on threads')
+    process_parser.add_argument('--trim-horizon', action='store_true',
+                                help="Emit each feed's activations only up to the next processed feed's date")
+    process_parser.add_argument('--merge-shards', type=int, default=1,
+                                help='Split the route version and shape variant merges into this many '
+                                     'route shards, one process each (default: 1)')
+    process_parser.add_argument('--no-save', action='store_true', help='Do not save the processed data')
+    process_parser.add_argument('--no-resume', action='store_true', help='Reprocess already processed dates')
+    process_parser.add_argument('--no-tracker', action='store_true', help='Do not use the processing history')
+    process_parser.set_defaults(handler=_process)
+
+    rebuild_parser = subparsers.add_parser('rebuild', help='Rebuild the processed data from all feeds in one pass')
+    rebuild_parser.add_argument('--raw-folder', default=None,
+                                help='Raw feed folder (default: auto-detected data/raw)')
+    rebuild_parser.add_argument('--trim-horizon', action='store_true',
+                                help="Emit each feed's activations only up to the next feed's date")
+    rebuild_parser.add_argument('--no-save', action='store_true', help='Do not save the rebuilt data')
+    rebuild_parser.add_argument('--no-tracker', action='store_true', help='Do not reset the processing history')
+    rebuild_parser.set_defaults(handler=_rebuild)
+
+    insert_parser = subparsers.add_parser('insert', help='Merge feeds that fall before already processed ones')
+    insert_parser.add_argument('dates', nargs='*',
+                               help='Dates to insert (YYYYMMDD). If omitted, inserts all unprocessed feeds '
+                                    'before the last processed one')
+    insert_parser.add_argument('--raw-folder', default=None,
+                               help='Raw feed folder (default: auto-detected data/raw)')
+    insert_parser.add_argument('--progress', choices=['none', 'full', 'compact'], default='compact',
+                               help='Progress output (default: compact)')
+    insert_parser.add_argument('--trim-horizon', action='store_true',
+                               help='The processed data was built with --trim-horizon')
+    insert_parser.add_argument('--no-save', action='store_true', help='Do not save the processed data')
+    insert_parser.add_argument('--no-tracker', action='store_true', help='Do not use the processing history')
+    insert_parser.set_defaults(handler=_insert)
+
+    rollback_parser = subparsers.add_parser('rollback', help='Undo the merges made after a date')
+    rollback_parser.add_argument('date', help='Date to roll back to (YYYYMMDD)')
+    rollback_parser.add_argument('--no-tracker', action='store_true', help='Do not update the processing history')
+    rollback_parser.set_defaults(handler=_rollback)
+
+    status_parser = subparsers.add_parser('status', help='Show the processing history summary')
+    status_parser.set_defaults(handler=_status)
+
+    validate_parser = subparsers.add_parser('validate', help='Check the processed data for consistency')
+    validate_parser.add_argument('--details', action='store_true', help='Print the individual issues')
+    validate_parser.set_defaults(handler=_validate)
+
+    export_parser = subparsers.add_parser('export', help='Export processed tables')
+    export_parser.add_argument('output', help='Output folder (csv) or database file (sqlite)')
+    export_parser.add_argument('--route', default=None, help='Export only the data of this route_id')
+    export_parser.add_argument('--format', choices=['csv', 'sqlite'], default='csv',
+                               help='Export format (default: csv)')
+    export_parser.set_defaults(handler=_export)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,472 @@
+"""
+Run-length encoded shape variant activations.
+
+shape_variant_activations has one row per (date, shape_variant_id,
+exception_type), and most of it is regular repetition: a variant running on
+weekdays for a year is about 250 rows. EncodedActivations keeps the active
+days of each (shape_variant_id, exception_type) key as runs of
+(first day, last day, weekday mask), plus override days that switch single
+days on (extra service) or off (holidays). Runs of one key never overlap, so
+"is active on D" is a binary search per lookup, and new activations are
+merged by re-encoding only the last weeks of the keys they touch.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from typing import Dict, Optional, Tuple
+
+from .config import Config
+
+# Days are counted from 1970-01-01, which was a Thursday (weekday 3)
+_WEEKDAY_OFFSET = 3
+# Keys and days are packed into one int64 code: (key << _DAY_BITS) | day
+_DAY_BITS = 21
+_DAY_MASK = (1 << _DAY_BITS) - 1
+# A key is shape_variant_id * _KEY_FACTOR + exception code (0 for no exception_type)
+_KEY_FACTOR = 4
+
+
+class EncodedActivations:
+    """Shape variant activations as weekday-masked date runs with override days."""
+
+    def __init__(self):
+        """Initialize an empty encoding."""
+        # Runs sorted by key and start day; weekday bit 0 is Monday
+        self.run_keys = np.empty(0, dtype=np.int64)
+        self.run_starts = np.empty(0, dtype=np.int64)
+        self.run_ends = np.empty(0, dtype=np.int64)
+        self.run_masks = np.empty(0, dtype=np.int64)
+        # Override days as sorted (key, day) codes, with the activity they force
+        self.override_codes = np.empty(0, dtype=np.int64)
+        self.override_active = np.empty(0, dtype=bool)
+        self.fingerprint: Dict[str, object] = {}
+        self._run_codes = np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def from_activations(cls, shape_variant_activations_df: pd.DataFrame) -> 'EncodedActivations':
+        """
+        Encode a full shape variant activations table.
+
+        Args:
+            shape_variant_activations_df: Shape variant activations DataFrame
+
+        Returns:
+            Populated EncodedActivations
+        """
+        encoded = cls()
+        keys, days = _keys_and_days(shape_variant_activations_df)
+        encoded._set(*_encode((keys << _DAY_BITS) | days))
+        encoded.fingerprint = cls.table_fingerprint(shape_variant_activations_df)
+        return encoded
+
+    @classmethod
+    def load(cls, shape_variant_activations_df: pd.DataFrame,
+             data_folder: Optional[str] = None) -> 'EncodedActivations':
+        """
+        Load the saved encoding, or rebuild it if it does not match the given table.
+
+        Args:
+            shape_variant_activations_df: Activations DataFrame the encoding must describe
+            data_folder: Custom data folder path. If None, uses auto-detected path.
+
+        Returns:
+            EncodedActivations consistent with the given table
+        """
+        path = cls.get_path(data_folder)
+        fingerprint = cls.table_fingerprint(shape_variant_activations_df)
+
+        if os.path.exists(path):
+            try:
+                with np.load(path) as saved:
+                    if json.loads(str(saved['fingerprint'])) == fingerprint:
+                        encoded = cls()
+                        encoded._set(saved['run_keys'], saved['run_starts'], saved['run_ends'],
+                                     saved['run_masks'], saved['override_codes'], saved['override_active'])
+                        encoded.fingerprint = fingerprint
+                        return encoded
+            except (ValueError, KeyError, OSError):
+                print("Warning: Could not read encoded activations file. Rebuilding it.")
+
+        return cls.from_activations(shape_variant_activations_df)
+
+    def save(self, data_folder: Optional[str] = None) -> None:
+        """
+        Save the encoding next to the processed data files.
+
+        Args:
+            data_folder: Custom data folder path. If None, uses auto-detected path.
+        """
+        path = self.get_path(data_folder)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, run_keys=self.run_keys, run_starts=self.run_starts, run_ends=self.run_ends,
+                     run_masks=self.run_masks, override_codes=self.override_codes,
+                     override_active=self.override_active, fingerprint=json.dumps(self.fingerprint))
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def get_path(data_folder: Optional[str] = None) -> str:
+        """Get the path of the encoded activations file."""
+        if data_folder is None:
+            data_folder = Config.get_default_processed_data_folder()
+        return os.path.join(data_folder, Config.ACTIVATION_RUNS_FILE)
+
+    @staticmethod
+    def table_fingerprint(shape_variant_activations_df: pd.DataFrame) -> Dict[str, object]:
+        """Cheap fingerprint of the (date-sorted) activations table the encoding describes."""
+        if shape_variant_activations_df.empty:
+            return {'rows': 0}
+        return {
+            'rows': len(shape_variant_activations_df),
+            'first_date': str(shape_variant_activations_df['date'].iloc[0]),
+            'last_date': str(shape_variant_activations_df['date'].iloc[-1])
+        }
+
+    def refresh_fingerprint(self, shape_variant_activations_df: pd.DataFrame) -> None:
+        """Record that the encoding now describes the given table."""
+        self.fingerprint = self.table_fingerprint(shape_variant_activations_df)
+
+    def __len__(self) -> int:
+        """Number of runs plus override days, i.e. the encoded size."""
+        return len(self.run_keys) + len(self.override_codes)
+
+    # Queries
+
+    def contains(self, activations_df: pd.DataFrame) -> np.ndarray:
+        """
+        Check which activation rows are already active.
+
+        Args:
+            activations_df: DataFrame with date, shape_variant_id and exception_type
+
+        Returns:
+            Boolean array aligned with activations_df
+        """
+        keys, days = _keys_and_days(activations_df)
+        return self._is_active(keys, days)
+
+    def is_active(self, date: str, shape_variant_ids, exception_type: Optional[float] = None) -> np.ndarray:
+        """
+        Check whether shape variants are active on a date.
+
+        Args:
+            date: Date string (YYYY-MM-DD or YYYYMMDD)
+            shape_variant_ids: Shape variant ids to check
+            exception_type: Exception type of the activation (None or NaN for regular service)
+
+        Returns:
+            Boolean array aligned with shape_variant_ids
+        """
+        variant_ids = np.asarray(shape_variant_ids, dtype=np.int64)
+        keys = variant_ids * _KEY_FACTOR + _exception_code(exception_type)
+        days = np.full(len(keys), _to_day(date), dtype=np.int64)
+        return self._is_active(keys, days)
+
+    def active_on(self, date: str) -> pd.DataFrame:
+        """
+        Get all activations of one date.
+
+        Args:
+            date: Date string (YYYY-MM-DD or YYYYMMDD)
+
+        Returns:
+            DataFrame with shape_variant_id and exception_type, sorted by shape_variant_id
+        """
+        day = _to_day(date)
+        covering = ((self.run_starts <= day) & (self.run_ends >= day) &
+                    (((self.run_masks >> _weekday(day)) & 1) == 1))
+        keys = set(self.run_keys[covering].tolist())
+
+        on_day = (self.override_codes & _DAY_MASK) == day
+        for key, active in zip((self.override_codes[on_day] >> _DAY_BITS).tolist(),
+                               self.override_active[on_day].tolist()):
+            if active:
+                keys.add(key)
+            else:
+                keys.discard(key)
+
+        return _keys_to_frame(np.array(sorted(keys), dtype=np.int64))
+
+    def to_activations(self) -> pd.DataFrame:
+        """
+        Materialize the per-day activation rows.
+
+        Returns:
+            DataFrame in the shape_variant_activations format, sorted by date and shape_variant_id
+        """
+        codes = _expand(self.run_keys, self.run_starts, self.run_ends, self.run_masks)
+        codes = np.setdiff1d(codes, self.override_codes[~self.override_active], assume_unique=True)
+        codes = np.union1d(codes, self.override_codes[self.override_active])
+
+        days = codes & _DAY_MASK
+        df = _keys_to_frame(codes >> _DAY_BITS)
+        df.insert(0, 'date', np.datetime_as_string(days.astype('datetime64[D]')).astype(object))
+        return df.sort_values(['date', 'shape_variant_id'], kind='stable').reset_index(drop=True)
+
+    # Updates
+
+    def add(self, activations_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Merge activation rows into the encoding.
+
+        Only the weeks from the week before each touched key's earliest new day
+        are re-encoded; older runs are kept as they are.
+
+        Args:
+            activations_df: DataFrame with date, shape_variant_id and exception_type
+
+        Returns:
+            The rows that were not active yet, in their original order
+        """
+        keys, days = _keys_and_days(activations_df)
+        new = ~self._is_active(keys, days)
+        if new.any():
+            self._merge_codes(np.unique((keys[new] << _DAY_BITS) | days[new]))
+        return activations_df[new].reset_index(drop=True)
+
+    def _merge_codes(self, new_codes: np.ndarray) -> None:
+        """Re-encode the touched keys from a window start before their earliest new day."""
+        touched, first = np.unique(new_codes >> _DAY_BITS, return_index=True)
+        first_days = new_codes[first] & _DAY_MASK
+        # Monday of the week before the earliest new day, so the segment it joins is re-encoded whole
+        windows = first_days - _weekday(first_days) - 7
+
+        run_windows = _lookup(touched, windows, self.run_keys)
+        cut = self.run_ends >= run_windows
+        pool = [_expand(self.run_keys[cut], np.maximum(self.run_starts[cut], run_windows[cut]),
+                        self.run_ends[cut], self.run_masks[cut])]
+
+        # Runs reaching into the window keep their part before it
+        heads = cut & (self.run_starts < run_windows)
+        head_ends = _last_mask_day(run_windows[heads] - 1, self.run_masks[heads])
+        kept = ~cut
+        kept_heads = head_ends >= self.run_starts[heads]
+        runs = [
+            (self.run_keys[kept], self.run_starts[kept], self.run_ends[kept], self.run_masks[kept]),
+            (self.run_keys[heads][kept_heads], self.run_starts[heads][kept_heads],
+             head_ends[kept_heads], self.run_masks[heads][kept_heads])
+        ]
+
+        override_windows = _lookup(touched, windows, self.override_codes >> _DAY_BITS)
+        in_window = (self.override_codes & _DAY_MASK) >= override_windows
+        pool.append(self.override_codes[in_window & self.override_active])
+        pool_codes = np.union1d(
+            np.setdiff1d(np.unique(np.concatenate(pool)), self.override_codes[in_window & ~self.override_active]),
+            new_codes
+        )
+
+        # The last run each key keeps before the window, for the re-encoded weeks to continue
+        prior_keys, _, prior_ends, prior_masks = (np.concatenate(parts) for parts in zip(*runs))
+        order = np.lexsort((prior_ends, prior_keys))
+        prior_keys, prior_ends, prior_masks = prior_keys[order], prior_ends[order], prior_masks[order]
+        last = np.r_[prior_keys[1:] != prior_keys[:-1], True] if len(prior_keys) else np.empty(0, dtype=bool)
+
+        (new_keys, new_starts, new_ends, new_masks,
+         new_override_codes, new_override_active) = _encode(
+            pool_codes, (prior_keys[last], prior_ends[last], prior_masks[last])
+        )
+        runs.append((new_keys, new_starts, new_ends, new_masks))
+
+        self._set(*(np.concatenate(parts) for parts in zip(*runs)),
+                  np.concatenate([self.override_codes[~in_window], new_override_codes]),
+                  np.concatenate([self.override_active[~in_window], new_override_active]))
+
+    def _set(self, run_keys: np.ndarray, run_starts: np.ndarray, run_ends: np.ndarray, run_masks: np.ndarray,
+             override_codes: np.ndarray, override_active: np.ndarray) -> None:
+        """Store runs and overrides sorted, joining adjacent runs that describe one run."""
+        order = np.lexsort((run_starts, run_keys))
+        run_keys, run_starts = run_keys[order].astype(np.int64), run_starts[order].astype(np.int64)
+        run_ends, run_masks = run_ends[order].astype(np.int64), run_masks[order].astype(np.int64)
+
+        # Runs of a key with the same mask and no masked day between them are one run
+        joins = np.zeros(len(run_keys), dtype=bool)
+        if len(run_keys) > 1:
+            joins[1:] = ((run_keys[1:] == run_keys[:-1]) & (run_masks[1:] == run_masks[:-1]) &
+                         _no_mask_day_between(run_ends[:-1], run_starts[1:], run_masks[1:]))
+        groups = np.flatnonzero(~joins)
+        self.run_keys = run_keys[groups]
+        self.run_starts = run_starts[groups]
+        self.run_ends = np.maximum.reduceat(run_ends, groups) if len(groups) else run_ends
+        self.run_masks = run_masks[groups]
+        self._run_codes = (self.run_keys << _DAY_BITS) | self.run_starts
+
+        order = np.argsort(override_codes, kind='stable')
+        self.override_codes = override_codes[order].astype(np.int64)
+        self.override_active = override_active[order].astype(bool)
+
+    def _is_active(self, keys: np.ndarray, days: np.ndarray) -> np.ndarray:
+        """Vectorized activity lookup of (key, day) pairs."""
+        codes = (keys << _DAY_BITS) | days
+        active = np.zeros(len(codes), dtype=bool)
+
+        if len(self._run_codes):
+            # The only run that can cover a day is the key's last run starting on or before it
+            runs = np.searchsorted(self._run_codes, codes, side='right') - 1
+            found = runs >= 0
+            runs = np.maximum(runs, 0)
+            active = (found & (self.run_keys[runs] == keys) & (self.run_ends[runs] >= days) &
+                      (((self.run_masks[runs] >> _weekday(days)) & 1) == 1))
+
+        if len(self.override_codes):
+            positions = np.searchsorted(self.override_codes, codes)
+            positions = np.minimum(positions, len(self.override_codes) - 1)
+            overridden = self.override_codes[positions] == codes
+            active = np.where(overridden, self.override_active[positions], active)
+
+        return active
+
+
+def _weekday(days):
+    """Weekday (0 = Monday) of day numbers counted from 1970-01-01."""
+    return (days + _WEEKDAY_OFFSET) % 7
+
+
+def _to_day(date: str) -> int:
+    return int(pd.Timestamp(date).to_datetime64().astype('datetime64[D]').astype(np.int64))
+
+
+def _exception_code(exception_type: Optional[float]) -> int:
+    return 0 if exception_type is None or pd.isna(exception_type) else int(exception_type)
+
+
+def _keys_and_days(activations_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """Keys and day numbers of activation rows."""
+    exception_types = activations_df['exception_type'].to_numpy(dtype='float64', na_value=np.nan)
+    codes = np.where(np.isnan(exception_types), 0, exception_types).astype(np.int64)
+    keys = activations_df['shape_variant_id'].to_numpy(dtype='int64') * _KEY_FACTOR + codes
+    days = (pd.to_datetime(activations_df['date'], format='%Y-%m-%d')
+            .to_numpy(dtype='datetime64[D]').astype(np.int64))
+    return keys, days
+
+
+def _keys_to_frame(keys: np.ndarray) -> pd.DataFrame:
+    """shape_variant_id and exception_type columns of keys."""
+    codes = keys % _KEY_FACTOR
+    return pd.DataFrame({
+        'shape_variant_id': pd.array(keys // _KEY_FACTOR, dtype='Int64'),
+        'exception_type': np.where(codes == 0, np.nan, codes).astype('float64')
+    })
+
+
+def _lookup(sorted_keys: np.ndarray, values: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """Value of each key in sorted_keys, or the largest int64 for keys not in it."""
+    result = np.full(len(keys), np.iinfo(np.int64).max, dtype=np.int64)
+    if len(sorted_keys):
+        positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        found = sorted_keys[positions] == keys
+        result[found] = values[positions[found]]
+    return result
+
+
+def _expand(keys: np.ndarray, starts: np.ndarray, ends: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    """Sorted (key, day) codes of the days covered by runs."""
+    lengths = np.maximum(ends - starts + 1, 0)
+    run_index = np.repeat(np.arange(len(keys)), lengths)
+    days = starts[run_index] + (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    covered = ((masks[run_index] >> _weekday(days)) & 1) == 1
+    return np.sort((keys[run_index][covered] << _DAY_BITS) | days[covered])
+
+
+def _last_mask_day(days: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    """Latest day on or before each day whose weekday is in the mask."""
+    result = days.copy()
+    for _ in range(6):
+        missing = ((masks >> _weekday(result)) & 1) == 0
+        result[missing] -= 1
+    return result
+
+
+def _no_mask_day_between(ends: np.ndarray, starts: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    """Whether no day strictly between each end and start has its weekday in the mask."""
+    gaps = starts - ends - 1
+    clear = gaps < 7
+    for offset in range(1, 7):
+        in_gap = offset <= gaps
+        clear &= ~in_gap | (((masks >> _weekday(ends + offset)) & 1) == 0)
+    return clear
+
+
+def _encode(codes: np.ndarray, previous: Optional[tuple] = None) -> tuple:
+    """
+    Encode sorted unique (key, day) codes as runs and override days.
+
+    Days are grouped into weeks (Monday to Sunday). Consecutive weeks of a key
+    with the same weekday mask form a run. A single deviating week (a holiday
+    week, or the partial week a run starts or ends in) joins the neighbouring
+    run, and its deviations become override days.
+
+    Args:
+        codes: Sorted unique (key, day) codes
+        previous: Optional (keys, ends, masks) of the runs right before the codes
+                  of each key, which a deviating first week continues
+
+    Returns:
+        Tuple of (run keys, run starts, run ends, run masks, override codes, override activity)
+    """
+    if len(codes) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, empty, empty, np.empty(0, dtype=bool)
+
+    keys = codes >> _DAY_BITS
+    days = codes & _DAY_MASK
+    weeks = (days + _WEEKDAY_OFFSET) // 7
+
+    # One group per key and week
+    group_starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]) | (weeks[1:] != weeks[:-1])])
+    group_keys = keys[group_starts]
+    group_weeks = weeks[group_starts]
+    group_masks = np.bitwise_or.reduceat(1 << _weekday(days), group_starts)
+    group_first = days[group_starts]
+    group_last = days[np.r_[group_starts[1:], len(days)] - 1]
+
+    # Segments of consecutive weeks with the same mask
+    segment_starts = np.flatnonzero(np.r_[
+        True,
+        (group_keys[1:] != group_keys[:-1]) | (group_weeks[1:] != group_weeks[:-1] + 1) |
+        (group_masks[1:] != group_masks[:-1])
+    ])
+    segment_ends = np.r_[segment_starts[1:], len(group_keys)] - 1
+
+    previous_weeks = previous_masks = None
+    if previous is not None:
+        # Last week and mask of the run before each key's first segment
+        previous_weeks = _lookup(previous[0], (previous[1] + _WEEKDAY_OFFSET) // 7, group_keys[segment_starts])
+        previous_masks = _lookup(previous[0], previous[2], group_keys[segment_starts])
+
+    runs = []  # [first group, last group, mask, whether the mask is the run's own]
+    for segment, (first, last) in enumerate(zip(segment_starts.tolist(), segment_ends.tolist())):
+        if runs and group_keys[first] == group_keys[runs[-1][1]]:
+            previous_run = runs[-1]
+            adjoins = group_weeks[first] == group_weeks[previous_run[1]] + 1
+            if adjoins and first == last:
+                # A single deviating week joins the run before it
+                previous_run[1] = last
+                continue
+            if adjoins and previous_run[0] == previous_run[1] and previous_run[3]:
+                # A run that is a single week joins the run after it
+                previous_run[1] = last
+                previous_run[2] = int(group_masks[first])
+                continue
+        elif (previous_weeks is not None and first == last and
+                group_weeks[first] - 1 == previous_weeks[segment]):
+            # A single deviating week continues the run it follows, with that run's mask
+            runs.append([first, last, int(previous_masks[segment]), False])
+            continue
+        runs.append([first, last, int(group_masks[first]), True])
+
+    run_groups = np.array([run[:3] for run in runs], dtype=np.int64).reshape(-1, 3)
+    run_keys = group_keys[run_groups[:, 0]]
+    run_starts = group_first[run_groups[:, 0]]
+    run_ends = group_last[run_groups[:, 1]]
+    run_masks = run_groups[:, 2]
+
+    covered = _expand(run_keys, run_starts, run_ends, run_masks)
+    off_codes = np.setdiff1d(covered, codes, assume_unique=True)
+    on_codes = np.setdiff1d(codes, covered, assume_unique=True)
+    override_codes = np.concatenate([off_codes, on_codes])
+    override_active = np.r_[np.zeros(len(off_codes), dtype=bool), np.ones(len(on_codes), dtype=bool)]
+
+    return run_keys, run_starts, run_ends, run_masks, override_codes, override_active
@@ -0,0 +1,317 @@
+"""
+One-pass rebuild of the processed data from all raw feeds.
+
+Instead of loading, merging and saving the processed tables once per feed,
+the feed-only stages of all feeds run up front and their outputs are merged
+as one batch: route versions are the change points of each (route_id,
+direction_id)'s pattern over the feeds, shape variants and activations are
+built from every feed at once, and the final tables are written once. The
+result is the same as merging the feeds one by one with TransitDataProcessor
+(without fix_overlaps).
+"""
+import pandas as pd
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from .config import Config
+from .data_loader import PROCESSED_TABLE_DTYPES, read_gtfs_shapes
+from .data_saver import save_tables_atomic
+from .pipeline import TransitDataProcessor
+from .processed_dataset import ProcessedDataset
+from .processing_tracker import ProcessingTracker
+from .feed_inventory import FeedInventory
+from .shape_processor import build_shape_variant_ranges, trim_service_ranges, expand_variant_activations
+from .key_index import ProcessedKeyIndex
+from .activation_encoding import EncodedActivations
+from .variant_index import VARIANT_KEY_COLUMNS, ShapeVariantIndex
+from .feed_history import FeedHistory
+from .change_log import ChangeLog
+
+VERSION_KEY_COLUMNS = ['route_id', 'direction_id']
+PATTERN_COLUMNS = ['main_shape_id', 'trip_headsign']
+
+
+class BulkRebuilder:
+    """Rebuilds the processed tables from a list of feeds in one batch."""
+
+    def __init__(self, data_folder: Optional[str] = None, raw_data_folder: Optional[str] = None,
+                 use_tracker: bool = True, prepare_workers: int = 4, trim_horizon: bool = False):
+        """
+        Initialize the rebuilder.
+
+        Args:
+            data_folder: Path to processed data folder. If None, uses auto-detected path.
+            raw_data_folder: Path to raw data folder. If None, uses auto-detected path.
+            use_tracker: Whether to replace the processing history with the rebuilt dates.
+            prepare_workers: Number of feeds whose feed-only stages may run at once.
+            trim_horizon: Whether each feed emits activations only up to the next feed's
+                          date (see TransitDataProcessor).
+        """
+        self.processor = TransitDataProcessor(data_folder, raw_data_folder, trim_horizon=trim_horizon)
+        self.data_folder = data_folder
+        self.raw_data_folder = raw_data_folder
+        self.use_tracker = use_tracker
+        self.prepare_workers = prepare_workers
+        self.trim_horizon = trim_horizon
+
+    def rebuild(self, dates: Optional[List[str]] = None, save_data: bool = True,
+                show_progress: bool = True) -> Dict[str, Dict]:
+        """
+        Rebuild the processed tables from scratch.
+
+        Args:
+            dates: Feed dates to build from. If None, all feeds in the raw data folder.
+            save_data: Whether to save the rebuilt tables (replacing the processed data)
+            show_progress: Whether to show progress messages
+
+        Returns:
+            Dictionary with processing results keyed by date, like FlexibleDateProcessor
+        """
+        if dates is None:
+            inventory = FeedInventory(self.raw_data_folder, self.data_folder)
+            inventory.refresh()
+            dates = inventory.dates()
+        dates = sorted(dates)
+
+        if show_progress:
+            print(f"1-3. Preparing {len(dates)} feed(s)...")
+        feeds, results = self._prepare_feeds(dates, show_progress)
+        if not feeds:
+            if show_progress:
+                print("No feeds could be prepared, nothing to rebuild.")
+            return results
+
+        if show_progress:
+            print(f"4-8. Building the processed tables from {len(feeds)} feed(s)...")
+        tables = self.build_tables(feeds, show_progress)
+
+        if save_data:
+            if show_progress:
+                print("9. Saving processed data...")
+            self._save(tables, feeds, show_progress)
+            if self.use_tracker:
+                tracker = ProcessingTracker(self.data_folder)
+                tracker.reset_history()
+                successful = [date for date, result in results.items() if result['status'] == 'success']
+                failed = [date for date, result in results.items() if result['status'] == 'failed']
+                tracker.record_processing_session(dates[0], dates[-1], successful, failed)
+
+        if show_progress:
+            failed_count = sum(1 for result in results.values() if result['status'] == 'failed')
+            print(f"Rebuilt from {len(feeds)} feed(s), {failed_count} failed")
+        return results
+
+    def _prepare_feeds(self, dates: List[str], show_progress: bool) -> tuple:
+        """Run the feed-only stages of all feeds; feeds that fail are left out."""
+        feeds = []
+        results = {}
+        with ThreadPoolExecutor(max_workers=self.prepare_workers) as executor:
+            futures = [executor.submit(self.processor.prepare_feed, date, False) for date in dates]
+            for date, future in zip(dates, futures):
+                try:
+                    feeds.append(future.result())
+                    results[date] = {'status': 'success', 'data': None, 'error': None}
+                except Exception as e:
+                    results[date] = {'status': 'failed', 'data': None, 'error': str(e)}
+                    if show_progress:
+                        print(f"✗ Failed to prepare {date}: {e}")
+        return feeds, results
+
+    def build_tables(self, feeds: List[dict], show_progress: bool = False) -> Dict[str, pd.DataFrame]:
+        """
+        Build the processed tables from prepared feeds.
+
+        Args:
+            feeds: Outputs of TransitDataProcessor.prepare_feed, in date order (at least one)
+            show_progress: Whether to show progress messages
+
+        Returns:
+            Dictionary with the shapes, routes, route_versions, shape_variants and
+            shape_variant_activations tables
+        """
+        latest_routes = pd.concat(
+            [feed['latest_routes'].assign(feed=i) for i, feed in enumerate(feeds)], ignore_index=True
+        )
+
+        routes_df = build_routes(latest_routes)
+        route_versions_df, version_feeds = build_route_versions(latest_routes)
+        if show_progress:
+            print(f"Routes: {len(routes_df)}, route versions: {len(route_versions_df)}")
+
+        # Shape variant data of each feed, against the versions active after that feed
+        shape_variant_data = []
+        for i, feed in enumerate(feeds):
+            active = (version_feeds['created'] <= i) & (version_feeds['closed'] > i)
+            valid_routes = route_versions_df[active.to_numpy()].assign(valid_to=pd.NaT)
+            service_ranges, df_exceptions = feed['service_ranges'], feed['df_exceptions']
+            if self.trim_horizon:
+                next_date = feeds[i + 1]['date'] if i + 1 < len(feeds) else None
+                service_ranges, df_exceptions = trim_service_ranges(service_ranges, df_exceptions,
+                                                                    feed['date'], next_date)
+            shape_variant_data.append(
+                build_shape_variant_ranges(valid_routes, service_ranges, df_exceptions, False).assign(feed=i)
+            )
+
+        shape_variants_df, shape_variant_activations_df = build_shape_variants_and_activations(shape_variant_data)
+        if show_progress:
+            print(f"Shape variants: {len(shape_variants_df)}, activations: {len(shape_variant_activations_df)}")
+
+        shapes_df = self._build_shapes(feeds, shape_variant_data, show_progress)
+
+        return {
+            'shapes': shapes_df,
+            'routes': routes_df,
+            'route_versions': route_versions_df,
+            'shape_variants': shape_variants_df,
+            'shape_variant_activations': shape_variant_activations_df
+        }
+
+    def _build_shapes(self, feeds: List[dict], shape_variant_data: List[pd.DataFrame],
+                      show_progress: bool) -> pd.DataFrame:
+        """Read each shape from the first feed that uses it (and has it in shapes.txt)."""
+        known = set()
+        added = []
+        for feed, variant_data in zip(feeds, shape_variant_data):
+            missing = set(variant_data['shape_id'].unique()) - known
+            if not missing:
+                continue
+            shapes_txt = read_gtfs_shapes(feed['date'], sorted(missing), self.raw_data_folder)
+            found = shapes_txt[shapes_txt['shape_id'].isin(missing)]
+            known.update(found['shape_id'].unique())
+            added.append(found)
+
+        if not added:
+            return pd.DataFrame(columns=list(PROCESSED_TABLE_DTYPES['shapes']))
+        shapes_df = pd.concat(added, ignore_index=True)
+        if show_progress:
+            print(f"Shapes: {shapes_df['shape_id'].nunique()} shape(s), {len(shapes_df)} point(s)")
+        return shapes_df.sort_values(['shape_id', 'shape_pt_sequence']).reset_index(drop=True)
+
+    def _save(self, tables: Dict[str, pd.DataFrame], feeds: List[dict], show_progress: bool) -> None:
+        """Save the tables, their columnar copies and the indexes describing them."""
+        dataset = ProcessedDataset(self.data_folder)
+        dataset.mark_saved(save_tables_atomic(tables, self.data_folder, show_progress))
+        dataset.write_columnar('shapes', tables['shapes'])
+        dataset.write_columnar('shape_variant_activations', tables['shape_variant_activations'])
+
+        key_index = ProcessedKeyIndex.from_tables(tables['shapes'], tables['routes'], tables['route_versions'])
+        if feeds:
+            key_index.set_feed_routes(feeds[-1]['latest_routes'])
+        key_index.save(self.data_folder)
+        EncodedActivations.from_activations(tables['shape_variant_activations']).save(self.data_folder)
+        ShapeVariantIndex.from_variants(tables['shape_variants']).save(self.data_folder)
+        FeedHistory(self.data_folder).rewrite(feeds)
+        # Earlier saves cannot be undone on top of the rebuilt tables
+        ChangeLog(self.data_folder).clear()
+
+
+def build_routes(latest_routes: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build the routes table from the stacked latest routes of all feeds.
+
+    Like update_routes applied feed by feed: the rows of a route_id are taken
+    from the first feed it appears in.
+
+    Args:
+        latest_routes: Latest routes of all feeds with a feed column (feed order)
+
+    Returns:
+        Routes DataFrame
+    """
+    first_feed = latest_routes.groupby('route_id', dropna=False)['feed'].transform('min')
+    # Missing route_ids never match a known route, so they are added by every feed
+    is_new = (latest_routes['feed'] == first_feed) | latest_routes['route_id'].isna()
+    return latest_routes.loc[is_new, list(PROCESSED_TABLE_DTYPES['routes'])].reset_index(drop=True)
+
+
+def build_route_versions(latest_routes: pd.DataFrame) -> tuple:
+    """
+    Build the route versions from the change points of each route direction's pattern.
+
+    Like update_route_versions applied feed by feed (without fix_overlaps): a
+    (route_id, direction_id) gets a new version in a feed whose
+    (main_shape_id, trip_headsign) differs from that of its active version.
+    Patterns with missing values never match, so they always start a version.
+    A version ends the day before the next version of its key starts.
+
+    Args:
+        latest_routes: Latest routes of all feeds with a feed column (feed order)
+
+    Returns:
+        Tuple of (route versions DataFrame, DataFrame with the feed that created
+        each version, the feed that closed it and the latest_routes index label 
+        of the row it was created from, aligned with the versions)
+    """
+    rows = latest_routes.assign(source_row=latest_routes.index).reset_index(drop=True)
+    rows['direction_id'] = pd.to_numeric(rows['direction_id'], errors='coerce').astype('Int64')
+    key_group = rows.groupby(VERSION_KEY_COLUMNS, sort=False, dropna=False).ngroup()
+    incomplete = rows[VERSION_KEY_COLUMNS + PATTERN_COLUMNS].isna().any(axis=1)
+
+    # Rows of one key in one feed (duplicate route_ids) share their pattern
+    feed_keys = rows.assign(key_group=key_group, incomplete=incomplete).drop_duplicates(['key_group', 'feed'])
+    feed_keys = feed_keys.sort_values(['key_group', 'feed'], kind='mergesort')
+    same_key = feed_keys['key_group'].eq(feed_keys['key_group'].shift())
+    previous = feed_keys[PATTERN_COLUMNS + ['incomplete']].shift()
+    same_pattern = (same_key & ~feed_keys['incomplete'] & ~previous['incomplete'].fillna(True).astype(bool) &
+                    (feed_keys['main_shape_id'] == previous['main_shape_id']) &
+                    (feed_keys['trip_headsign'] == previous['trip_headsign']))
+    changed = feed_keys.loc[~same_pattern, ['key_group', 'feed']]
+
+    versions = rows.assign(key_group=key_group).merge(changed, on=['key_group', 'feed'])
+    versions = versions.sort_values(['feed'], kind='mergesort').reset_index(drop=True)
+    versions['version_id'] = range(Config.START_VERSION_ID, Config.START_VERSION_ID + len(versions))
+    versions['valid_from'] = pd.to_datetime(versions['valid_from'])
+
+    # Each version ends where the next version of its key begins
+    ordered = versions.sort_values(['key_group', 'version_id'])
+    next_version = ordered.groupby('key_group', sort=False)[['valid_from', 'feed']].shift(-1)
+    versions.loc[ordered.index, 'valid_to'] = next_version['valid_from'] - pd.Timedelta(days=1)
+    versions.loc[ordered.index, 'closed'] = next_version['feed']
+
+    route_versions_df = versions[['route_id', 'main_shape_id', 'trip_headsign', 'direction_id', 'route_desc',
+                                  'valid_from', 'valid_to']].assign(parent_version_id=np.nan, note=np.nan)
+    route_versions_df['valid_to'] = pd.to_datetime(route_versions_df['valid_to'])
+    route_versions_df['version_id'] = versions['version_id']
+    version_feeds = pd.DataFrame({
+        'created': versions['feed'],
+        'closed': versions['closed'].fillna(np.inf),
+        'row': versions['source_row']
+    })
+    return route_versions_df, version_feeds
+
+
+def build_shape_variants_and_activations(shape_variant_data: List[pd.DataFrame]) -> tuple:
+    """
+    Build the shape variants and activations of all feeds at once.
+
+    Like update_shape_variants_and_activations applied feed by feed: variant ids
+    follow the first appearance of each variant key, and an activation is kept
+    from the first feed that has it.
+
+    Args:
+        shape_variant_data: Range-form shape variant data of each feed with a feed column
+
+    Returns:
+        Tuple of (shape variants DataFrame, shape variant activations DataFrame)
+    """
+    data = pd.concat(shape_variant_data, ignore_index=True)
+    variant_groups = data.groupby(VARIANT_KEY_COLUMNS, sort=False, dropna=False).ngroup().to_numpy()
+    variants = data[VARIANT_KEY_COLUMNS].drop_duplicates().reset_index(drop=True)
+    variant_ids = np.arange(Config.START_SHAPE_VARIANT_ID, Config.START_SHAPE_VARIANT_ID + len(variants))
+
+    variants.insert(0, 'shape_variant_id', variant_ids)
+    variants['note'] = None
+    data['shape_variant_id'] = variant_ids[variant_groups]
+
+    activations = pd.concat([
+        expand_variant_activations(data[data['feed'] == feed]).assign(feed=feed)
+        for feed in data['feed'].unique()
+    ], ignore_index=True)
+    activations['exception_type'] = activations['exception_type'].astype('float64')
+    first_feed = activations.groupby(['date', 'shape_variant_id', 'exception_type'],
+                                     dropna=False)['feed'].transform('min')
+    activations = activations[activations['feed'] == first_feed].drop(columns='feed')
+    activations = activations.sort_values(['date', 'shape_variant_id']).reset_index(drop=True)
+
+    return variants, activations
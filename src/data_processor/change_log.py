@@ -0,0 +1,332 @@
+"""
+Change log of the processed data saves, for rolling back to an earlier feed.
+
+Each save of a merged feed logs how to undo it, in a folder next to the
+processed data: the row count of every saved table before the save, the
+earlier values of the rows it changed in place (the route versions it
+closed) and the keys of the rows it inserted among the existing ones (the
+activations, kept sorted by date, and the shapes, kept sorted by shape_id).
+The other tables are only appended to, so truncating them to their earlier
+row count undoes them.
+Saves that rewrite whole tables (FeedInserter) keep the replaced files,
+as hard links where possible.
+
+Rolling back to a feed date undoes the saves made after that date's save,
+newest first, so it takes time proportional to the changes since then
+(plus writing the tables once). Only the saves of the latest
+Config.CHANGE_LOG_MAX_DATES dates are kept, so the log does not grow with
+the activations table. A rebuild (BulkRebuilder) starts a new log.
+"""
+import os
+import json
+import shutil
+import warnings
+import pandas as pd
+from typing import Dict, List, Optional
+
+from .config import Config
+from .data_loader import PROCESSED_TABLE_DTYPES, PROCESSED_TABLE_DATE_COLUMNS, get_processed_table_path
+from .data_saver import save_tables_atomic, read_save_manifest, recover_interrupted_save
+
+# Keys of the rows a save inserts among the existing ones, by table
+ADDED_KEY_COLUMNS = {
+    'shape_variant_activations': ['date', 'shape_variant_id', 'exception_type'],
+    'shapes': ['shape_id']
+}
+
+
+class ChangeLog:
+    """Undo records of the saves of a processed data folder."""
+
+    def __init__(self, data_folder: Optional[str] = None,
+                 max_dates: Optional[int] = Config.CHANGE_LOG_MAX_DATES):
+        """
+        Initialize the change log.
+
+        Args:
+            data_folder: Processed data folder the log is stored in.
+                         If None, uses auto-detected path.
+            max_dates: Number of latest dates whose saves are kept. Older saves are
+                       dropped as new ones are logged, and their dates can no longer
+                       be rolled back to. If None, every save is kept.
+        """
+        if data_folder is None:
+            data_folder = Config.get_default_processed_data_folder()
+
+        self.data_folder = data_folder
+        self.folder = os.path.join(data_folder, Config.CHANGE_LOG_FOLDER)
+        self.max_dates = max_dates
+
+    # Recording
+
+    def record(self, generation: int, date: str, row_counts: Dict[str, int],
+               changed_rows: Optional[Dict[str, pd.DataFrame]] = None,
+               added_rows: Optional[Dict[str, pd.DataFrame]] = None,
+               snapshots: Optional[Dict[str, str]] = None) -> None:
+        """
+        Log how to undo a save.
+
+        Args:
+            generation: Generation number of the save (see save_tables_atomic)
+            date: Date of the feed the save merged
+            row_counts: Row count of each saved table before the save
+            changed_rows: Earlier values of rows changed in place, indexed by
+                          their position (see changed_rows)
+            added_rows: Rows inserted among the existing ones (activations and
+                        shapes), removed by their key when undoing
+            snapshots: Files kept by snapshot_tables, for tables the save rewrote
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        tables = {}
+        for name, rows in row_counts.items():
+            tables[name] = {'rows': int(rows), 'changed': None, 'added': None, 'snapshot': None}
+        for name, df in (changed_rows or {}).items():
+            if not df.empty:
+                tables[name]['changed'] = self._write_rows(generation, name, 'changed', df.rename_axis('position'))
+        for name, df in (added_rows or {}).items():
+            if not df.empty:
+                keys = df[ADDED_KEY_COLUMNS[name]].drop_duplicates()
+                tables[name]['added'] = self._write_rows(generation, name, 'added', keys)
+        for name, path in (snapshots or {}).items():
+            file_name = f'{generation:08d}_{name}_snapshot.csv'
+            os.replace(path, os.path.join(self.folder, file_name))
+            tables.setdefault(name, {'rows': None, 'changed': None, 'added': None})['snapshot'] = file_name
+
+        # The entry file is written last, so an entry is only listed once its rows are complete
+        self._write_entry({'generation': generation, 'date': date, 'tables': tables})
+        self._prune()
+
+    def _prune(self) -> None:
+        """Drop the saves made before those of the latest max_dates dates."""
+        if self.max_dates is None:
+            return
+        entries = self.entries()
+        dates = set()
+        for position in range(len(entries) - 1, -1, -1):
+            dates.add(entries[position]['date'])
+            if len(dates) > self.max_dates:
+                for entry in entries[:position + 1]:
+                    self._remove_entry(entry)
+                return
+
+    def snapshot_tables(self, names) -> Dict[str, str]:
+        """
+        Keep the current files of tables that a save is about to rewrite.
+
+        Args:
+            names: Names of the tables
+
+        Returns:
+            Dictionary of table name -> kept file, to pass to record after the save
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        snapshots = {}
+        for name in names:
+            path = get_processed_table_path(name, self.data_folder)
+            kept_path = os.path.join(self.folder, f'pending_{name}.csv')
+            if os.path.exists(kept_path):
+                os.remove(kept_path)
+            try:
+                # The save replaces the live file with a new one, so the link keeps the old content
+                os.link(path, kept_path)
+            except OSError:
+                shutil.copyfile(path, kept_path)
+            snapshots[name] = kept_path
+        return snapshots
+
+    def clear(self) -> None:
+        """Drop the whole log, e.g. after the processed data was rebuilt."""
+        if os.path.isdir(self.folder):
+            shutil.rmtree(self.folder)
+
+    # Reading
+
+    def entries(self) -> List[dict]:
+        """Logged saves, oldest first."""
+        if not os.path.isdir(self.folder):
+            return []
+        entries = []
+        for file_name in sorted(os.listdir(self.folder)):
+            if file_name.endswith('.json'):
+                with open(os.path.join(self.folder, file_name), 'r') as f:
+                    entries.append(json.load(f))
+        return entries
+
+    def dates(self) -> List[str]:
+        """Dates the processed data can be rolled back to, in save order."""
+        return [entry['date'] for entry in self.entries()]
+
+    # Rolling back
+
+    def rollback(self, date: str, use_tracker: bool = True, show_progress: bool = True) -> Dict[str, pd.DataFrame]:
+        """
+        Restore the processed data as it was right after the last save of a date.
+
+        Args:
+            date: Feed date to roll back to
+            use_tracker: Whether to record the dates that are no longer merged
+                         in the processing history
+            show_progress: Whether to show progress messages
+
+        Returns:
+            Dictionary of the restored tables (only those the undone saves changed)
+
+        Raises:
+            ValueError: If the date has no logged save, or a later save was not logged
+        """
+        from .processed_dataset import ProcessedDataset
+        from .key_index import ProcessedKeyIndex
+        from .activation_encoding import EncodedActivations
+        from .variant_index import ShapeVariantIndex
+        from .feed_history import FeedHistory
+        from .processing_tracker import ProcessingTracker
+
+        recover_interrupted_save(self.data_folder)
+        kept, undone = self._split_entries(date)
+        if not undone:
+            if show_progress:
+                print(f"The processed data is already as of {date}.")
+            return {}
+
+        if show_progress:
+            print(f"Undoing {len(undone)} save(s) made after {date}...")
+        dataset = ProcessedDataset(self.data_folder)
+        names = sorted({name for entry in undone for name in entry['tables']})
+        tables = {name: dataset.table(name) for name in names}
+        for entry in reversed(undone):
+            for name, spec in entry['tables'].items():
+                tables[name] = self._undo(name, tables[name], spec)
+
+        generation = save_tables_atomic(tables, self.data_folder, show_progress)
+        dataset.mark_saved(generation)
+        for name, df in tables.items():
+            dataset.set_table(name, df)
+            if name in ('shapes', 'shape_variant_activations'):
+                dataset.write_columnar(name, df)
+
+        # Indexes describing the restored tables
+        history = FeedHistory(self.data_folder)
+        # A date merged again after its first save is still merged
+        rolled_back = sorted({entry['date'] for entry in undone} - {entry['date'] for entry in kept})
+        key_index = ProcessedKeyIndex.from_tables(dataset.table('shapes', columns=['shape_id']),
+                                                  dataset.routes, dataset.route_versions)
+        if date in history:
+            key_index.set_feed_routes(history.latest_routes([date]))
+        key_index.save(self.data_folder)
+        EncodedActivations.from_activations(dataset.shape_variant_activations).save(self.data_folder)
+        ShapeVariantIndex.from_variants(dataset.shape_variants).save(self.data_folder)
+        history.discard(rolled_back)
+        if use_tracker:
+            ProcessingTracker(self.data_folder).record_rollback(date, rolled_back)
+
+        # The restored state is that of the date's save; later saves undo to it
+        for entry in undone:
+            self._remove_entry(entry)
+        self._write_entry({'generation': generation, 'date': date, 'tables': {},
+                           'follows': kept[-1]['generation']})
+
+        if show_progress:
+            print(f"Rolled back to {date}: {len(rolled_back)} date(s) no longer merged")
+        return tables
+
+    def _split_entries(self, date: str) -> tuple:
+        """
+        Split the entries at the last save of a date, checking that no later save is missing.
+
+        Returns:
+            Tuple of (entries up to the date's save, entries of the later saves)
+        """
+        entries = self.entries()
+        positions = [i for i, entry in enumerate(entries) if entry['date'] == date]
+        if not positions:
+            raise ValueError(f"No logged save of {date} to roll back to")
+
+        generation = read_save_manifest(self.data_folder)['generation']
+        chain = entries[positions[-1]:]
+        # Each save follows the one before it, except a rollback, which follows the save it restored
+        unbroken = all(entry.get('follows', entry['generation'] - 1) == previous['generation']
+                       for previous, entry in zip(chain, chain[1:]))
+        if not unbroken or chain[-1]['generation'] != generation:
+            raise ValueError(f"The processed data was saved without logging its changes after {date}, "
+                             f"so it cannot be rolled back; reprocess or rebuild it instead")
+        return entries[:positions[-1] + 1], chain[1:]
+
+    def _undo(self, name: str, df: pd.DataFrame, spec: dict) -> pd.DataFrame:
+        """Undo one save of a table."""
+        if spec.get('snapshot'):
+            return self._read_rows(spec['snapshot'], name)
+
+        if spec['added']:
+            added = self._read_rows(spec['added'], name).drop_duplicates().assign(_added=True)
+            keys = ADDED_KEY_COLUMNS[name]
+            # A left merge keeps the table's row order; missing exception types match each other
+            is_added = df[keys].merge(added, on=keys, how='left')['_added']
+            df = df[is_added.isna().to_numpy()]
+        df = df.iloc[:spec['rows']]
+
+        if spec['changed']:
+            changed = self._read_rows(spec['changed'], name).set_index('position')
+            # Rows the save removed from the end come back in place
+            removed = changed[changed.index >= len(df)].sort_index()
+            if not removed.empty:
+                df = pd.concat([df, removed[df.columns]], ignore_index=True)
+            in_place = changed[changed.index < len(df)]
+            df = df.reset_index(drop=True)
+            for col in df.columns:
+                df.loc[in_place.index, col] = in_place[col].to_numpy()
+        return df.reset_index(drop=True)
+
+    # Files
+
+    def _write_rows(self, generation: int, name: str, kind: str, df: pd.DataFrame) -> str:
+        file_name = f'{generation:08d}_{name}_{kind}.csv'
+        df.to_csv(os.path.join(self.folder, file_name), index=kind == 'changed')
+        return file_name
+
+    def _read_rows(self, file_name: str, name: str) -> pd.DataFrame:
+        dtypes = dict(PROCESSED_TABLE_DTYPES[name], position='int64')
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", pd.errors.DtypeWarning)
+            df = pd.read_csv(os.path.join(self.folder, file_name), dtype=dtypes, low_memory=False)
+        for col in PROCESSED_TABLE_DATE_COLUMNS.get(name, []):
+            if col in df:
+                df[col] = pd.to_datetime(df[col])
+        return df
+
+    def _write_entry(self, entry: dict) -> None:
+        path = os.path.join(self.folder, f"{entry['generation']:08d}.json")
+        os.makedirs(self.folder, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(path + '.tmp', path)
+
+    def _remove_entry(self, entry: dict) -> None:
+        os.remove(os.path.join(self.folder, f"{entry['generation']:08d}.json"))
+        for spec in entry['tables'].values():
+            for kind in ('changed', 'added', 'snapshot'):
+                if spec.get(kind):
+                    os.remove(os.path.join(self.folder, spec[kind]))
+
+
+def changed_rows(before_df: pd.DataFrame, after_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Earlier values of the rows a save changed in place or removed from the end.
+
+    Args:
+        before_df: Table before the update
+        after_df: Table after the update; rows are compared by position
+
+    Returns:
+        Rows of before_df that differ from the row at the same position of
+        after_df, or have no row there, indexed by position
+    """
+    # Rows are restored into the saved table, so they take its columns
+    before_df = before_df.reset_index(drop=True).reindex(columns=after_df.columns)
+    common = min(len(before_df), len(after_df))
+    before_hash = pd.util.hash_pandas_object(before_df.iloc[:common], index=False).to_numpy()
+    after_hash = pd.util.hash_pandas_object(
+        after_df.iloc[:common].reset_index(drop=True), index=False
+    ).to_numpy()
+    changed = before_df.iloc[:common][before_hash != after_hash]
+    return pd.concat([changed, before_df.iloc[common:]]) if len(before_df) > common else changed
+
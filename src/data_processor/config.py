@@ -16,12 +16,52 @@ class Config:
     SHAPE_VARIANT_ACTIVATIONS_FILE = 'shape_variant_activations.csv'
     TEMPORARY_CHANGES_FILE = 'temporary_changes.csv'
     
+    # Processed tables in the order of PathManager.get_processed_data_paths
+    PROCESSED_TABLES = (
+        'shapes', 'routes', 'route_versions', 'shape_variants', 
+        'shape_variant_activations', 'temporary_changes'
+    )
+    KEY_INDEX_FILE = 'key_index.json'
+    ACTIVATION_RUNS_FILE = 'activation_runs.npz'
+    VARIANT_INDEX_FILE = 'shape_variant_index.json'
+    SQLITE_FILE = 'processed.sqlite'
+    SAVE_MANIFEST_FILE = 'manifest.json'
+    CONSISTENT_READ_RETRIES = 50
+    
+    # Memory-mapped columnar copies of the large processed tables
+    COLUMNAR_FOLDER = 'columnar'
+    MMAP_TABLES = ('shapes', 'shape_variant_activations')
+    # Id and headsign columns of the columnar files stored as codes of the shared string dictionary
+    STRING_DICTIONARY_FILE = 'strings.jsonl'
+    INTERNED_COLUMNS = ('route_id', 'shape_id', 'service_id', 'trip_headsign', 'route_desc')
+    
+    # Processing history: small header, append-only session log and periodic date snapshots
+    PROCESSING_HISTORY_FILE = 'processing_history.json'
+    PROCESSING_SESSIONS_FILE = 'processing_sessions.jsonl'
+    PROCESSING_SNAPSHOT_FILE = 'processing_dates.json'
+    TRACKER_SNAPSHOT_INTERVAL = 100
+    
+    # Route patterns and service horizon of every merged feed, for inserting feeds out of order
+    FEED_HISTORY_FILE = 'feed_history.jsonl'
+    # Undo records of each save, for rolling the processed data back to an earlier feed
+    CHANGE_LOG_FOLDER = 'change_log'
+    # Number of latest merged dates that can be rolled back to (None keeps every save)
+    CHANGE_LOG_MAX_DATES = 30
+    
+    # Memoized pipeline stage outputs
+    STAGE_CACHE_FOLDER = 'stage_cache'
+    STAGE_CACHE_MAX_PARTITIONS = 30
+    
     # GTFS file names
     GTFS_ROUTES_FILE = 'routes.txt'
     GTFS_TRIPS_FILE = 'trips.txt'
     GTFS_SHAPES_FILE = 'shapes.txt'
     GTFS_CALENDAR_FILE = 'calendar.txt'
     GTFS_CALENDAR_DATES_FILE = 'calendar_dates.txt'
+    SHAPES_CHUNK_SIZE = 200_000
+    
+    # Raw feed inventory
+    FEED_INVENTORY_FILE = 'feed_inventory.json'
     
     # Starting IDs
     START_VERSION_ID = 100_000
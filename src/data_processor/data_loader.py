@@ -8,12 +8,86 @@ import warnings
 import os
 import zipfile
 import tempfile
-from typing import Tuple, Optional
+import time
+from typing import Iterable, List, Tuple, Optional
 
 from .config import PathManager, Config
+from .data_saver import read_save_manifest
 
 
-def load_gtfs_data(date: str, raw_data_folder: Optional[str] = None, print_shapes: bool = False) -> Tuple[pd.DataFrame, ...]:
+# Processed tables in the order of PathManager.get_processed_data_paths
+PROCESSED_TABLES = Config.PROCESSED_TABLES
+
+# Column dtypes used when reading the processed CSV files
+PROCESSED_TABLE_DTYPES = {
+    'shapes': {
+        'shape_id': 'str',
+        'shape_pt_lat': 'float64',
+        'shape_pt_lon': 'float64',
+        'shape_pt_sequence': 'Int64',
+        'shape_dist_traveled': 'float64',
+        'shape_bkk_ref': 'str'  # This column can have mixed types, force to string
+    },
+    'routes': {
+        'route_id': 'str',
+        'agency_id': 'str',
+        'route_short_name': 'str',
+        'route_type': 'Int64',
+        'route_color': 'str',
+        'route_text_color': 'str'
+    },
+    'route_versions': {
+        'version_id': 'Int64',
+        'route_id': 'str',
+        'direction_id': 'Int64',
+        'route_long_name': 'str',
+        'route_desc': 'str',
+        'main_shape_id': 'str',
+        'trip_headsign': 'str',
+        'parent_version_id': 'Int64',
+        'note': 'str'
+    },
+    'shape_variants': {
+        'shape_variant_id': 'Int64',
+        'version_id': 'Int64',
+        'shape_id': 'str',
+        'trip_headsign': 'str',
+        'is_main': 'Int64',
+        'note': 'str'
+    },
+    'shape_variant_activations': {
+        'date': 'str',
+        'shape_variant_id': 'Int64',
+        'exception_type': 'float64'
+    },
+    'temporary_changes': {
+        'detour_id': 'str',
+        'route_id': 'str',
+        'start_date': 'str',
+        'end_date': 'str',
+        'affects_version_id': 'Int64',
+        'description': 'str'
+    }
+}
+
+# Columns parsed as dates when reading the processed CSV files
+PROCESSED_TABLE_DATE_COLUMNS = {
+    'route_versions': ['valid_from', 'valid_to']
+}
+
+
+# dtypes of the GTFS shapes.txt columns
+GTFS_SHAPES_DTYPES = {
+    'shape_id': 'str',
+    'shape_pt_lat': 'float64',
+    'shape_pt_lon': 'float64', 
+    'shape_pt_sequence': 'Int64',
+    'shape_dist_traveled': 'float64'
+}
+
+
+def load_gtfs_data(date: str, raw_data_folder: Optional[str] = None, print_shapes: bool = False,
+                   load_shapes: bool = True) -> Tuple[pd.DataFrame, ...]:
     """
     Load GTFS data files for a specific date.
     Supports both folder structure and zip files.
@@ -22,6 +96,8 @@ def load_gtfs_data(date: str, raw_data_folder: Optional[str] = None, print_shape
         date: Date string (e.g., '20131018')
         raw_data_folder: Custom raw data folder path. If None, uses default.
         print_shapes: Whether to print DataFrame shapes
+        load_shapes: Whether to load shapes.txt. If False, shapes is None and the 
+                     needed shapes can be read later with read_gtfs_shapes.
         
     Returns:
         Tuple of DataFrames: (routes, trips, shapes, calendar, calendar_dates)
@@ -48,7 +124,9 @@ def load_gtfs_data(date: str, raw_data_folder: Optional[str] = None, print_shape
             # Extract zip file to temporary directory
             temp_dir = tempfile.mkdtemp()
             with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
+                members = [name for name in zip_ref.namelist() 
+                           if load_shapes or name != Config.GTFS_SHAPES_FILE]
+                zip_ref.extractall(temp_dir, members)
             data_path = temp_dir
             cleanup_needed = True
         else:
@@ -79,15 +157,11 @@ def load_gtfs_data(date: str, raw_data_folder: Optional[str] = None, print_shape
             }, low_memory=False)
         
         # Read shapes with mixed type handling
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", pd.errors.DtypeWarning)
-            shapes_df = pd.read_csv(shapes_path, dtype={
-                'shape_id': 'str',
-                'shape_pt_lat': 'float64',
-                'shape_pt_lon': 'float64', 
-                'shape_pt_sequence': 'Int64',
-                'shape_dist_traveled': 'float64'
-            }, low_memory=False)
+        shapes_df = None
+        if load_shapes:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", pd.errors.DtypeWarning)
+                shapes_df = pd.read_csv(shapes_path, dtype=GTFS_SHAPES_DTYPES, low_memory=False)
         
         # Read calendar_dates with proper types
         with warnings.catch_warnings():
@@ -101,7 +175,7 @@ def load_gtfs_data(date: str, raw_data_folder: Optional[str] = None, print_shape
         if print_shapes:
             print("Routes:", routes_df.shape)
             print("Trips:", trips_df.shape)
-            print("Shapes:", shapes_df.shape)
+            print("Shapes:", shapes_df.shape if shapes_df is not None else "not loaded")
             print("Calendar Dates:", calendar_dates_df.shape)
 
         try:
@@ -120,6 +194,66 @@ def load_gtfs_data(date: str, raw_data_folder: Optional[str] = None, print_shape
             shutil.rmtree(temp_dir)
 
 
+def read_gtfs_shapes(date: str, shape_ids: Iterable[str], raw_data_folder: Optional[str] = None,
+                     chunksize: int = Config.SHAPES_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    Read the points of the given shapes from a feed's shapes.txt in chunks.
+    
+    The file is streamed (straight out of the zip, without extracting it) and 
+    only rows of the requested shape_ids are kept, so memory use depends on 
+    the requested shapes rather than on the size of shapes.txt.
+    
+    Args:
+        date: Date string (e.g., '20131018')
+        shape_ids: Shape ids to read
+        raw_data_folder: Custom raw data folder path. If None, uses default.
+        chunksize: Number of rows parsed per chunk
+        
+    Returns:
+        DataFrame with the shapes.txt rows of the requested shapes; each shape's 
+        rows form one contiguous block, in file order
+    """
+    if raw_data_folder is None:
+        raw_data_folder = Config.get_default_raw_data_folder()
+    
+    base_path = os.path.join(raw_data_folder, date)
+    folder_shapes_path = os.path.join(base_path, Config.GTFS_SHAPES_FILE)
+    zip_path = base_path + '.zip'
+    shape_ids = set(shape_ids)
+    
+    if os.path.isdir(base_path):
+        zip_ref = None
+        handle = open(folder_shapes_path, 'rb')
+    elif os.path.isfile(zip_path):
+        zip_ref = zipfile.ZipFile(zip_path, 'r')
+        handle = zip_ref.open(Config.GTFS_SHAPES_FILE)
+    else:
+        raise FileNotFoundError(f"No data found for date {date}. Checked: {base_path} and {zip_path}")
+    
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", pd.errors.DtypeWarning)
+            reader = pd.read_csv(handle, dtype=GTFS_SHAPES_DTYPES, chunksize=chunksize, low_memory=False)
+            columns = None
+            kept = []
+            for chunk in reader:
+                columns = chunk.columns
+                if shape_ids:
+                    kept.append(chunk[chunk['shape_id'].isin(shape_ids)])
+    finally:
+        handle.close()
+        if zip_ref is not None:
+            zip_ref.close()
+    
+    if not kept:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in GTFS_SHAPES_DTYPES.items()}
+                            ).reindex(columns=columns if columns is not None else list(GTFS_SHAPES_DTYPES))
+    
+    shapes_df = pd.concat(kept, ignore_index=True)
+    # Stable sort groups each shape's points without reordering them
+    return shapes_df.sort_values('shape_id', kind='mergesort').reset_index(drop=True)
+
+
 def load_processed_data(data_folder: Optional[str] = None) -> Tuple[pd.DataFrame, ...]:
     """
     Load processed data files or create empty ones if they don't exist.
@@ -137,67 +271,8 @@ def load_processed_data(data_folder: Optional[str] = None) -> Tuple[pd.DataFrame
     file_paths = PathManager.get_processed_data_paths(data_folder)
     
     try:
-        # Load shapes with proper dtype handling to avoid mixed type warnings
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", pd.errors.DtypeWarning)
-            shapes_df = pd.read_csv(file_paths[0], dtype={
-                'shape_id': 'str',
-                'shape_pt_lat': 'float64',
-                'shape_pt_lon': 'float64',
-                'shape_pt_sequence': 'Int64',
-                'shape_dist_traveled': 'float64',
-                'shape_bkk_ref': 'str'  # This column can have mixed types, force to string
-            }, low_memory=False)
-        
-        # Load routes
-        routes_df = pd.read_csv(file_paths[1], dtype={
-            'route_id': 'str',
-            'agency_id': 'str',
-            'route_short_name': 'str',
-            'route_type': 'Int64',
-            'route_color': 'str',
-            'route_text_color': 'str'
-        })
-        
-        # Load route versions with date parsing
-        route_versions_df = pd.read_csv(file_paths[2], parse_dates=['valid_from', 'valid_to'], dtype={
-            'version_id': 'Int64',
-            'route_id': 'str',
-            'direction_id': 'Int64',
-            'route_long_name': 'str',
-            'route_desc': 'str',
-            'main_shape_id': 'str',
-            'trip_headsign': 'str',
-            'parent_version_id': 'Int64',
-            'note': 'str'
-        })
-        
-        # Load shape variants
-        shape_variants_df = pd.read_csv(file_paths[3], dtype={
-            'shape_variant_id': 'Int64',
-            'version_id': 'Int64',
-            'shape_id': 'str',
-            'trip_headsign': 'str',
-            'is_main': 'Int64',
-            'note': 'str'
-        })
-        
-        # Load shape variant activations
-        shape_variant_activations_df = pd.read_csv(file_paths[4], dtype={
-            'date': 'str',
-            'shape_variant_id': 'Int64',
-            'exception_type': 'float64'
-        })
-        
-        # Load temporary changes
-        temporary_changes_df = pd.read_csv(file_paths[5], dtype={
-            'detour_id': 'str',
-            'route_id': 'str',
-            'start_date': 'str',
-            'end_date': 'str',
-            'affects_version_id': 'Int64',
-            'description': 'str'
-        })
+        (shapes_df, routes_df, route_versions_df, shape_variants_df, 
+         shape_variant_activations_df, temporary_changes_df) = _read_consistent_tables(data_folder)
         
     except FileNotFoundError:
         print("Some processed data files not found. Creating empty dataframes.")
@@ -214,6 +289,77 @@ def load_processed_data(data_folder: Optional[str] = None) -> Tuple[pd.DataFrame
             shape_variant_activations_df, temporary_changes_df)
 
 
+def get_processed_table_path(name: str, data_folder: Optional[str] = None) -> str:
+    """
+    Get the CSV path of a processed table.
+    
+    Args:
+        name: Table name, one of PROCESSED_TABLES
+        data_folder: Custom data folder path. If None, uses auto-detected path.
+        
+    Returns:
+        Path of the table's CSV file
+    """
+    if name not in PROCESSED_TABLES:
+        raise ValueError(f"Unknown processed table: {name}")
+    return PathManager.get_processed_data_paths(data_folder)[PROCESSED_TABLES.index(name)]
+
+
+def read_processed_table(name: str, data_folder: Optional[str] = None, 
+                         columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Read one processed table from its CSV file with the proper dtypes.
+    
+    Args:
+        name: Table name, one of PROCESSED_TABLES
+        data_folder: Custom data folder path. If None, uses auto-detected path.
+        columns: Columns to read. If None, reads all columns.
+        
+    Returns:
+        DataFrame with the table data
+    """
+    path = get_processed_table_path(name, data_folder)
+    dtypes = PROCESSED_TABLE_DTYPES[name]
+    date_columns = PROCESSED_TABLE_DATE_COLUMNS.get(name, [])
+    if columns is not None:
+        dtypes = {col: dtype for col, dtype in dtypes.items() if col in columns}
+        date_columns = [col for col in date_columns if col in columns]
+    
+    # Suppress mixed type warnings for cleaner output
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", pd.errors.DtypeWarning)
+        return pd.read_csv(path, dtype=dtypes, parse_dates=date_columns or False, 
+                           usecols=columns, low_memory=False)
+
+
+def _read_consistent_tables(data_folder: str) -> Tuple[pd.DataFrame, ...]:
+    """
+    Read all processed tables from one save generation.
+    
+    The save manifest is checked before and after reading; if a save was in 
+    progress or completed in between, the read is retried. Readers never touch
+    the files: a save interrupted while renaming them is completed by the
+    writer's next save.
+    
+    Raises:
+        RuntimeError: If no complete generation could be read within the retries
+    """
+    for _ in range(Config.CONSISTENT_READ_RETRIES):
+        before = read_save_manifest(data_folder)
+        if before['state'] == 'committed':
+            tables = tuple(read_processed_table(name, data_folder) for name in PROCESSED_TABLES)
+            after = read_save_manifest(data_folder)
+            if after['state'] == 'committed' and after['generation'] == before['generation']:
+                return tables
+        time.sleep(0.1)
+    
+    raise RuntimeError(
+        f"The processed data in {data_folder} is being saved, or its last save was "
+        f"interrupted (generation {before['generation']} is '{before['state']}'). "
+        f"Retry once the save finished; the next save completes an interrupted one."
+    )
+
+
 def _create_empty_calendar_dataframe() -> pd.DataFrame:
     """Create an empty calendar DataFrame with proper structure."""
     calendar_df = pd.DataFrame(columns=[
@@ -1,8 +1,12 @@
 """
 Data saving functions for processed transit data.
 """
+import os
+import json
 import pandas as pd
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional
 
 from .config import PathManager, Config
 
@@ -147,11 +151,176 @@ def save_all_processed_data(shapes_df: pd.DataFrame, routes_df: pd.DataFrame,
         data_folder: Custom data folder path. If None, uses auto-detected path.
         show_progress: Whether to show progress messages
     """
-    save_shapes(shapes_df, data_folder, show_progress)
-    save_routes(routes_df, data_folder, show_progress)
-    save_route_versions(route_versions_df, data_folder, show_progress)
-    save_shape_variants(shape_variants_df, data_folder, show_progress)
-    save_shape_variant_activations(shape_variant_activations_df, data_folder, show_progress)
-    save_temporary_changes(temporary_changes_df, data_folder, show_progress)
+    save_tables_atomic({
+        'shapes': shapes_df,
+        'routes': routes_df,
+        'route_versions': route_versions_df,
+        'shape_variants': shape_variants_df,
+        'shape_variant_activations': shape_variant_activations_df,
+        'temporary_changes': temporary_changes_df
+    }, data_folder, show_progress)
     if show_progress:
-        print("All processed data saved successfully!")
\ No newline at end of file
+        print("All processed data saved successfully!")
+
+
+def save_tables_atomic(tables: Dict[str, pd.DataFrame], data_folder: Optional[str] = None,
+                       show_progress: bool = True, max_workers: Optional[int] = None) -> int:
+    """
+    Save several processed tables as one unit.
+    
+    The tables are written concurrently to temporary files next to the live
+    files. Only when all of them are complete and flushed to disk is the manifest switched to the
+    new generation (state 'committing') and the temporary files renamed over the
+    live ones, after which the manifest is marked 'committed'. Each rename is 
+    atomic, readers that follow the manifest (see read_save_manifest) never mix 
+    generations, and a save interrupted during the renames is completed by 
+    recover_interrupted_save.
+    
+    Args:
+        tables: DataFrames to save keyed by table name (e.g. 'routes', 'shapes')
+        data_folder: Custom data folder path. If None, uses auto-detected path.
+        show_progress: Whether to show progress messages
+        max_workers: Number of tables serialized at the same time. If None, one per table.
+        
+    Returns:
+        Generation number of the saved state
+    """
+    if data_folder is None:
+        data_folder = Config.get_default_processed_data_folder()
+    os.makedirs(data_folder, exist_ok=True)
+    
+    recover_interrupted_save(data_folder)
+    
+    file_paths = PathManager.get_processed_data_paths(data_folder)
+    paths = {name: file_paths[Config.PROCESSED_TABLES.index(name)] for name in tables}
+    
+    manifest = read_save_manifest(data_folder)
+    generation = manifest['generation'] + 1
+    temp_paths = {name: f"{path}.tmp{generation}" for name, path in paths.items()}
+    
+    # Serialize all tables concurrently; to_csv releases the GIL for much of its work
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(tables), 1)) as executor:
+        futures = [
+            executor.submit(_write_table_file, df, temp_paths[name])
+            for name, df in tables.items()
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            for temp_path in temp_paths.values():
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            raise
+    
+    files = {name: os.path.basename(path) for name, path in paths.items()}
+    _write_save_manifest(data_folder, generation, 'committing', files)
+    for name in tables:
+        os.replace(temp_paths[name], paths[name])
+    _fsync_directory(data_folder)
+    _write_save_manifest(data_folder, generation, 'committed', files)
+    
+    if show_progress:
+        for name, path in paths.items():
+            print(f"{name}_df saved to {path}")
+        print(f"Saved generation {generation}")
+    
+    return generation
+
+
+def read_save_manifest(data_folder: Optional[str] = None) -> dict:
+    """
+    Read the save manifest of the processed data folder.
+    
+    Readers wanting a consistent view read the manifest, then the tables, then 
+    the manifest again, and retry if the generation changed or the state was 
+    not 'committed'.
+    
+    Args:
+        data_folder: Custom data folder path. If None, uses auto-detected path.
+        
+    Returns:
+        Manifest dictionary with generation, state and files keys
+    """
+    if data_folder is None:
+        data_folder = Config.get_default_processed_data_folder()
+    
+    manifest_path = os.path.join(data_folder, Config.SAVE_MANIFEST_FILE)
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'generation': 0, 'state': 'committed', 'files': {}}
+
+
+def recover_interrupted_save(data_folder: Optional[str] = None) -> bool:
+    """
+    Finish a save that was interrupted while renaming its files.
+    
+    Once the manifest says 'committing', all temporary files of that generation
+    are complete, so the save is rolled forward.
+    
+    Args:
+        data_folder: Custom data folder path. If None, uses auto-detected path.
+        
+    Returns:
+        True if an interrupted save was completed
+    """
+    if data_folder is None:
+        data_folder = Config.get_default_processed_data_folder()
+    
+    manifest = read_save_manifest(data_folder)
+    if manifest['state'] != 'committing':
+        return False
+    
+    generation = manifest['generation']
+    for filename in manifest['files'].values():
+        path = os.path.join(data_folder, filename)
+        temp_path = f"{path}.tmp{generation}"
+        try:
+            os.replace(temp_path, path)
+        except FileNotFoundError:
+            pass  # Already renamed before the interruption
+    _fsync_directory(data_folder)
+    
+    _write_save_manifest(data_folder, generation, 'committed', manifest['files'])
+    print(f"Completed interrupted save of generation {generation}")
+    return True
+
+
+def _write_save_manifest(data_folder: str, generation: int, state: str, files: Dict[str, str]) -> None:
+    """Atomically replace the save manifest."""
+    manifest_path = os.path.join(data_folder, Config.SAVE_MANIFEST_FILE)
+    temp_path = manifest_path + '.tmp'
+    
+    with open(temp_path, 'w') as f:
+        json.dump({
+            'generation': generation,
+            'state': state,
+            'files': files,
+            'saved_at': datetime.now().isoformat()
+        }, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, manifest_path)
+    _fsync_directory(data_folder)
+
+
+def _write_table_file(df: pd.DataFrame, path: str) -> None:
+    """Write a table's CSV and flush it to disk, so a committed manifest never points at partial files."""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        df.to_csv(f, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _fsync_directory(folder: str) -> None:
+    """Make the renames in a folder durable."""
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return  # Directories cannot be opened on some platforms (Windows)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
\ No newline at end of file
@@ -0,0 +1,220 @@
+"""
+Append-only history of the route patterns of every merged feed.
+
+The route_versions table only keeps the feeds where a route direction's
+pattern changed. FeedHistory keeps the pattern of every (route_id,
+direction_id) in every merged feed, and the first and last service date of
+the feed, so the version chains can be re-derived when a feed is inserted
+between already merged ones (see FeedInserter) without loading the other
+feeds again. One JSON object per line; a feed merged again replaces its
+earlier entry.
+"""
+import os
+import json
+import threading
+import pandas as pd
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .config import Config
+
+ROUTE_PATTERN_COLUMNS = ['route_id', 'direction_id', 'main_shape_id', 'trip_headsign', 'route_desc', 'valid_from']
+
+
+class FeedHistory:
+    """Route patterns and service horizon of each merged feed, stored next to the processed data."""
+
+    def __init__(self, data_folder: Optional[str] = None):
+        """
+        Initialize the history. The file is read on first use.
+
+        Args:
+            data_folder: Processed data folder the history file is stored in.
+                         If None, uses auto-detected path.
+        """
+        if data_folder is None:
+            data_folder = Config.get_default_processed_data_folder()
+
+        self.path = os.path.join(data_folder, Config.FEED_HISTORY_FILE)
+        self._entries: Optional[Dict[str, dict]] = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, date: str) -> bool:
+        return date in self._load()
+
+    def dates(self) -> List[str]:
+        """Sorted dates of the recorded feeds."""
+        return sorted(self._load())
+
+    def record(self, feed_data: dict) -> None:
+        """
+        Append a merged feed's entry.
+
+        Args:
+            feed_data: Dictionary returned by TransitDataProcessor.prepare_feed
+        """
+        entry = _make_entry(feed_data)
+        with self._lock:
+            if self._entries is None:
+                # Appending does not need the entries, only a file that ends with a complete line
+                _truncate_interrupted_line(self.path)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if self._entries is not None:
+                self._entries[entry['date']] = entry
+
+    def rewrite(self, feeds: Iterable[dict]) -> None:
+        """
+        Replace the history with the entries of the given feeds.
+
+        Args:
+            feeds: Dictionaries returned by TransitDataProcessor.prepare_feed
+        """
+        entries = {entry['date']: entry for entry in map(_make_entry, feeds)}
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                for date in sorted(entries):
+                    f.write(json.dumps(entries[date]) + '\n')
+            os.replace(temp_path, self.path)
+            self._entries = entries
+
+    def discard(self, dates: Iterable[str]) -> None:
+        """
+        Remove the entries of feeds that are no longer merged (see ChangeLog.rollback).
+
+        Args:
+            dates: Feed dates to remove
+        """
+        dates = set(dates)
+        entries = self._load()
+        if not dates & set(entries):
+            return
+        with self._lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                for date in sorted(entries):
+                    if date not in dates:
+                        f.write(json.dumps(entries[date]) + '\n')
+            os.replace(temp_path, self.path)
+            self._entries = {date: entry for date, entry in entries.items() if date not in dates}
+
+    def latest_routes(self, dates: Iterable[str]) -> pd.DataFrame:
+        """
+        Get the recorded route patterns of the given feeds.
+
+        Args:
+            dates: Feed dates, all recorded
+
+        Returns:
+            DataFrame with ROUTE_PATTERN_COLUMNS and a feed_date column, in the given feed order
+        """
+        entries = self._load()
+        frames = [pd.DataFrame(entries[date]['routes'], columns=ROUTE_PATTERN_COLUMNS).assign(feed_date=date)
+                  for date in dates]
+        if not frames:
+            return pd.DataFrame(columns=ROUTE_PATTERN_COLUMNS + ['feed_date'])
+        latest_routes = pd.concat(frames, ignore_index=True)
+        latest_routes['direction_id'] = latest_routes['direction_id'].astype('Int64')
+        return latest_routes
+
+    def service_horizon(self, date: str) -> Tuple[Optional[str], Optional[str]]:
+        """First and last service date (YYYY-MM-DD) of a recorded feed, None if it has no service."""
+        entry = self._load()[date]
+        return entry['service_start'], entry['service_end']
+
+    def _load(self) -> Dict[str, dict]:
+        """Read the history file on first use."""
+        if self._entries is not None:
+            return self._entries
+
+        entries = {}
+        _truncate_interrupted_line(self.path)
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    entries[entry['date']] = entry
+
+        self._entries = entries
+        return entries
+
+
+def service_horizon(service_ranges_df: pd.DataFrame, df_exceptions: pd.DataFrame) -> Tuple[Optional[str], Optional[str]]:
+    """
+    First and last date a feed's services can be active on.
+
+    Args:
+        service_ranges_df: DataFrame from build_service_ranges_without_exceptions
+        df_exceptions: DataFrame with service data with exceptions
+
+    Returns:
+        Tuple of (first, last) date as YYYY-MM-DD, or (None, None) if there is no service
+    """
+    dates = pd.concat([
+        pd.to_datetime(service_ranges_df['start_date']),
+        pd.to_datetime(service_ranges_df['end_date']),
+        pd.to_datetime(df_exceptions['date'])
+    ], ignore_index=True).dropna()
+    if dates.empty:
+        return None, None
+    return dates.min().strftime('%Y-%m-%d'), dates.max().strftime('%Y-%m-%d')
+
+
+def _truncate_interrupted_line(path: str) -> None:
+    """Cut a last line without a newline (an interrupted append) off the file."""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            chunk_start = max(0, position - 65536)
+            f.seek(chunk_start)
+            chunk = f.read(position - chunk_start)
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                position = chunk_start + newline + 1
+                break
+            position = chunk_start
+        if position < end:
+            f.truncate(position)
+
+
+def route_patterns(latest_routes_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Route pattern columns of a feed's latest routes, as FeedHistory stores them.
+
+    Args:
+        latest_routes_df: Latest routes DataFrame of a feed
+
+    Returns:
+        DataFrame with ROUTE_PATTERN_COLUMNS: Int64 direction_id, other values strings or None
+    """
+    patterns = pd.DataFrame(index=latest_routes_df.index)
+    for col in ROUTE_PATTERN_COLUMNS:
+        if col == 'direction_id':
+            patterns[col] = pd.to_numeric(latest_routes_df[col], errors='coerce').astype('Int64')
+        else:
+            patterns[col] = [None if pd.isna(value) else str(value) 
+                             for value in latest_routes_df[col].astype(object)]
+    return patterns
+
+
+def _make_entry(feed_data: dict) -> dict:
+    """History entry of a prepared feed, with plain JSON values."""
+    patterns = route_patterns(feed_data['latest_routes'])
+    routes = {col: [None if pd.isna(value) else value for value in patterns[col].astype(object)]
+              for col in ROUTE_PATTERN_COLUMNS}
+    routes['direction_id'] = [None if value is None else int(value) for value in routes['direction_id']]
+
+    service_start, service_end = service_horizon(feed_data['service_ranges'], feed_data['df_exceptions'])
+    return {
+        'date': feed_data['date'],
+        'service_start': service_start,
+        'service_end': service_end,
+        'routes': routes
+    }
@@ -0,0 +1,717 @@
+"""
+Insertion of a feed between already merged feeds.
+
+TransitDataProcessor merges feeds in date order: update_route_versions closes
+whatever versions are open, and activations are only ever added. A feed that
+turns up later but falls before already merged feeds would otherwise mean
+reprocessing every later date. FeedInserter merges such a feed in place:
+
+- the version chains of the (route_id, direction_id) keys the feed has are
+  re-derived from the route patterns kept in FeedHistory, as change points
+  of each key's pattern over the feeds (like BulkRebuilder), and matched to
+  the existing versions; versions keep their ids where their feeds allow;
+- every merged feed of a key is attributed to one version, before and after
+  the insertion. The activations of a version whose feeds now belong to
+  other versions are moved to them by date, using the feeds' service
+  horizons; the dates several versions' feeds can account for are rebuilt
+  from the feeds whose horizon reaches them, which are the feeds around the
+  inserted date;
+- the inserted feed's own shape variants and activations are added.
+
+The result matches merging all feeds in date order (without fix_overlaps),
+up to the ids given to new versions and variants. Shapes already in the
+processed data are kept, even if the inserted feed would have been the first
+to provide them.
+"""
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .data_loader import PROCESSED_TABLE_DTYPES, read_gtfs_shapes
+from .data_saver import save_tables_atomic, recover_interrupted_save
+from .config import Config
+from .pipeline import TransitDataProcessor
+from .processed_dataset import ProcessedDataset
+from .processing_tracker import ProcessingTracker
+from .feed_history import FeedHistory, route_patterns, service_horizon
+from .change_log import ChangeLog
+from .bulk_rebuild import VERSION_KEY_COLUMNS, build_route_versions
+from .shape_processor import build_shape_variant_ranges, trim_service_ranges, expand_variant_activations
+from .shapes_updater import update_shapes_from_variants
+from .key_index import ProcessedKeyIndex
+from .activation_encoding import EncodedActivations
+from .variant_index import VARIANT_KEY_COLUMNS, ShapeVariantIndex
+
+VERSION_CONTENT_COLUMNS = ['route_id', 'direction_id', 'main_shape_id', 'trip_headsign', 'route_desc',
+                           'valid_from', 'valid_to']
+
+# Day numbers bounding the empty service horizon
+_NO_DAY = np.iinfo('int64').max // 2
+
+
+class FeedInserter:
+    """Merges a feed into processed data that already has later feeds."""
+
+    def __init__(self, data_folder: Optional[str] = None, raw_data_folder: Optional[str] = None,
+                 use_tracker: bool = True, trim_horizon: bool = False, prepare_workers: int = 4):
+        """
+        Initialize the inserter.
+
+        Args:
+            data_folder: Path to processed data folder. If None, uses auto-detected path.
+            raw_data_folder: Path to raw data folder. If None, uses auto-detected path.
+            use_tracker: Whether the processed dates of the processing history count as
+                         merged feeds (besides those in FeedHistory), and whether the
+                         inserted date is recorded there.
+            trim_horizon: Whether each feed's activations only cover the dates up to the
+                          next feed's date (see TransitDataProcessor). Must match how the
+                          processed data was built.
+            prepare_workers: Number of feeds loaded at once when the feed history has to
+                             be completed.
+        """
+        self.processor = TransitDataProcessor(data_folder, raw_data_folder, trim_horizon=trim_horizon)
+        self.data_folder = data_folder
+        self.raw_data_folder = raw_data_folder
+        self.use_tracker = use_tracker
+        self.trim_horizon = trim_horizon
+        self.prepare_workers = prepare_workers
+        self.history = FeedHistory(data_folder)
+
+    def insert(self, date: str, merged_dates: Optional[List[str]] = None, save_data: bool = True,
+               show_progress: bool = True) -> Dict[str, pd.DataFrame]:
+        """
+        Merge the feed of a date into the processed data, at its place among the merged feeds.
+
+        Args:
+            date: Date of the feed to insert
+            merged_dates: Dates of the feeds merged into the processed data. If None, the
+                          feeds in FeedHistory and the processing history.
+            save_data: Whether to save the updated tables
+            show_progress: Whether to show progress messages
+
+        Returns:
+            Dictionary with the updated routes, route_versions, shape_variants and
+            shape_variant_activations tables, and shapes if the feed added any
+
+        Raises:
+            ValueError: If the date is already merged, or the route versions do not
+                        match the merged feeds (e.g. built with fix_overlaps)
+        """
+        tracker = ProcessingTracker(self.data_folder) if self.use_tracker else None
+        if merged_dates is None:
+            # Every merged feed is in the history; the processing history also has those
+            # merged before the feed history existed
+            merged_dates = set(self.history.dates())
+            if tracker is not None:
+                merged_dates |= tracker.processed_dates & tracker.get_available_dates(self.raw_data_folder)
+        if date in merged_dates:
+            raise ValueError(f"The feed of {date} is already merged")
+
+        dates = sorted(set(merged_dates) | {date})
+        position = dates.index(date)
+        if show_progress:
+            print(f"Inserting the feed of {date} before {len(dates) - position - 1} "
+                  f"and after {position} merged feed(s)...")
+
+        feed = self.processor.prepare_feed(date, False)
+        self._complete_history(merged_dates, show_progress)
+
+        recover_interrupted_save(self.data_folder)
+        dataset = ProcessedDataset(self.data_folder)
+        insertion = _Insertion(self, dates, position, feed, dataset)
+        tables = insertion.run(show_progress)
+
+        if save_data:
+            if show_progress:
+                print("Saving processed data...")
+            self._save(date, dataset, tables, insertion.key_index, insertion.variant_index, show_progress)
+            self.history.record(feed)
+            if tracker is not None:
+                tracker.record_processing_session(date, date, [date], [])
+        return tables
+
+    def _complete_history(self, merged_dates, show_progress: bool) -> None:
+        """Record the merged feeds that are missing from the feed history (merged before it existed)."""
+        missing = sorted(set(merged_dates) - set(self.history.dates()))
+        if not missing:
+            return
+        if show_progress:
+            print(f"Recording the route patterns of {len(missing)} merged feed(s)...")
+        with ThreadPoolExecutor(max_workers=self.prepare_workers) as executor:
+            for feed in executor.map(lambda day: self.processor.prepare_feed(day, False), missing):
+                self.history.record(feed)
+
+    def _save(self, date: str, dataset: ProcessedDataset, tables: Dict[str, pd.DataFrame],
+              key_index: ProcessedKeyIndex, variant_index: ShapeVariantIndex, show_progress: bool) -> None:
+        """Save the changed tables, their columnar copies and the indexes describing them."""
+        # The insertion changes rows anywhere in the tables, so the change log keeps their files
+        change_log = ChangeLog(self.data_folder)
+        snapshots = change_log.snapshot_tables(tables)
+        generation = save_tables_atomic(tables, self.data_folder, show_progress)
+        dataset.mark_saved(generation)
+        change_log.record(generation, date, {}, snapshots=snapshots)
+        if 'shapes' in tables:
+            dataset.write_columnar('shapes', tables['shapes'])
+        dataset.write_columnar('shape_variant_activations', tables['shape_variant_activations'])
+
+        key_index.save(self.data_folder)
+        EncodedActivations.from_activations(tables['shape_variant_activations']).save(self.data_folder)
+        variant_index.save(self.data_folder)
+
+
+class _Insertion:
+    """State of one feed insertion (see FeedInserter)."""
+
+    def __init__(self, inserter: FeedInserter, dates: List[str], position: int, feed: dict,
+                 dataset: ProcessedDataset):
+        self.inserter = inserter
+        self.dates = dates
+        self.position = position
+        self.feed = feed
+        self.dataset = dataset
+        self.trim_horizon = inserter.trim_horizon
+        self.new_variants: List[pd.DataFrame] = []
+        self.key_index: Optional[ProcessedKeyIndex] = None
+        self.variant_index: Optional[ShapeVariantIndex] = None
+
+    def run(self, show_progress: bool) -> Dict[str, pd.DataFrame]:
+        """Compute the updated tables."""
+        routes_df = self.dataset.routes
+        route_versions_df = self.dataset.route_versions
+        shape_variants_df = self.dataset.shape_variants
+        activations_df = self.dataset.shape_variant_activations
+        self.variant_index = ShapeVariantIndex.load(shape_variants_df, self.inserter.data_folder)
+
+        latest = self._route_patterns()
+        self._coverage()
+
+        # Version chains of the keys the feed has, without and with it
+        versions, changed_keys = self._derive_versions(latest, route_versions_df)
+        plans = [self._plan_key(key, key_versions) for key, key_versions in versions.groupby('key', sort=False)
+                 if key in changed_keys]
+        self._assign_version_ids(versions, plans, route_versions_df)
+        updated_route_versions_df = self._update_route_versions(route_versions_df, versions, plans)
+
+        # Activations of the versions whose feeds moved to other versions, and the feed's own
+        touched = [move for plan in plans for move in plan['moves'] if move['touched']]
+        touched_ids = {versions.at[move['old'], 'old_id'] for move in touched}
+        touched_vids = shape_variants_df.loc[shape_variants_df['version_id'].isin(touched_ids), 'shape_variant_id']
+        is_touched = activations_df['shape_variant_id'].isin(touched_vids).to_numpy()
+        moved, recompute = self._move_activations(versions, touched, activations_df[is_touched],
+                                                  shape_variants_df)
+        for plan in plans:
+            for new_row, feed_lo, feed_hi in plan['fresh']:
+                for feed_index in range(feed_lo, feed_hi):
+                    if feed_index != self.position:
+                        recompute.setdefault(feed_index, []).append((new_row, None))
+        recomputed = self._recompute(versions, recompute, show_progress)
+
+        active = versions[(versions['new_created'] <= self.position) & (versions['new_closed'] > self.position)]
+        feed_variant_data = self._shape_variant_data(self.feed, self.position, active)
+        feed_activations = pd.DataFrame(columns=['date', 'shape_variant_id', 'exception_type'])
+        if not feed_variant_data.empty:
+            feed_variant_data = self._assign_variant_ids(feed_variant_data)
+            feed_activations = expand_variant_activations(feed_variant_data)
+
+        kept = activations_df[~is_touched]
+        if self.trim_horizon:
+            # The dates from the inserted feed to the next one were the previous feed's
+            lo, hi = self._trim_window()
+            kept = kept[~((kept['date'] >= lo) & (kept['date'] < hi))]
+            moved = moved[~((moved['date'] >= lo) & (moved['date'] < hi))]
+        parts = [df.astype({'shape_variant_id': 'int64', 'exception_type': 'float64'})
+                 for df in (kept, moved, recomputed, feed_activations) if not df.empty]
+        updated_activations_df = pd.concat(parts, ignore_index=True) if parts else kept
+        updated_activations_df = updated_activations_df.drop_duplicates(['date', 'shape_variant_id', 'exception_type'])
+        updated_activations_df = updated_activations_df.sort_values(
+            ['date', 'shape_variant_id'], kind='stable'
+        ).reset_index(drop=True)
+
+        updated_shape_variants_df = self._update_shape_variants(shape_variants_df, activations_df,
+                                                                updated_activations_df, updated_route_versions_df)
+        updated_routes_df = self._update_routes(routes_df, latest)
+        updated_shapes_df = self._update_shapes(feed_variant_data, show_progress)
+
+        if show_progress:
+            print(f"Route versions: {len(plans)} route direction(s) re-derived, "
+                  f"{len(updated_route_versions_df) - len(route_versions_df):+d} version(s)")
+            print(f"Shape variants: {len(updated_shape_variants_df)}, "
+                  f"activations: {len(updated_activations_df)} "
+                  f"({len(moved)} moved, {len(recomputed)} rebuilt from {len(recompute)} feed(s), "
+                  f"{len(feed_activations)} from the inserted feed)")
+
+        # Indexes describing the updated tables
+        shape_ids_df = updated_shapes_df if updated_shapes_df is not None else \
+            self.dataset.table('shapes', columns=['shape_id'])
+        self.key_index = ProcessedKeyIndex.from_tables(shape_ids_df, updated_routes_df,
+                                                       updated_route_versions_df)
+        last_feed = self.feed['latest_routes'] if self.position == len(self.dates) - 1 else \
+            self.inserter.history.latest_routes([self.dates[-1]])
+        self.key_index.set_feed_routes(last_feed)
+        next_id = self.variant_index.next_id
+        self.variant_index = ShapeVariantIndex.from_variants(updated_shape_variants_df)
+        self.variant_index.next_id = max(self.variant_index.next_id, next_id)
+
+        tables = {
+            'routes': updated_routes_df,
+            'route_versions': updated_route_versions_df,
+            'shape_variants': updated_shape_variants_df,
+            'shape_variant_activations': updated_activations_df
+        }
+        if updated_shapes_df is not None:
+            tables['shapes'] = updated_shapes_df
+        return tables
+
+    # Feeds
+
+    def _route_patterns(self) -> pd.DataFrame:
+        """Route patterns of all feeds in date order, with the feed's position and the key of each row."""
+        history = self.inserter.history
+        latest = pd.concat([
+            history.latest_routes(self.dates[:self.position]),
+            route_patterns(self.feed['latest_routes']).assign(feed_date=self.dates[self.position]),
+            history.latest_routes(self.dates[self.position + 1:])
+        ], ignore_index=True)
+        latest['direction_id'] = latest['direction_id'].astype('Int64')
+        latest['feed'] = latest['feed_date'].map({date: i for i, date in enumerate(self.dates)})
+        latest['key'] = latest.groupby(VERSION_KEY_COLUMNS, sort=False, dropna=False).ngroup()
+        return latest
+
+    def _coverage(self) -> None:
+        """Day numbers each feed's activations can fall on, before and after the insertion."""
+        count = len(self.dates)
+        starts = np.full(count, _NO_DAY, dtype='int64')
+        ends = np.full(count, -_NO_DAY, dtype='int64')
+        feed_days = _to_days(pd.Series(pd.to_datetime(self.dates, format='%Y%m%d').strftime('%Y-%m-%d')))
+        for i, date in enumerate(self.dates):
+            if i == self.position:
+                start, end = service_horizon(self.feed['service_ranges'], self.feed['df_exceptions'])
+            else:
+                start, end = self.inserter.history.service_horizon(date)
+            if start is not None:
+                starts[i], ends[i] = _to_days(pd.Series([start, end]))
+
+        self.new_lo, self.new_hi = starts.copy(), ends.copy()
+        if self.trim_horizon:
+            # Each feed covers the dates from its own date up to the next feed's date
+            self.new_lo = np.maximum(self.new_lo, feed_days)
+            self.new_hi[:-1] = np.minimum(self.new_hi[:-1], feed_days[1:] - 1)
+        self.old_lo, self.old_hi = self.new_lo.copy(), self.new_hi.copy()
+        self.old_lo[self.position], self.old_hi[self.position] = _NO_DAY, -_NO_DAY
+        if self.trim_horizon and self.position > 0:
+            previous = self.position - 1
+            self.old_hi[previous] = (min(ends[previous], feed_days[self.position + 1] - 1)
+                                     if self.position + 1 < count else ends[previous])
+
+    def _trim_window(self) -> Tuple[str, str]:
+        """Dates (YYYY-MM-DD) the previous feed covered and the inserted feed covers now (trim_horizon)."""
+        lo = pd.to_datetime(self.dates[self.position], format='%Y%m%d').strftime('%Y-%m-%d')
+        if self.position + 1 < len(self.dates):
+            hi = pd.to_datetime(self.dates[self.position + 1], format='%Y%m%d').strftime('%Y-%m-%d')
+        else:
+            hi = '9999-12-31'
+        return lo, hi
+
+    def _load_feed(self, feed_index: int) -> dict:
+        if feed_index == self.position:
+            return self.feed
+        return self.inserter.processor.prepare_feed(self.dates[feed_index], False)
+
+    def _shape_variant_data(self, feed: dict, feed_index: int, versions: pd.DataFrame) -> pd.DataFrame:
+        """Range-form shape variant data of a feed against the given versions (with final ids)."""
+        valid_routes = pd.DataFrame({
+            'version_id': versions['new_id'].astype('int64'),
+            'route_id': versions['route_id'],
+            'direction_id': versions['direction_id'],
+            'main_shape_id': versions['main_shape_id'],
+            'valid_to': pd.NaT
+        })
+        service_ranges, df_exceptions = feed['service_ranges'], feed['df_exceptions']
+        if self.trim_horizon:
+            next_date = self.dates[feed_index + 1] if feed_index + 1 < len(self.dates) else None
+            service_ranges, df_exceptions = trim_service_ranges(service_ranges, df_exceptions,
+                                                                self.dates[feed_index], next_date)
+        return build_shape_variant_ranges(valid_routes, service_ranges, df_exceptions, False)
+
+    # Route versions
+
+    def _derive_versions(self, latest: pd.DataFrame, route_versions_df: pd.DataFrame) -> tuple:
+        """
+        Derive the version chains of the keys the feed has, and match the old ones to the table.
+
+        Returns:
+            Tuple of (versions DataFrame indexed by the latest_routes row each version was
+            created from, with the content, key, created/closed feeds and old_id of the
+            versions before the insertion and new_created/new_closed after it; set of the
+            keys whose chain changed)
+        """
+        position = self.position
+        service_keys = pd.concat([
+            self.feed['service_ranges'][VERSION_KEY_COLUMNS], self.feed['df_exceptions'][VERSION_KEY_COLUMNS]
+        ], ignore_index=True)
+        service_keys['direction_id'] = pd.to_numeric(service_keys['direction_id'], errors='coerce').astype('Int64')
+        key_table = latest[VERSION_KEY_COLUMNS + ['key']].drop_duplicates(VERSION_KEY_COLUMNS)
+        feed_keys = set(latest.loc[latest['feed'] == position, 'key'])
+        feed_keys.update(service_keys.drop_duplicates().merge(key_table, on=VERSION_KEY_COLUMNS)['key'])
+        rows = latest[latest['key'].isin(feed_keys)]
+
+        old_versions = _chain(rows[rows['feed'] != position])
+        new_versions = _chain(rows)
+        versions = old_versions.join(new_versions[['created', 'closed', 'valid_to']].add_prefix('new_'), how='outer')
+        for col in VERSION_CONTENT_COLUMNS + ['key']:
+            versions[col] = versions[col].fillna(new_versions[col]) if col in versions else new_versions[col]
+
+        changed = (versions['created'].isna() | versions['new_created'].isna() |
+                   (versions['closed'] != versions['new_closed']))
+        changed_keys = set(versions.loc[changed, 'key'])
+
+        # Existing versions of these keys, by content
+        existing_keys = route_versions_df[VERSION_KEY_COLUMNS].astype(object).where(
+            route_versions_df[VERSION_KEY_COLUMNS].notna(), None
+        )
+        derived_keys = set(_tuples(key_table[key_table['key'].isin(feed_keys)][VERSION_KEY_COLUMNS]))
+        in_keys = np.array([key in derived_keys for key in _tuples(existing_keys)], dtype=bool)
+        existing = route_versions_df[in_keys].sort_values('version_id')
+        ids_by_content: Dict[tuple, List[int]] = {}
+        for content, version_id in zip(_tuples(existing[VERSION_CONTENT_COLUMNS]),
+                                       existing['version_id'].astype('int64')):
+            ids_by_content.setdefault(content, []).append(int(version_id))
+
+        old = old_versions.sort_values(['created'], kind='stable')
+        old_ids = []
+        for content in _tuples(old[VERSION_CONTENT_COLUMNS]):
+            candidates = ids_by_content.get(content)
+            old_ids.append(candidates.pop(0) if candidates else None)
+        unmatched = sum(version_id is None for version_id in old_ids) + sum(map(len, ids_by_content.values()))
+        if unmatched:
+            raise ValueError(f"{unmatched} route version(s) do not match the route patterns of the merged "
+                             f"feeds (built with fix_overlaps, or from feeds that are no longer available); "
+                             f"rebuild the processed data with BulkRebuilder instead")
+        versions['old_id'] = pd.Series(old_ids, index=old.index, dtype='Int64')
+        return versions, changed_keys
+
+    def _plan_key(self, key: int, key_versions: pd.DataFrame) -> dict:
+        """
+        Attribute a key's merged feeds to its versions before and after the insertion.
+
+        Returns:
+            Dictionary with the key, moves (for each old version, the new version
+            each of its feed ranges belongs to now) and fresh feed ranges of new
+            versions that no old version had
+        """
+        position = self.position
+        count = len(self.dates)
+        olds = key_versions[key_versions['created'].notna()].sort_values('created', kind='stable')
+        news = key_versions[key_versions['new_created'].notna()].sort_values('new_created', kind='stable')
+        old_spans = [(row, int(created), int(min(closed, count)))
+                     for row, created, closed in zip(olds.index, olds['created'], olds['closed'])]
+        new_spans = [(row, int(created), int(min(closed, count)))
+                     for row, created, closed in zip(news.index, news['new_created'], news['new_closed'])]
+
+        moves = []
+        for old_row, old_lo, old_hi in old_spans:
+            parts = []
+            covered = old_lo
+            for new_row, new_lo, new_hi in new_spans:
+                lo, hi = max(old_lo, new_lo), min(old_hi, new_hi)
+                if lo >= hi:
+                    continue
+                if covered < lo:
+                    parts.append((None, covered, lo))
+                parts.append((new_row, lo, hi))
+                covered = hi
+            if covered < old_hi:
+                parts.append((None, covered, old_hi))
+            # The inserted feed was no old version's feed
+            parts = [(new_row, lo, hi) for new_row, lo, hi in parts if hi - lo > (1 if lo <= position < hi else 0)]
+            moves.append({'old': old_row, 'parts': parts})
+
+        first_old = min((lo for _, lo, _ in old_spans), default=count)
+        fresh = [(new_row, new_lo, min(new_hi, first_old)) for new_row, new_lo, new_hi in new_spans
+                 if new_lo < first_old]
+        return {'key': key, 'moves': moves, 'fresh': fresh}
+
+    def _assign_version_ids(self, versions: pd.DataFrame, plans: List[dict],
+                            route_versions_df: pd.DataFrame) -> None:
+        """
+        Give each version after the insertion its id.
+
+        A version created from the same row as before keeps its id; otherwise it
+        takes the id of an old version all of whose feeds are now its own, or
+        gets a new id.
+        """
+        is_new_version = versions['new_created'].notna()
+        versions['new_id'] = versions['old_id'].where(is_new_version)
+        versions['row_kept'] = versions['old_id'].notna() & is_new_version
+        used = set(versions.loc[versions['row_kept'], 'old_id'].astype('int64'))
+
+        for plan in plans:
+            for move in plan['moves']:
+                targets = {new_row for new_row, _, _ in move['parts']}
+                old_id = int(versions.at[move['old'], 'old_id'])
+                if len(targets) == 1 and None not in targets and old_id not in used:
+                    (new_row,) = targets
+                    if pd.isna(versions.at[new_row, 'new_id']):
+                        versions.at[new_row, 'new_id'] = old_id
+                        used.add(old_id)
+
+        missing = versions[is_new_version & versions['new_id'].isna()].sort_values('new_created', kind='stable')
+        next_id = int(route_versions_df['version_id'].max()) + 1 if not route_versions_df.empty else None
+        if next_id is None:
+            next_id = Config.START_VERSION_ID
+        versions.loc[missing.index, 'new_id'] = range(next_id, next_id + len(missing))
+
+        for plan in plans:
+            for move in plan['moves']:
+                old_id = int(versions.at[move['old'], 'old_id'])
+                move['touched'] = any(new_row is None or int(versions.at[new_row, 'new_id']) != old_id
+                                      for new_row, _, _ in move['parts'])
+
+    def _update_route_versions(self, route_versions_df: pd.DataFrame, versions: pd.DataFrame,
+                               plans: List[dict]) -> pd.DataFrame:
+        """Replace the versions of the changed keys by their chains after the insertion."""
+        changed = versions[versions['key'].isin({plan['key'] for plan in plans})]
+        after = changed[changed['new_created'].notna()]
+        old_ids = set(changed['old_id'].dropna().astype('int64'))
+        new_rows = pd.DataFrame({
+            'route_id': after['route_id'],
+            'main_shape_id': after['main_shape_id'],
+            'trip_headsign': after['trip_headsign'],
+            'direction_id': after['direction_id'],
+            'route_desc': after['route_desc'],
+            'valid_from': pd.to_datetime(after['valid_from']),
+            'valid_to': pd.to_datetime(after['new_valid_to']),
+            'parent_version_id': np.nan,
+            'note': np.nan,
+            'version_id': after['new_id'].astype('int64')
+        })
+
+        kept = route_versions_df['version_id'].isin(set(new_rows['version_id']) & old_ids)
+        updated = route_versions_df[~route_versions_df['version_id'].isin(old_ids) | kept].copy()
+        by_id = new_rows.set_index('version_id')
+        kept_positions = updated['version_id'].isin(by_id.index).to_numpy()
+        kept_ids = updated.loc[kept_positions, 'version_id'].astype('int64')
+        for col in ['main_shape_id', 'trip_headsign', 'route_desc', 'valid_from', 'valid_to']:
+            updated.loc[kept_positions, col] = by_id.loc[kept_ids, col].to_numpy()
+        added = new_rows[~new_rows['version_id'].isin(updated['version_id'])]
+        if not added.empty:
+            updated = pd.concat([updated, added.reindex(columns=updated.columns)], ignore_index=True)
+        return updated.reset_index(drop=True)
+
+    # Shape variants and activations
+
+    def _move_activations(self, versions: pd.DataFrame, touched: List[dict], activations_df: pd.DataFrame,
+                          shape_variants_df: pd.DataFrame) -> tuple:
+        """
+        Move the activations of versions whose feeds now belong to other versions.
+
+        Each activation is given to the version whose feeds' service horizons
+        contain its date. Activations several versions' feeds can account for,
+        and those of feeds whose version has another main shape (is_main changes),
+        are left to be rebuilt from those feeds.
+
+        Returns:
+            Tuple of (moved activations with their new shape_variant_id, dictionary
+            of feed index -> [(version row, (first day, last day))] to rebuild)
+        """
+        variants = shape_variants_df.set_index('shape_variant_id')
+        days = _to_days(activations_df['date'])
+        variant_versions = variants.loc[activations_df['shape_variant_id'], 'version_id'].to_numpy()
+
+        moved = []
+        recompute: Dict[int, list] = {}
+        for move in touched:
+            old_id = versions.at[move['old'], 'old_id']
+            in_version = variant_versions == old_id
+            if not in_version.any():
+                continue
+            version_days = days[in_version]
+            parts = move['parts']
+            candidates = np.zeros((len(version_days), len(parts)), dtype=bool)
+            for j, (new_row, lo, hi) in enumerate(parts):
+                hull_lo, hull_hi = self.old_lo[lo:hi].min(), self.old_hi[lo:hi].max()
+                candidates[:, j] = (version_days >= hull_lo) & (version_days <= hull_hi)
+
+            count = candidates.sum(axis=1)
+            part = candidates.argmax(axis=1)
+            rows = activations_df[in_version]
+            ambiguous = count > 1
+            for j, (new_row, lo, hi) in enumerate(parts):
+                mine = (count == 1) & (part == j)
+                if new_row is None or not mine.any():
+                    continue
+                same_main = _same(versions.at[move['old'], 'main_shape_id'], versions.at[new_row, 'main_shape_id'])
+                if not same_main:
+                    ambiguous |= mine
+                    continue
+                target = rows[mine].assign(version_id=int(versions.at[new_row, 'new_id']))
+                moved.append(target)
+
+            if ambiguous.any():
+                zone = (int(version_days[ambiguous].min()), int(version_days[ambiguous].max()))
+                for new_row, lo, hi in parts:
+                    if new_row is None:
+                        continue
+                    feed_indexes = np.arange(lo, hi)
+                    reaches = (self.new_lo[lo:hi] <= zone[1]) & (self.new_hi[lo:hi] >= zone[0])
+                    for feed_index in feed_indexes[reaches]:
+                        if feed_index != self.position:
+                            recompute.setdefault(int(feed_index), []).append((new_row, zone))
+
+        if not moved:
+            return pd.DataFrame(columns=['date', 'shape_variant_id', 'exception_type']), recompute
+        moved = pd.concat(moved, ignore_index=True)
+        keys = variants.loc[moved['shape_variant_id'], ['shape_id', 'trip_headsign', 'is_main']].reset_index(drop=True)
+        keys.insert(0, 'version_id', moved['version_id'].to_numpy())
+        moved_keys = keys.drop_duplicates()
+        ids, _ = self._assign_keys(moved_keys)
+        groups = keys.groupby(VARIANT_KEY_COLUMNS, sort=False, dropna=False).ngroup().to_numpy()
+        moved = moved[['date', 'exception_type']].assign(shape_variant_id=ids[groups])
+        return moved[['date', 'shape_variant_id', 'exception_type']], recompute
+
+    def _recompute(self, versions: pd.DataFrame, recompute: Dict[int, list], show_progress: bool) -> pd.DataFrame:
+        """
+        Rebuild activations from the feeds that can account for them.
+
+        Args:
+            versions: Versions from _derive_versions, with their final ids
+            recompute: Dictionary of feed index -> [(version row, (first day, last day)
+                       or None for all dates)] to rebuild
+
+        Returns:
+            DataFrame with the rebuilt activations
+        """
+        if not recompute:
+            return pd.DataFrame(columns=['date', 'shape_variant_id', 'exception_type'])
+        if show_progress:
+            print(f"Rebuilding activations from {len(recompute)} feed(s) around {self.dates[self.position]}...")
+
+        rebuilt = []
+        for feed_index in sorted(recompute):
+            requests = recompute[feed_index]
+            rows = list(dict.fromkeys(new_row for new_row, _ in requests))
+            feed_variant_data = self._shape_variant_data(self._load_feed(feed_index), feed_index, versions.loc[rows])
+            if feed_variant_data.empty:
+                continue
+            feed_variant_data = self._assign_variant_ids(feed_variant_data)
+            activations = expand_variant_activations(feed_variant_data)
+            variant_versions = feed_variant_data.drop_duplicates('shape_variant_id').set_index(
+                'shape_variant_id')['version_id']
+            activation_versions = variant_versions.loc[activations['shape_variant_id']].to_numpy()
+            days = _to_days(activations['date'])
+
+            keep = np.zeros(len(activations), dtype=bool)
+            for new_row, zone in requests:
+                in_version = activation_versions == int(versions.at[new_row, 'new_id'])
+                if zone is None:
+                    keep |= in_version
+                else:
+                    keep |= in_version & (days >= zone[0]) & (days <= zone[1])
+            rebuilt.append(activations[keep])
+
+        if not rebuilt:
+            return pd.DataFrame(columns=['date', 'shape_variant_id', 'exception_type'])
+        return pd.concat(rebuilt, ignore_index=True)
+
+    def _assign_variant_ids(self, shape_variant_data: pd.DataFrame) -> pd.DataFrame:
+        """Add the shape_variant_id of each row's variant key, allocating ids to new keys."""
+        groups = shape_variant_data.groupby(VARIANT_KEY_COLUMNS, sort=False, dropna=False).ngroup().to_numpy()
+        ids, _ = self._assign_keys(shape_variant_data[VARIANT_KEY_COLUMNS].drop_duplicates())
+        return shape_variant_data.assign(shape_variant_id=ids[groups])
+
+    def _assign_keys(self, keys: pd.DataFrame) -> tuple:
+        """Ids of distinct variant keys (in order of first appearance); new ones are remembered."""
+        keys = keys.reset_index(drop=True)
+        ids, is_new = self.variant_index.assign(keys)
+        if is_new.any():
+            new_variants = keys[is_new].copy()
+            new_variants.insert(0, 'shape_variant_id', ids[is_new])
+            new_variants['note'] = None
+            self.new_variants.append(new_variants)
+        return ids, is_new
+
+    def _update_shape_variants(self, shape_variants_df: pd.DataFrame, activations_df: pd.DataFrame,
+                               updated_activations_df: pd.DataFrame,
+                               updated_route_versions_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Keep the variants that still exist and add the new ones.
+
+        Every variant a feed has gets activations, so a variant whose
+        activations were all moved or trimmed away no longer exists.
+        """
+        before_ids = set(activations_df['shape_variant_id'].unique().tolist())
+        after_ids = set(updated_activations_df['shape_variant_id'].unique().tolist())
+        variant_ids = shape_variants_df['shape_variant_id']
+        still_exists = (variant_ids.isin(after_ids) |
+                        (~variant_ids.isin(before_ids) &
+                         shape_variants_df['version_id'].isin(updated_route_versions_df['version_id'])))
+        updated = shape_variants_df[still_exists]
+
+        if self.new_variants:
+            added = pd.concat(self.new_variants, ignore_index=True)
+            added = added[added['shape_variant_id'].isin(after_ids)]
+            updated = pd.concat([updated, added[updated.columns]], ignore_index=True)
+        return updated.reset_index(drop=True)
+
+    # Routes and shapes
+
+    def _update_routes(self, routes_df: pd.DataFrame, latest: pd.DataFrame) -> pd.DataFrame:
+        """Take the rows of the routes whose first feed is now the inserted one from it."""
+        latest_routes_df = self.feed['latest_routes']
+        earlier = latest[(latest['feed'] < self.position) & latest['route_id'].notna()]
+        first_here = ~latest_routes_df['route_id'].isin(set(earlier['route_id']))
+        replaced = set(latest_routes_df.loc[first_here, 'route_id'].dropna())
+        rows = latest_routes_df.loc[first_here, list(PROCESSED_TABLE_DTYPES['routes'])]
+        updated = routes_df[~routes_df['route_id'].isin(replaced)]
+        if rows.empty:
+            return updated.reset_index(drop=True)
+        return pd.concat([updated, rows.reindex(columns=routes_df.columns)], ignore_index=True)
+
+    def _update_shapes(self, feed_variant_data: pd.DataFrame, show_progress: bool) -> Optional[pd.DataFrame]:
+        """Add the shapes of the inserted feed's variants that are missing; None if none is."""
+        if feed_variant_data.empty:
+            return None
+        shape_ids = set(self.dataset.table('shapes', columns=['shape_id'])['shape_id'])
+        missing = sorted(set(feed_variant_data['shape_id'].dropna()) - shape_ids)
+        if not missing:
+            return None
+        shapes_txt = read_gtfs_shapes(self.dates[self.position], missing, self.inserter.raw_data_folder)
+        return update_shapes_from_variants(self.dataset.shapes, feed_variant_data, shapes_txt, show_progress)
+
+
+def _chain(rows: pd.DataFrame) -> pd.DataFrame:
+    """Version chains of the given route pattern rows, indexed by the row each version was created from."""
+    if rows.empty:
+        return pd.DataFrame(columns=VERSION_CONTENT_COLUMNS + ['key', 'created', 'closed'])
+    route_versions_df, version_feeds = build_route_versions(rows)
+    chain = route_versions_df[VERSION_CONTENT_COLUMNS].copy()
+    chain['created'] = version_feeds['created'].to_numpy()
+    chain['closed'] = version_feeds['closed'].to_numpy()
+    chain.index = version_feeds['row'].to_numpy()
+    chain['key'] = rows.loc[chain.index, 'key'].to_numpy()
+    return chain
+
+
+def _tuples(df: pd.DataFrame) -> List[tuple]:
+    """Hashable rows with None for missing values, ints for direction_id and Timestamps for dates."""
+    columns = []
+    for col in df.columns:
+        values = df[col].astype(object)
+        if col == 'direction_id':
+            columns.append([None if pd.isna(value) else int(value) for value in values])
+        elif col in ('valid_from', 'valid_to'):
+            columns.append([None if pd.isna(value) else pd.Timestamp(value) for value in values])
+        else:
+            columns.append([None if pd.isna(value) else value for value in values])
+    return list(zip(*columns))
+
+
+def _same(a, b) -> bool:
+    """Equality treating two missing values as equal."""
+    return (pd.isna(a) and pd.isna(b)) or (not pd.isna(a) and not pd.isna(b) and a == b)
+
+
+def _to_days(dates: pd.Series) -> np.ndarray:
+    """Day numbers (since 1970-01-01) of YYYY-MM-DD dates."""
+    return pd.to_datetime(dates).to_numpy(dtype='datetime64[D]').astype('int64')
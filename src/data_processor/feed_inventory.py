@@ -0,0 +1,348 @@
+"""
+Persistent inventory of the raw GTFS feeds.
+
+Records every feed in the raw data folder (date, path, size, mtime) together
+with per-file metadata from the zip's central directory (CRC-32, sizes) or
+the feed folder's files (sizes, mtimes). Row counts of the GTFS files need
+the files decompressed, so they are only counted when asked for (see
+row_count). The inventory is refreshed incrementally: the folder is only
+rescanned when its modification time changes, and only new or modified
+feeds are re-read. list_feed_dates lists the feeds without reading or
+saving anything.
+"""
+import os
+import json
+import zipfile
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .config import Config
+
+
+class FeedInventory:
+    """Cached listing of the raw feeds and their metadata."""
+
+    def __init__(self, raw_data_folder: Optional[str] = None, data_folder: Optional[str] = None):
+        """
+        Initialize the inventory and load its saved state.
+
+        Args:
+            raw_data_folder: Path to raw data folder. If None, uses auto-detected path.
+            data_folder: Processed data folder the inventory file is stored in.
+                         If None, uses auto-detected path.
+        """
+        if raw_data_folder is None:
+            raw_data_folder = Config.get_default_raw_data_folder()
+        if data_folder is None:
+            data_folder = Config.get_default_processed_data_folder()
+
+        self.raw_data_folder = raw_data_folder
+        self.inventory_file = os.path.join(data_folder, Config.FEED_INVENTORY_FILE)
+        self.folder_mtime_ns: Optional[int] = None
+        self.feeds: Dict[str, Dict] = {}
+        self._sorted_dates: Optional[List[str]] = None
+        self._load()
+
+    def _load(self) -> None:
+        """Load the saved inventory if it describes the same raw folder."""
+        if not os.path.exists(self.inventory_file):
+            return
+
+        try:
+            with open(self.inventory_file, 'r') as f:
+                saved = json.load(f)
+            if saved.get('raw_data_folder') == os.path.abspath(self.raw_data_folder):
+                self.folder_mtime_ns = saved['folder_mtime_ns']
+                self.feeds = saved['feeds']
+        except (json.JSONDecodeError, KeyError, IOError):
+            print("Warning: Could not read feed inventory file. Rebuilding it.")
+
+    def save(self) -> None:
+        """Save the inventory next to the processed data."""
+        os.makedirs(os.path.dirname(self.inventory_file), exist_ok=True)
+        data = {
+            'raw_data_folder': os.path.abspath(self.raw_data_folder),
+            'folder_mtime_ns': self.folder_mtime_ns,
+            'feeds': self.feeds
+        }
+
+        temp_path = self.inventory_file + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.inventory_file)
+        except IOError as e:
+            print(f"Warning: Could not save feed inventory: {e}")
+
+    def refresh(self, force: bool = False) -> Dict[str, List[str]]:
+        """
+        Bring the inventory up to date with the raw folder.
+
+        Args:
+            force: Stat every feed even if the folder's modification time is unchanged
+                   (catches feeds overwritten in place).
+
+        Returns:
+            Dictionary with 'added', 'changed' and 'removed' date lists
+        """
+        changes = {'added': [], 'changed': [], 'removed': []}
+        if not os.path.exists(self.raw_data_folder):
+            if self.feeds:
+                changes['removed'] = sorted(self.feeds)
+                self.feeds = {}
+                self._sorted_dates = None
+                self.folder_mtime_ns = None
+                self.save()
+            return changes
+
+        folder_mtime_ns = os.stat(self.raw_data_folder).st_mtime_ns
+        if not force and folder_mtime_ns == self.folder_mtime_ns:
+            # Unreadable feeds may be downloads still being written in place
+            self._recheck_failed(changes)
+            return changes
+
+        found = _scan_folder(self.raw_data_folder)
+        for date in sorted(set(self.feeds) - set(found)):
+            del self.feeds[date]
+            changes['removed'].append(date)
+
+        for date, (name, stat) in sorted(found.items()):
+            entry = self.feeds.get(date)
+            if (entry is not None and entry['name'] == name and
+                    entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns):
+                continue
+            changes['added' if entry is None else 'changed'].append(date)
+            self.feeds[date] = self._read_feed(name, stat)
+
+        self.folder_mtime_ns = folder_mtime_ns
+        self._sorted_dates = None
+        self.save()
+        return changes
+
+    def refresh_feed(self, date: str) -> bool:
+        """
+        Re-read one feed's metadata if its files changed since it was inventoried.
+
+        A feed overwritten in place, or a file of a feed folder rewritten, does
+        not change the raw folder's modification time, so refresh misses it.
+        This stats the feed's zip, or every file of its folder.
+
+        Args:
+            date: Date of the feed
+
+        Returns:
+            True if the feed's metadata was re-read
+        """
+        entry = self.feeds.get(date)
+        if entry is None:
+            return False
+
+        path = os.path.join(self.raw_data_folder, entry['name'])
+        try:
+            stat = os.stat(path)
+            if entry['kind'] == 'zip':
+                unchanged = entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+            else:
+                members = {item.name: item.stat() for item in os.scandir(path) if item.is_file()}
+                unchanged = members.keys() == entry['files'].keys() and all(
+                    entry['files'][name]['size'] == member_stat.st_size and
+                    entry['files'][name].get('mtime_ns') == member_stat.st_mtime_ns
+                    for name, member_stat in members.items()
+                )
+        except OSError:
+            return False  # Removed; the next rescan drops it
+
+        if unchanged:
+            return False
+        self.feeds[date] = self._read_feed(entry['name'], stat)
+        self.save()
+        return True
+
+    def _recheck_failed(self, changes: Dict[str, List[str]]) -> None:
+        """Re-read unreadable feeds whose file changed since they were inventoried."""
+        for date, entry in list(self.feeds.items()):
+            if entry['error'] is None:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.raw_data_folder, entry['name']))
+            except OSError:
+                continue
+            if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                self.feeds[date] = self._read_feed(entry['name'], stat)
+                changes['changed'].append(date)
+
+        if changes['changed']:
+            self.save()
+
+    def _read_feed(self, name: str, stat: os.stat_result) -> Dict:
+        """Read the metadata of one feed."""
+        path = os.path.join(self.raw_data_folder, name)
+        entry = {
+            'name': name,
+            'kind': 'zip' if name.endswith('.zip') else 'folder',
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'files': {},
+            'error': None
+        }
+
+        try:
+            if entry['kind'] == 'zip':
+                with zipfile.ZipFile(path, 'r') as zip_ref:
+                    for info in zip_ref.infolist():
+                        entry['files'][info.filename] = {
+                            'crc': info.CRC,
+                            'size': info.file_size,
+                            'compressed_size': info.compress_size,
+                            'rows': None
+                        }
+            else:
+                for item in os.scandir(path):
+                    if item.is_file():
+                        member_stat = item.stat()
+                        entry['files'][item.name] = {
+                            'crc': None,
+                            'size': member_stat.st_size,
+                            'mtime_ns': member_stat.st_mtime_ns,
+                            'compressed_size': None,
+                            'rows': None
+                        }
+        except (zipfile.BadZipFile, OSError) as e:
+            entry['error'] = str(e)
+
+        return entry
+
+    def row_count(self, date: str, filename: str) -> Optional[int]:
+        """
+        Number of data rows of one file of a feed, counted on first request.
+
+        Args:
+            date: Date of the feed
+            filename: File name within the feed (e.g. 'trips.txt')
+
+        Returns:
+            Row count, or None if the feed or file is not in the inventory
+        """
+        entry = self.feeds.get(date)
+        if entry is None or filename not in entry['files']:
+            return None
+        info = entry['files'][filename]
+        if info['rows'] is None:
+            path = os.path.join(self.raw_data_folder, entry['name'])
+            if entry['kind'] == 'zip':
+                with zipfile.ZipFile(path, 'r') as zip_ref:
+                    info['rows'] = self._count_rows(zip_ref.open(filename))
+            else:
+                info['rows'] = self._count_rows(open(os.path.join(path, filename), 'rb'))
+            self.save()
+        return info['rows']
+
+    @staticmethod
+    def _count_rows(handle) -> int:
+        """Count data rows (lines after the header) of a CSV file handle, then close it."""
+        lines = 0
+        last_byte = b'\n'
+        with handle:
+            for chunk in iter(lambda: handle.read(1 << 20), b''):
+                lines += chunk.count(b'\n')
+                last_byte = chunk[-1:]
+        if last_byte != b'\n':
+            lines += 1  # Last line without a trailing newline
+        return max(lines - 1, 0)
+
+    # Queries
+
+    def dates(self) -> List[str]:
+        """Sorted dates of all feeds, including unreadable ones (see the 'error' field)."""
+        return list(self._get_sorted_dates())
+
+    def dates_between(self, start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[str]:
+        """
+        Feed dates in an inclusive range, found by bisecting the sorted dates.
+
+        Args:
+            start_date: First date (YYYYMMDD). If None, the range starts at the first feed.
+            end_date: Last date (YYYYMMDD). If None, the range runs to the latest feed.
+
+        Returns:
+            Sorted list of feed dates in the range
+        """
+        dates = self._get_sorted_dates()
+        start = bisect_left(dates, start_date) if start_date is not None else 0
+        end = bisect_right(dates, end_date) if end_date is not None else len(dates)
+        return dates[start:end]
+
+    def _get_sorted_dates(self) -> List[str]:
+        if self._sorted_dates is None:
+            self._sorted_dates = sorted(self.feeds)
+        return self._sorted_dates
+
+    def get_feed(self, date: str) -> Optional[Dict]:
+        """Metadata of one feed, or None if it is not in the raw folder."""
+        return self.feeds.get(date)
+
+    def get_feed_path(self, date: str) -> Optional[str]:
+        """Path of a feed's folder or zip, or None if it is not in the raw folder."""
+        entry = self.feeds.get(date)
+        return os.path.join(self.raw_data_folder, entry['name']) if entry is not None else None
+
+    def content_signature(self, date: str) -> Optional[str]:
+        """
+        Signature of a feed's content built from its member CRCs and sizes.
+
+        Folders have no CRCs, so their files' modification times are used
+        instead. Two zips with the same signature have identical files, so it
+        can be used to detect re-downloaded feeds whose content changed, or to
+        skip duplicates.
+        """
+        entry = self.feeds.get(date)
+        if entry is None:
+            return None
+        return ';'.join(
+            f"{name}:{info['crc'] if info['crc'] is not None else ''}:{info['size']}"
+            + (f":{info.get('mtime_ns')}" if info['crc'] is None else '')
+            for name, info in sorted(entry['files'].items())
+        )
+
+
+def list_feed_dates(raw_data_folder: Optional[str] = None) -> List[str]:
+    """
+    Sorted feed dates of a raw data folder, from a directory listing only.
+
+    Unlike FeedInventory.refresh, no feed is opened and nothing is saved, so
+    read-only callers (e.g. the status command) stay cheap.
+
+    Args:
+        raw_data_folder: Path to raw data folder. If None, uses auto-detected path.
+
+    Returns:
+        Sorted list of feed dates (YYYYMMDD)
+    """
+    if raw_data_folder is None:
+        raw_data_folder = Config.get_default_raw_data_folder()
+    if not os.path.exists(raw_data_folder):
+        return []
+    return sorted(_scan_folder(raw_data_folder))
+
+
+def _scan_folder(raw_data_folder: str) -> Dict[str, tuple]:
+    """List feed folders and zips named YYYYMMDD. Folders win over zips, like load_gtfs_data."""
+    found = {}
+    for item in os.scandir(raw_data_folder):
+        is_dir = item.is_dir()
+        if not is_dir and not item.name.endswith('.zip'):
+            continue
+        date_name = item.name.replace('.zip', '')
+        # Validate date format (YYYYMMDD)
+        if len(date_name) != 8 or not date_name.isdigit():
+            continue
+        if date_name in found and not is_dir:
+            continue
+        try:
+            # Verify it's a valid date
+            datetime.strptime(date_name, '%Y%m%d')
+        except ValueError:
+            continue  # Skip invalid dates
+        found[date_name] = (item.name, item.stat())
+    return found
@@ -2,16 +2,20 @@
 Enhanced FlexibleDateProcessor with detailed progress control options and processing tracking.
 """
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Union
 from .pipeline import TransitDataProcessor
 from .processing_tracker import ProcessingTracker
+from .feed_inventory import FeedInventory
 
 
 class FlexibleDateProcessor:
     """Enhanced processor with flexible date input, progress control, and processing tracking."""
     
-    def __init__(self, data_folder: str = None, raw_data_folder: str = None, use_tracker: bool = True):
+    def __init__(self, data_folder: str = None, raw_data_folder: str = None, use_tracker: bool = True,
+                 storage: str = 'csv', fix_overlaps: bool = False, concurrent: bool = False,
+                 trim_horizon: bool = False, merge_shards: int = 1):
         """
         Initialize the processor with data folder.
         
@@ -19,8 +23,20 @@ class FlexibleDateProcessor:
             data_folder: Path to processed data folder. If None, auto-detects project structure.
             raw_data_folder: Path to raw data folder. If None, auto-detects project structure.
             use_tracker: Whether to use processing history tracking for smart resuming.
+            storage: Processed data backend, 'csv' or 'sqlite'.
+            fix_overlaps: Whether to repair route version overlaps after each date.
+            concurrent: Whether to overlap the steps of each date on a thread pool, load 
+                        the next date's feed while a date is merged, and save each date 
+                        in the background (see TransitDataProcessor).
+            trim_horizon: Whether each date emits activations only up to the next date 
+                          being processed, which covers the dates after it. The last 
+                          date of a run keeps its whole horizon.
+            merge_shards: Number of processes the route version and shape variant 
+                          merges are split into by route (see TransitDataProcessor).
         """
-        self.processor = TransitDataProcessor(data_folder, raw_data_folder)
+        self.processor = TransitDataProcessor(data_folder, raw_data_folder, fix_overlaps=fix_overlaps, 
+                                              storage=storage, concurrent=concurrent, 
+                                              trim_horizon=trim_horizon, merge_shards=merge_shards)
         self.data_folder = data_folder
         self.raw_data_folder = raw_data_folder
         self.use_tracker = use_tracker
@@ -42,6 +58,9 @@ class FlexibleDateProcessor:
                 - List of dates: ['20131018', '20131019']
                 - Date range dict: {'start': '20131018', 'end': '20131025'}
                 - Date range dict with days: {'start': '20131018', 'days': 7}
+                - Open-ended range dict: {'start': '20131018'} (up to the latest feed)
+                  or {} (all feeds; with smart_resume, everything since the last processed date)
+              Ranges resolve to the dates that have a feed in the raw data folder.
             save_data: Whether to save processed data
             progress: Progress display options:
                 - False or 'none': No progress output
@@ -67,8 +86,11 @@ class FlexibleDateProcessor:
         if progress not in [False, 'none']:
             print(f"Processing {len(dates_to_process)} date(s): {dates_to_process[0]} to {dates_to_process[-1]}")
         
-        # Process the dates
-        results = self._process_date_list(dates_to_process, save_data, progress, return_data)
+        # Process the dates, then stop the processor's worker pools until the next call
+        try:
+            results = self._process_date_list(dates_to_process, save_data, progress, return_data)
+        finally:
+            self.close()
         
         # Record processing session if using tracker
         if self.use_tracker and original_range:
@@ -83,7 +105,82 @@ class FlexibleDateProcessor:
             )
         
         return results
-    
+
+    def close(self) -> None:
+        """Wait for the background save and stop the worker pools (see TransitDataProcessor.close)."""
+        self.processor.close()
+
+    def __enter__(self) -> 'FlexibleDateProcessor':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def insert_dates(self, dates: Optional[List[str]] = None, save_data: bool = True,
+                     progress: Union[bool, str] = True) -> Dict[str, Dict]:
+        """
+        Merge feeds of dates before already processed dates, each at its place in the history.
+
+        Args:
+            dates: Dates to insert. If None, the unprocessed dates before the last
+                   processed date (requires the tracker).
+            save_data: Whether to save processed data
+            progress: Progress display option (see process_dates)
+
+        Returns:
+            Dictionary with processing results keyed by date
+        """
+        if self.processor.storage != 'csv':
+            raise ValueError("Inserting feeds is only supported with the csv storage")
+        if dates is None:
+            dates = self.tracker.get_dates_to_insert(raw_data_folder=self.raw_data_folder) if self.use_tracker else []
+        if not dates:
+            if progress not in [False, 'none']:
+                print("No dates need inserting.")
+            return {}
+
+        from .feed_insertion import FeedInserter
+
+        # The processor's state between dates no longer matches the files
+        self.processor.reload()
+        inserter = FeedInserter(self.data_folder, self.raw_data_folder, use_tracker=self.use_tracker,
+                                trim_horizon=self.processor.trim_horizon)
+        show_details = progress in [True, 'full']
+        results = {}
+        for date in sorted(dates):
+            if progress not in [False, 'none']:
+                print(f"Inserting {date}... ", end='\n' if show_details else '', flush=True)
+            try:
+                inserter.insert(date, save_data=save_data, show_progress=show_details)
+                results[date] = {'status': 'success', 'data': None, 'error': None}
+                if progress not in [False, 'none']:
+                    print("✓" if not show_details else f"✓ Successfully inserted {date}")
+            except Exception as e:
+                results[date] = {'status': 'failed', 'data': None, 'error': str(e)}
+                if progress not in [False, 'none']:
+                    print(f"✗ ({e})" if not show_details else f"✗ Failed to insert {date}: {e}")
+        return results
+
+    def rollback_to(self, date: str, progress: Union[bool, str] = True) -> None:
+        """
+        Roll the processed data back to how it was right after a date was merged.
+
+        Args:
+            date: Date to roll back to (see ChangeLog.rollback)
+            progress: Progress display option (see process_dates)
+        """
+        if self.processor.storage != 'csv':
+            raise ValueError("Rolling back is only supported with the csv storage")
+        from .change_log import ChangeLog
+
+        # The processor's state between dates no longer matches the files
+        self.processor.reload()
+        ChangeLog(self.data_folder).rollback(date, use_tracker=self.use_tracker,
+                                             show_progress=progress not in [False, 'none'])
+        if self.use_tracker:
+            # Pick up the rolled back dates recorded by the change log
+            self.tracker = ProcessingTracker(self.data_folder)
+
     def _parse_date_input_with_tracking(self, dates_input: Union[str, List[str], Dict[str, str]], 
                                        smart_resume: bool) -> tuple[List[str], Optional[Dict[str, str]]]:
         """Parse date input and apply smart resuming if enabled."""
@@ -110,37 +207,22 @@ class FlexibleDateProcessor:
         
         elif isinstance(dates_input, dict):
             # Date range dictionary - apply smart resuming if enabled
-            date_range = self._parse_date_range(dates_input)
-            if not date_range:
+            bounds = self._parse_date_range_bounds(dates_input)
+            if bounds is None:
                 return [], None
-            
-            # Determine original range for tracking
-            if 'start' in dates_input:
-                start_date = dates_input['start']
-                if 'end' in dates_input:
-                    end_date = dates_input['end']
-                elif 'days' in dates_input:
-                    try:
-                        start = datetime.strptime(start_date, '%Y%m%d')
-                        end = start + timedelta(days=int(dates_input['days']) - 1)
-                        end_date = end.strftime('%Y%m%d')
-                    except (ValueError, TypeError):
-                        end_date = start_date
-                else:
-                    end_date = start_date
-                
-                original_range = {'start': start_date, 'end': end_date}
+            start_date, end_date = bounds
             
             # Apply smart resuming if enabled and using tracker
-            if smart_resume and self.use_tracker and original_range:
-                dates_to_process = self.tracker.get_dates_to_process(
-                    original_range['start'], 
-                    original_range['end'], 
-                    self.raw_data_folder
-                )
-                return dates_to_process, original_range
+            if smart_resume and self.use_tracker:
+                date_range = self.tracker.get_dates_to_process(start_date, end_date, self.raw_data_folder)
             else:
-                return date_range, original_range
+                date_range = self._get_inventory().dates_between(start_date, end_date)
+            if not date_range:
+                return [], None
+            
+            # Open-ended ranges are recorded with the feed dates they resolved to
+            original_range = {'start': start_date or date_range[0], 'end': end_date or date_range[-1]}
+            return date_range, original_range
         
         else:
             print(f"Unsupported date input type: {type(dates_input)}")
@@ -175,51 +257,51 @@ class FlexibleDateProcessor:
         except ValueError:
             return False
     
-    def _parse_date_range(self, date_range: Dict[str, str]) -> List[str]:
-        """Parse date range dictionary into list of dates."""
-        if 'start' not in date_range:
-            print("Date range must contain 'start' key.")
-            return []
+    def _get_inventory(self) -> FeedInventory:
+        """Get the refreshed raw feed inventory."""
+        if self.use_tracker:
+            return self.tracker.get_inventory(self.raw_data_folder)
+        inventory = FeedInventory(self.raw_data_folder, self.data_folder)
+        inventory.refresh()
+        return inventory
+    
+    def _parse_date_range_bounds(self, date_range: Dict[str, str]) -> Optional[tuple[Optional[str], Optional[str]]]:
+        """
+        Parse a date range dictionary into inclusive (start, end) bounds.
         
-        start_date = date_range['start']
-        if not self._is_valid_date_string(start_date):
+        A missing 'start' means from the first feed; missing 'end' and 'days' 
+        means up to the latest feed. Returns None if the range is invalid.
+        """
+        start_date = date_range.get('start')
+        if start_date is not None and not self._is_valid_date_string(start_date):
             print(f"Invalid start date: {start_date}")
-            return []
-        
-        start = datetime.strptime(start_date, '%Y%m%d')
+            return None
         
         # Determine end date
+        end_date = None
         if 'end' in date_range:
             end_date = date_range['end']
             if not self._is_valid_date_string(end_date):
                 print(f"Invalid end date: {end_date}")
-                return []
-            end = datetime.strptime(end_date, '%Y%m%d')
+                return None
         
         elif 'days' in date_range:
+            if start_date is None:
+                print("Date range with 'days' must contain 'start' key.")
+                return None
             try:
                 num_days = int(date_range['days'])
-                end = start + timedelta(days=num_days - 1)
+                end = datetime.strptime(start_date, '%Y%m%d') + timedelta(days=num_days - 1)
+                end_date = end.strftime('%Y%m%d')
             except (ValueError, TypeError):
                 print(f"Invalid days value: {date_range['days']}")
-                return []
-        
-        else:
-            print("Date range must contain either 'end' or 'days' key.")
-            return []
+                return None
         
-        # Generate date list
-        if start > end:
+        if start_date is not None and end_date is not None and start_date > end_date:
             print("Start date must be before or equal to end date.")
-            return []
+            return None
         
-        dates = []
-        current = start
-        while current <= end:
-            dates.append(current.strftime('%Y%m%d'))
-            current += timedelta(days=1)
-        
-        return dates
+        return start_date, end_date
     
     def _process_date_list(self, dates: List[str], save_data: bool, 
                           progress: Union[bool, str], return_data: bool) -> Dict[str, Dict]:
@@ -233,6 +315,16 @@ class FlexibleDateProcessor:
         show_compact = progress == 'compact'
         show_summary = progress in [True, 'full', 'summary']
         
+        # Control internal processor progress based on our progress setting
+        show_internal_progress = progress in [True, 'full']
+        
+        # In concurrent mode the next date's feed is prepared while the current one is merged
+        prefetch = ThreadPoolExecutor(max_workers=1) if self.processor.concurrent else None
+        next_feed = None
+        self.processor.save_errors.clear()
+        # With trim_horizon: the last merged feed, whose activations stop at the next date
+        trimmed_feed = None
+        
         for i, date in enumerate(dates, 1):
             # Show date processing header
             if show_headers:
@@ -240,12 +332,24 @@ class FlexibleDateProcessor:
             elif show_compact:
                 print(f"Processing {date} ({i}/{total_dates})... ", end='', flush=True)
             
+            next_date = dates[i] if i < total_dates else None
             try:
-                # Control internal processor progress based on our progress setting
-                show_internal_progress = progress in [True, 'full']
-                
-                result = self.processor.process_date(date, save_data=save_data, return_data=return_data, 
-                                                   show_progress=show_internal_progress)
+                if prefetch is not None:
+                    feed_future = next_feed or prefetch.submit(
+                        self.processor.prepare_feed, date, show_internal_progress
+                    )
+                    next_feed = (prefetch.submit(self.processor.prepare_feed, next_date, show_internal_progress)
+                                 if next_date is not None else None)
+                    feed_data = feed_future.result()
+                else:
+                    if show_internal_progress:
+                        print(f"Processing transit data for date: {date}")
+                    feed_data = self.processor.prepare_feed(date, show_internal_progress)
+                result = self.processor.merge_feed(feed_data, save_data=save_data, 
+                                                   return_data=return_data, 
+                                                   show_progress=show_internal_progress,
+                                                   next_date=next_date)
+                trimmed_feed = feed_data if self.processor.trim_horizon else None
                 
                 results[date] = {
                     'status': 'success',
@@ -269,6 +373,20 @@ class FlexibleDateProcessor:
                     print(f"✗ Failed to process {date}: {e}")
                 elif show_compact:
                     print(f"✗ ({str(e)[:50]}...)" if len(str(e)) > 50 else f"✗ ({e})")
+                
+                if trimmed_feed is not None:
+                    trimmed_feed = self._extend_trimmed_feed(trimmed_feed, date, next_date, save_data,
+                                                             show_internal_progress)
+        
+        if prefetch is not None:
+            prefetch.shutdown(wait=True)
+            # Dates whose background save failed are not processed after all
+            self.processor.flush()
+            for date, error in self.processor.save_errors.items():
+                if date in results:
+                    results[date] = {'status': 'failed', 'data': None, 'error': error}
+                    if show_details:
+                        print(f"✗ Failed to save {date}: {error}")
         
         # Show summary
         if show_summary:
@@ -290,6 +408,29 @@ class FlexibleDateProcessor:
         return results
 
 
+    def _extend_trimmed_feed(self, feed_data: dict, failed_date: str, next_date: Optional[str],
+                             save_data: bool, show_progress: bool) -> Optional[dict]:
+        """
+        Extend the last merged feed's trimmed activations over a date that failed.
+
+        The feed was trimmed to the failed date, which leaves its dates to the 
+        next feed. Merging the feed again for [failed date, next date) covers 
+        them, as if the failed date had not been in the batch.
+
+        Returns:
+            The feed, still trimmed to next_date, or None if it could not be extended
+        """
+        try:
+            self.processor.merge_feed(feed_data, save_data=save_data, show_progress=show_progress,
+                                      next_date=next_date, horizon_start=failed_date)
+        except Exception as e:
+            print(f"Warning: Could not extend the activations of {feed_data['date']} over {failed_date}: {e}")
+            return None
+        if show_progress:
+            print(f"Extended the activations of {feed_data['date']} up to {next_date or 'its last date'}")
+        return feed_data
+
+
 # Enhanced convenience functions with progress and tracking control
 def process_single_date(date: str, data_folder: str = None, 
                        save_data: bool = True, return_data: bool = False,
@@ -313,7 +454,7 @@ def process_single_date(date: str, data_folder: str = None,
     return results.get(date, {})
 
 
-def process_date_range(start_date: str, end_date: str = None, days: int = None,
+def process_date_range(start_date: str = None, end_date: str = None, days: int = None,
                       data_folder: str = None, 
                       save_data: bool = True, return_data: bool = False,
                       progress: Union[bool, str] = True, use_tracker: bool = True,
@@ -322,9 +463,10 @@ def process_date_range(start_date: str, end_date: str = None, days: int = None,
     Process a range of dates with progress control and smart resuming.
     
     Args:
-        start_date: Start date in YYYYMMDD format
+        start_date: Start date in YYYYMMDD format. If None, starts at the first feed.
         end_date: End date in YYYYMMDD format (if not using days)
-        days: Number of days to process (if not using end_date)
+        days: Number of days to process (if not using end_date). 
+              Without end_date and days, processes up to the latest feed.
         data_folder: Path to processed data folder
         save_data: Whether to save results
         return_data: Whether to return the processed DataFrames
@@ -337,12 +479,11 @@ def process_date_range(start_date: str, end_date: str = None, days: int = None,
     """
     processor = FlexibleDateProcessor(data_folder, use_tracker=use_tracker)
     
+    date_spec = {} if start_date is None else {'start': start_date}
     if end_date:
-        date_spec = {'start': start_date, 'end': end_date}
+        date_spec['end'] = end_date
     elif days:
-        date_spec = {'start': start_date, 'days': days}
-    else:
-        raise ValueError("Must specify either end_date or days")
+        date_spec['days'] = days
     
     return processor.process_dates(date_spec, save_data=save_data, return_data=return_data, 
                                  progress=progress, smart_resume=smart_resume)
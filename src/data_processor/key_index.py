@@ -0,0 +1,250 @@
+"""
+Persistent key index for processed transit data.
+
+Keeps the sets of known shape_ids and route_ids and the keys of the active
+route versions, so that per-date validations only look at the rows that
+changed instead of rescanning the full history.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .config import Config
+
+# Route version columns the index is derived from
+VERSION_KEY_COLUMNS = ['version_id', 'route_id', 'direction_id', 'main_shape_id', 'trip_headsign', 'valid_to']
+
+
+def content_hash(df: pd.DataFrame, columns: List[str]) -> int:
+    """
+    Order-independent hash of the values in the given columns.
+
+    Numeric columns are hashed as floats and the others as strings, so a table
+    hashes the same whether it was read from the files or built in memory.
+
+    Args:
+        df: DataFrame to hash
+        columns: Columns whose values are hashed
+
+    Returns:
+        Sum of the row hashes, modulo 2**64
+    """
+    if df.empty:
+        return 0
+    normalized = pd.DataFrame({
+        column: (df[column].to_numpy(dtype='float64', na_value=np.nan)
+                 if pd.api.types.is_numeric_dtype(df[column]) else df[column].astype('string'))
+        for column in columns
+    })
+    return int(pd.util.hash_pandas_object(normalized, index=False).sum())
+
+
+class ProcessedKeyIndex:
+    """Key sets for the processed tables, maintained as the tables are updated."""
+
+    def __init__(self):
+        """Initialize an empty key index."""
+        self.shape_ids: Set[str] = set()
+        self.route_ids: Set[str] = set()
+        # (route_id, direction_id) -> {(main_shape_id, trip_headsign), ...} of active versions
+        self.active_versions: Dict[Tuple[str, int], Set[Tuple[str, str]]] = {}
+        # (route_id, direction_id) -> (main_shape_id, trip_headsign) of the last merged feed
+        self.feed_routes: Dict[Tuple[str, int], Tuple[str, str]] = {}
+        self.fingerprint: Dict[str, object] = {}
+
+    @classmethod
+    def from_tables(cls, shapes_df: pd.DataFrame, routes_df: pd.DataFrame,
+                    route_versions_df: pd.DataFrame) -> 'ProcessedKeyIndex':
+        """
+        Build the index with a full scan of the processed tables.
+
+        Args:
+            shapes_df: Shapes DataFrame
+            routes_df: Routes DataFrame
+            route_versions_df: Route versions DataFrame
+
+        Returns:
+            Populated ProcessedKeyIndex
+        """
+        index = cls()
+        index.add_shape_ids(shapes_df['shape_id'].dropna().unique())
+        index.add_route_ids(routes_df['route_id'].dropna().unique())
+        index.set_active_versions(route_versions_df[route_versions_df['valid_to'].isna()])
+        index.fingerprint = cls.table_fingerprint(shapes_df, routes_df, route_versions_df)
+        return index
+
+    @classmethod
+    def load(cls, shapes_df: pd.DataFrame, routes_df: pd.DataFrame, route_versions_df: pd.DataFrame,
+             data_folder: Optional[str] = None) -> 'ProcessedKeyIndex':
+        """
+        Load the saved index, or rebuild it if it does not match the given tables.
+
+        Args:
+            shapes_df: Shapes DataFrame the index must describe
+            routes_df: Routes DataFrame the index must describe
+            route_versions_df: Route versions DataFrame the index must describe
+            data_folder: Custom data folder path. If None, uses auto-detected path.
+
+        Returns:
+            ProcessedKeyIndex consistent with the given tables
+        """
+        index_path = cls.get_index_path(data_folder)
+        fingerprint = cls.table_fingerprint(shapes_df, routes_df, route_versions_df)
+
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    saved = json.load(f)
+                if saved.get('fingerprint') == fingerprint:
+                    index = cls()
+                    index.shape_ids = set(saved['shape_ids'])
+                    index.route_ids = set(saved['route_ids'])
+                    for route_id, direction_id, main_shape_id, trip_headsign in saved['active_versions']:
+                        index.active_versions.setdefault((route_id, direction_id), set()).add(
+                            (main_shape_id, trip_headsign)
+                        )
+                    for route_id, direction_id, main_shape_id, trip_headsign in saved.get('feed_routes', []):
+                        index.feed_routes[(route_id, direction_id)] = (main_shape_id, trip_headsign)
+                    index.fingerprint = fingerprint
+                    return index
+            except (json.JSONDecodeError, KeyError, ValueError, IOError):
+                print("Warning: Could not read key index file. Rebuilding it.")
+
+        return cls.from_tables(shapes_df, routes_df, route_versions_df)
+
+    def save(self, data_folder: Optional[str] = None) -> None:
+        """
+        Save the index next to the processed data files.
+
+        Args:
+            data_folder: Custom data folder path. If None, uses auto-detected path.
+        """
+        index_path = self.get_index_path(data_folder)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+
+        data = {
+            'fingerprint': self.fingerprint,
+            'shape_ids': sorted(self.shape_ids),
+            'route_ids': sorted(self.route_ids),
+            'active_versions': sorted(
+                [route_id, direction_id, main_shape_id, trip_headsign]
+                for (route_id, direction_id), keys in self.active_versions.items()
+                for main_shape_id, trip_headsign in keys
+            ),
+            'feed_routes': sorted(
+                [route_id, direction_id, main_shape_id, trip_headsign]
+                for (route_id, direction_id), (main_shape_id, trip_headsign) in self.feed_routes.items()
+            )
+        }
+        with open(index_path, 'w') as f:
+            json.dump(data, f)
+
+    @staticmethod
+    def get_index_path(data_folder: Optional[str] = None) -> str:
+        """Get the path of the key index file."""
+        if data_folder is None:
+            data_folder = Config.get_default_processed_data_folder()
+        return os.path.join(data_folder, Config.KEY_INDEX_FILE)
+
+    @staticmethod
+    def table_fingerprint(shapes_df: pd.DataFrame, routes_df: pd.DataFrame,
+                          route_versions_df: pd.DataFrame) -> Dict[str, object]:
+        """Cheap fingerprint used to detect tables changed behind the index's back."""
+        return {
+            'shapes': len(shapes_df),
+            'routes': len(routes_df),
+            'route_versions': len(route_versions_df),
+            'active_versions': int(route_versions_df['valid_to'].isna().sum()),
+            'max_version_id': int(route_versions_df['version_id'].max()) if not route_versions_df.empty else 0,
+            # Edits that keep the row counts still change the keys
+            'content': [content_hash(shapes_df, ['shape_id']), content_hash(routes_df, ['route_id']),
+                        content_hash(route_versions_df, VERSION_KEY_COLUMNS)]
+        }
+
+    def refresh_fingerprint(self, shapes_df: pd.DataFrame, routes_df: pd.DataFrame,
+                            route_versions_df: pd.DataFrame) -> None:
+        """Record that the index now describes the given tables."""
+        self.fingerprint = self.table_fingerprint(shapes_df, routes_df, route_versions_df)
+
+    # Shape ids
+
+    def missing_shape_ids(self, shape_ids: Iterable[str]) -> Set[str]:
+        """Return the given shape_ids that are not in the shapes table."""
+        return set(shape_ids) - self.shape_ids
+
+    def add_shape_ids(self, shape_ids: Iterable[str]) -> None:
+        """Register shape_ids added to the shapes table."""
+        self.shape_ids.update(shape_ids)
+
+    # Route ids
+
+    def new_route_ids(self, route_ids: Iterable[str]) -> Set[str]:
+        """Return the given route_ids that are not in the routes table."""
+        return set(route_ids) - self.route_ids
+
+    def add_route_ids(self, route_ids: Iterable[str]) -> None:
+        """Register route_ids added to the routes table."""
+        self.route_ids.update(route_ids)
+
+    # Active route version keys
+
+    def set_active_versions(self, active_versions_df: pd.DataFrame) -> None:
+        """Register active versions. Keys with missing values are skipped, as they never match."""
+        keys = active_versions_df[['route_id', 'direction_id', 'main_shape_id', 'trip_headsign']]
+        for route_id, direction_id, main_shape_id, trip_headsign in keys.itertuples(index=False):
+            if pd.isna(route_id) or pd.isna(direction_id) or pd.isna(main_shape_id) or pd.isna(trip_headsign):
+                continue
+            self.active_versions.setdefault((route_id, int(direction_id)), set()).add(
+                (main_shape_id, trip_headsign)
+            )
+
+    def close_versions(self, version_keys: pd.DataFrame) -> None:
+        """Forget the active versions of the given (route_id, direction_id) keys."""
+        for route_id, direction_id in version_keys[['route_id', 'direction_id']].itertuples(index=False):
+            if pd.notna(direction_id):
+                self.active_versions.pop((route_id, int(direction_id)), None)
+
+    def version_exists_mask(self, versions_df: pd.DataFrame) -> pd.Series:
+        """
+        Check which versions already exist among the active versions.
+
+        Rows with a missing key value never match, like version_exists.
+
+        Args:
+            versions_df: DataFrame with route_id, direction_id, main_shape_id and trip_headsign
+
+        Returns:
+            Boolean Series aligned with versions_df
+        """
+        exists = []
+        keys = versions_df[['route_id', 'direction_id', 'main_shape_id', 'trip_headsign']]
+        for route_id, direction_id, main_shape_id, trip_headsign in keys.itertuples(index=False):
+            if pd.isna(route_id) or pd.isna(direction_id) or pd.isna(main_shape_id) or pd.isna(trip_headsign):
+                exists.append(False)
+            else:
+                active = self.active_versions.get((route_id, int(direction_id)), ())
+                exists.append((main_shape_id, trip_headsign) in active)
+        return pd.Series(exists, index=versions_df.index, dtype=bool)
+
+    # Route patterns of the last merged feed
+
+    def set_feed_routes(self, latest_routes_df: pd.DataFrame) -> None:
+        """
+        Remember the feed's route patterns for diffing the next feed against.
+
+        Only patterns that are active versions are kept, so an unchanged pattern 
+        in the next feed is guaranteed to need no version change.
+
+        Args:
+            latest_routes_df: Latest routes DataFrame of the merged feed
+        """
+        self.feed_routes = {}
+        keys = latest_routes_df[['route_id', 'direction_id', 'main_shape_id', 'trip_headsign']]
+        for route_id, direction_id, main_shape_id, trip_headsign in keys.itertuples(index=False):
+            if pd.isna(route_id) or pd.isna(direction_id) or pd.isna(main_shape_id) or pd.isna(trip_headsign):
+                continue
+            key = (route_id, int(direction_id))
+            if (main_shape_id, trip_headsign) in self.active_versions.get(key, ()):
+                self.feed_routes[key] = (main_shape_id, trip_headsign)
@@ -1,38 +1,105 @@
 """
 Updated processing pipeline with proper progress control.
 """
+import os
+import hashlib
+import threading
 import pandas as pd
-from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
 
-from .data_loader import load_gtfs_data, load_processed_data
+from . import data_loader, date_utils, route_processor, shape_processor
+from .config import Config
+from .data_loader import load_gtfs_data, read_gtfs_shapes
+from .feed_inventory import FeedInventory
+from .stage_graph import Stage, StageGraph
+from .processed_dataset import ProcessedDataset
+from .sqlite_store import SQLiteProcessedStore
 from .date_utils import build_service_date_mappings
-from .route_processor import build_latest_routes, update_routes, update_route_versions
+from .route_processor import (
+    build_latest_routes, diff_latest_routes, update_routes, update_route_versions, 
+    validate_route_versions
+)
 from .shape_processor import (
-    build_service_data_without_exceptions, 
+    build_service_ranges_without_exceptions, 
     build_service_data_with_exceptions,
     build_shape_variant_data,
+    build_shape_variant_ranges,
+    expand_service_ranges,
+    trim_service_ranges,
     update_shape_variants_and_activations
 )
+from .key_index import ProcessedKeyIndex
+from .activation_encoding import EncodedActivations
+from .variant_index import ShapeVariantIndex
+from .feed_history import FeedHistory
+from .change_log import ChangeLog, changed_rows
+from .route_shards import RouteShards
 from .shapes_updater import update_shapes_from_variants, validate_shape_integrity, print_shape_summary
-from .data_saver import save_routes, save_route_versions, save_shape_variants, save_shape_variant_activations, save_shapes
+from .data_saver import save_tables_atomic, recover_interrupted_save
 
 
 class TransitDataProcessor:
     """Main class for processing transit data."""
     
-    def __init__(self, data_folder: Optional[str] = None, raw_data_folder: Optional[str] = None):
+    def __init__(self, data_folder: Optional[str] = None, raw_data_folder: Optional[str] = None,
+                 fix_overlaps: bool = False, storage: str = 'csv', cache_stages: bool = True,
+                 concurrent: bool = False, trim_horizon: bool = False, merge_shards: int = 1):
         """
         Initialize the processor.
         
         Args:
             data_folder: Custom processed data folder path. If None, uses auto-detected path.
             raw_data_folder: Custom raw data folder path. If None, uses auto-detected path.
+            fix_overlaps: Whether to repair route version date overlaps on every date.
+            storage: 'csv' for the CSV files, or 'sqlite' to keep the processed tables
+                     in an SQLite database with one transaction per date.
+            cache_stages: Whether to memoize the feed stages and shape variant data on disk
+                          (in Config.STAGE_CACHE_FOLDER), keyed by feed content and stage code.
+            concurrent: Whether to overlap independent steps of a date on a thread pool.
+                        Shapes are updated while shape variants and activations are
+                        built, and with CSV storage the processed state is kept in 
+                        memory between dates so a date's save runs in the background 
+                        while the next date is merged (see flush).
+            trim_horizon: Whether to emit a feed's activations only for the dates from 
+                          the feed's own date up to the next feed's date (see merge_feed), 
+                          instead of the feed's whole service horizon. The later feed is 
+                          then authoritative for the dates it covers.
+            merge_shards: Number of route_id hash shards the route version and shape 
+                          variant merges are split into, each run in a worker process 
+                          (see RouteShards). 1 merges the whole network in this process.
         """
+        if storage not in ('csv', 'sqlite'):
+            raise ValueError(f"Unknown storage backend: {storage}")
+        
         self.data_folder = data_folder
         self.raw_data_folder = raw_data_folder
+        self.fix_overlaps = fix_overlaps
+        self.trim_horizon = trim_horizon
+        self.storage = storage
+        self.store = SQLiteProcessedStore(data_folder=data_folder) if storage == 'sqlite' else None
+        
+        cache_folder = None
+        if cache_stages:
+            cache_folder = os.path.join(data_folder or Config.get_default_processed_data_folder(), 
+                                        Config.STAGE_CACHE_FOLDER)
+        self.stages = build_stage_graph(cache_folder)
+        self.feed_history = FeedHistory(data_folder)
+        self.change_log = ChangeLog(data_folder)
+        self._inventory = None
+        self._inventory_lock = threading.Lock()
+        
+        self.concurrent = concurrent
+        # Thread pool of concurrent mode, started on first use (see close)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.route_shards = RouteShards(merge_shards) if merge_shards > 1 else None
+        # In-memory processed state carried over to the next date (concurrent mode only)
+        self._state: Optional[dict] = None
+        self._pending_save: Optional[Tuple[str, Future]] = None
+        self.save_errors: Dict[str, str] = {}
         
     def process_date(self, date: str, save_data: bool = True, return_data: bool = False, 
-                    show_progress: bool = True) -> dict:
+                    show_progress: bool = True, next_date: Optional[str] = None) -> dict:
         """
         Process transit data for a specific date.
         
@@ -41,6 +108,7 @@ class TransitDataProcessor:
             save_data: Whether to save processed data to files
             return_data: Whether to return the processed DataFrames dictionary
             show_progress: Whether to show internal processing steps
+            next_date: Date of the next feed, if known (see merge_feed)
             
         Returns:
             Dictionary containing all processed DataFrames if return_data=True, 
@@ -49,85 +117,480 @@ class TransitDataProcessor:
         if show_progress:
             print(f"Processing transit data for date: {date}")
         
-        # Step 1: Load data
-        if show_progress:
-            print("1. Loading GTFS data...")
-        routes_txt, trips_txt, shapes_txt, calendar_txt, calendar_dates_txt = load_gtfs_data(date, self.raw_data_folder)
+        feed_data = self.prepare_feed(date, show_progress)
+        return self.merge_feed(feed_data, save_data, return_data, show_progress, next_date)
+    
+    def prepare_feed(self, date: str, show_progress: bool = True) -> dict:
+        """
+        Run the feed-only stages for a date (no processed state is read).
         
-        if show_progress:
-            print("2. Loading existing processed data...")
-        (shapes_df, routes_df, route_versions_df, shape_variants_df, 
-         shape_variant_activations_df, temporary_changes_df) = load_processed_data(self.data_folder)
+        These stages depend only on the GTFS feed itself, so they can run for
+        several feeds at once, ahead of the state-merge stages in merge_feed.
         
-        # Step 2: Build service date mappings
+        Args:
+            date: Date string (e.g., '20131018')
+            show_progress: Whether to show internal processing steps
+            
+        Returns:
+            Dictionary with the loaded GTFS tables and feed-derived DataFrames
+        """
+        # Steps 1-3: Load GTFS data, build service date mappings, latest routes and 
+        # service data. Independent stages run concurrently, cached stages are skipped.
         if show_progress:
-            print("3. Building service date mappings...")
-        trip_dates, trip_first_date = build_service_date_mappings(trips_txt, calendar_txt)
+            print("1-3. Loading GTFS data and building latest routes and service data...")
+        fingerprints = {'date': date, 'raw_data_folder': self._feed_fingerprint(date)}
+        outputs = self.stages.run(
+            ['latest_routes', 'service_ranges', 'df_exceptions'],
+            inputs={'date': date, 'raw_data_folder': self.raw_data_folder},
+            fingerprints=fingerprints, partition=date, show_progress=show_progress
+        )
         
-        # Step 3: Process routes
-        if show_progress:
-            print("4. Processing routes...")
-        latest_routes_df = build_latest_routes(trips_txt, trip_first_date, routes_txt)
-        updated_routes_df = update_routes(routes_df, latest_routes_df, show_progress)
+        return {
+            'date': date,
+            'fingerprints': fingerprints,
+            'latest_routes': outputs['latest_routes'],
+            'service_ranges': outputs['service_ranges'],
+            'df_exceptions': outputs['df_exceptions']
+        }
+    
+    def _feed_fingerprint(self, date: str) -> Optional[str]:
+        """Content signature of a date's feed from the raw feed inventory (None if unknown)."""
+        with self._inventory_lock:
+            if self._inventory is None:
+                self._inventory = FeedInventory(self.raw_data_folder, self.data_folder)
+            self._inventory.refresh()
+            # The feed's own files are stat'ed every time; rewriting them does not touch the folder
+            self._inventory.refresh_feed(date)
+            signature = self._inventory.content_signature(date)
+        return hashlib.sha256(signature.encode()).hexdigest() if signature else None
+    
+    def flush(self) -> None:
+        """
+        Wait for the background save of the last merged date (concurrent mode).
+        
+        A failed save is recorded in save_errors, and the processed state is 
+        read from the files again for the next date.
+        """
+        if self._pending_save is None:
+            return
+        date, future = self._pending_save
+        self._pending_save = None
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Warning: Saving the processed data of {date} failed: {e}")
+            self.save_errors[date] = str(e)
+            self._state = None
+
+    def close(self) -> None:
+        """
+        Wait for the background save and stop the thread pool and the shard 
+        worker processes. The processor stays usable: they are started again 
+        when the next date needs them.
+        """
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self.route_shards is not None:
+            self.route_shards.shutdown()
+
+    def __enter__(self) -> 'TransitDataProcessor':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        """The thread pool of concurrent mode, started if needed."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=2)
+        return self._executor
+
+    def reload(self) -> None:
+        """
+        Drop the processed state kept between dates (concurrent mode), so the next
+        date reads the files again, e.g. after FeedInserter changed them.
+        """
+        self.flush()
+        self._state = None
+        self.feed_history = FeedHistory(self.data_folder)
+
+    def merge_feed(self, feed_data: dict, save_data: bool = True, return_data: bool = False,
+                   show_progress: bool = True, next_date: Optional[str] = None,
+                   horizon_start: Optional[str] = None) -> dict:
+        """
+        Merge a prepared feed into the processed data.
+        
+        Feeds must be merged in date order, because route version closing and
+        activation deduplication depend on the state left by earlier feeds.
+        
+        Args:
+            feed_data: Dictionary returned by prepare_feed
+            save_data: Whether to save processed data to files
+            return_data: Whether to return the processed DataFrames dictionary
+            show_progress: Whether to show internal processing steps
+            next_date: Date of the next feed, if known. With trim_horizon, only the 
+                       activations from date up to (not including) next_date are emitted, 
+                       or from date on if next_date is None.
+            horizon_start: First date of the emitted activations with trim_horizon, instead 
+                           of the feed's date. Merging an already merged feed again from 
+                           the date it was trimmed to extends its horizon, e.g. when the 
+                           feed that was to follow it failed.
+            
+        Returns:
+            Dictionary containing all processed DataFrames if return_data=True, 
+            empty dict otherwise
+        """
+        date = feed_data['date']
+        latest_routes_df = feed_data['latest_routes']
         
-        # Step 4: Process route versions (pass show_progress parameter)
         if show_progress:
-            print("5. Processing route versions...")
-        updated_route_versions_df = update_route_versions(route_versions_df, latest_routes_df, date, show_progress)
+            print("4. Loading existing processed data...")
+        # Shapes are only read in full if the feed brings shapes that are missing from them
+        state, self._state = self._state, None
+        if state is not None:
+            # The previous date's tables, possibly still being saved in the background
+            dataset = state['dataset']
+            shape_ids_df = state['shape_ids']
+            key_index = state['key_index']
+            encoded_activations = state['encoded_activations']
+            variant_index = state['variant_index']
+        else:
+            # Never read the files while a save is replacing them, and complete
+            # one that was interrupted before reading what it saved
+            self.flush()
+            if self.store is None:
+                recover_interrupted_save(self.data_folder)
+            dataset = self.store if self.store is not None else ProcessedDataset(self.data_folder)
+            shape_ids_df = dataset.table('shapes', columns=['shape_id'])
+            key_index = encoded_activations = variant_index = None
+        routes_df = dataset.routes
+        route_versions_df = dataset.route_versions
+        shape_variants_df = dataset.shape_variants
+        shape_variant_activations_df = dataset.shape_variant_activations
+        temporary_changes_df = dataset.temporary_changes
+        if key_index is None:
+            key_index = ProcessedKeyIndex.load(shape_ids_df, routes_df, route_versions_df, self.data_folder)
+            encoded_activations = EncodedActivations.load(shape_variant_activations_df, self.data_folder)
+            variant_index = ShapeVariantIndex.load(shape_variants_df, self.data_folder)
         
-        # Step 6: Process shape variants
+        # Step 5: Process routes
         if show_progress:
-            print("6. Processing shape variants...")
-        df_noexceptions = build_service_data_without_exceptions(trip_dates, trips_txt)
-        df_exceptions = build_service_data_with_exceptions(calendar_dates_txt, trips_txt)
-        shape_variant_data = build_shape_variant_data(updated_route_versions_df, df_noexceptions, df_exceptions, show_progress)
+            print("5. Processing routes...")
+        updated_routes_df = update_routes(routes_df, latest_routes_df, show_progress, key_index=key_index)
         
-        updated_shape_variants_df, updated_shape_variant_activations_df = update_shape_variants_and_activations(
-            shape_variant_data, shape_variants_df, shape_variant_activations_df, show_progress
+        # Step 6: Process route versions (pass show_progress parameter)
+        if show_progress:
+            print("6. Processing route versions...")
+        # Only patterns that differ from the previous feed can need a new version
+        changed_routes_df, route_diff_df = diff_latest_routes(
+            latest_routes_df, key_index.feed_routes, show_progress
         )
+        updated_route_versions_df, route_version_changes_df = update_route_versions(
+            route_versions_df, changed_routes_df, date, show_progress, 
+            return_changes=True, fix_overlaps=self.fix_overlaps, key_index=key_index,
+            shards=self.route_shards
+        )
+        key_index.set_feed_routes(latest_routes_df)
+        version_issues = validate_route_versions(updated_route_versions_df, show_details=False)
+        if not version_issues['is_valid'] and show_progress:
+            print(f"Warning: route versions have {len(version_issues['invalid_date_ranges'])} invalid range(s), "
+                  f"{len(version_issues['overlapping_versions'])} overlap(s) and "
+                  f"{len(version_issues['duplicate_active_versions'])} duplicate active version(s).")
         
-        # Step 7: Update shapes_df with any missing shapes
+        # Step 7: Process shape variants
         if show_progress:
-            print("7. Updating shapes data...")
-            print_shape_summary(shapes_df, "Before update")
+            print("7. Processing shape variants...")
+        route_versions_hash = pd.util.hash_pandas_object(updated_route_versions_df, index=False).to_numpy()
+        horizon = (horizon_start or date, next_date) if self.trim_horizon else None
+        shape_variant_data = self.stages.run(
+            ['shape_variant_data'],
+            inputs={'route_versions': updated_route_versions_df, 'horizon': horizon, 
+                    'show_progress': show_progress},
+            fingerprints={
+                **feed_data['fingerprints'],
+                'route_versions': hashlib.sha256(route_versions_hash.tobytes()).hexdigest(),
+                'horizon': repr(horizon),
+                'show_progress': ''
+            },
+            known={'service_ranges': feed_data['service_ranges'], 'df_exceptions': feed_data['df_exceptions']},
+            partition=date
+        )['shape_variant_data']
         
-        # Validate current shape integrity
-        validation = validate_shape_integrity(shapes_df, shape_variant_data)
-        if not validation['is_valid'] and show_progress:
-            print(f"Found {validation['missing_count']} missing shape_ids that need to be added.")
+        # Step 8 (updating shapes) only needs shape_variant_data, so it can overlap step 7
+        update_shapes_args = (date, dataset, shape_ids_df, shape_variant_data, key_index, 
+                              state is not None, show_progress)
+        shapes_future = (self._pool().submit(self._update_shapes, *update_shapes_args) 
+                         if self.concurrent else None)
         
-        # Update shapes_df with missing shapes
-        updated_shapes_df = update_shapes_from_variants(shapes_df, shape_variant_data, shapes_txt, show_progress)
-        if show_progress:
-            print_shape_summary(updated_shapes_df, "After update")
+        (updated_shape_variants_df, updated_shape_variant_activations_df, 
+         new_activations_df) = update_shape_variants_and_activations(
+            shape_variant_data, shape_variants_df, shape_variant_activations_df, show_progress, return_new=True,
+            encoded_activations=encoded_activations, variant_index=variant_index,
+            shards=self.route_shards
+        )
+        
+        if shapes_future is not None:
+            validation, updated_shapes_df = shapes_future.result()
+        else:
+            validation, updated_shapes_df = self._update_shapes(*update_shapes_args)
+        shapes_changed = updated_shapes_df is not None
         
-        # Step 8: Save data if requested
+        # Step 9: Save data if requested
         if save_data:
             if show_progress:
-                print("8. Saving processed data...")
-            save_shapes(updated_shapes_df, self.data_folder, show_progress)
-            save_routes(updated_routes_df, self.data_folder, show_progress)
-            save_route_versions(updated_route_versions_df, self.data_folder, show_progress)
-            save_shape_variants(updated_shape_variants_df, self.data_folder, show_progress)
-            save_shape_variant_activations(updated_shape_variant_activations_df, self.data_folder, show_progress)
+                print("9. Saving processed data...")
+            if self.store is not None:
+                # Only the new and changed rows, all in one transaction
+                self.store.commit_date(date, {
+                    'shapes': (updated_shapes_df[updated_shapes_df['shape_id'].isin(validation['missing_shape_ids'])]
+                               if shapes_changed else None),
+                    'routes': updated_routes_df.iloc[len(routes_df):],
+                    'route_versions': _changed_route_versions(route_versions_df, updated_route_versions_df),
+                    'shape_variants': updated_shape_variants_df.iloc[len(shape_variants_df):],
+                    'shape_variant_activations': new_activations_df
+                })
+                if show_progress:
+                    print(f"Changes for {date} committed to {self.store.db_path}")
+            else:
+                # How to undo the save: the other tables are only appended to
+                added_rows = {'shape_variant_activations': new_activations_df}
+                row_counts = {
+                    'routes': len(routes_df),
+                    'route_versions': len(route_versions_df),
+                    'shape_variants': len(shape_variants_df),
+                    'shape_variant_activations': len(shape_variant_activations_df)
+                }
+                if shapes_changed:
+                    row_counts['shapes'] = len(shape_ids_df)
+                    added_rows['shapes'] = pd.DataFrame({'shape_id': sorted(validation['missing_shape_ids'])})
+                undo = {
+                    'date': date,
+                    'row_counts': row_counts,
+                    'changed_rows': {'route_versions': changed_rows(route_versions_df, updated_route_versions_df)},
+                    'added_rows': added_rows
+                }
+                tables_to_save = {
+                    'routes': updated_routes_df,
+                    'route_versions': updated_route_versions_df,
+                    'shape_variants': updated_shape_variants_df,
+                    'shape_variant_activations': updated_shape_variant_activations_df
+                }
+                if shapes_changed:
+                    tables_to_save['shapes'] = updated_shapes_df
+                
+                # Saves are committed in date order
+                self.flush()
+                if state is not None and state['date'] in self.save_errors:
+                    raise RuntimeError(f"Processed data of {state['date']} could not be saved, "
+                                       f"so {date} was not saved either")
+                if self.concurrent:
+                    self._pending_save = (date, self._pool().submit(
+                        self._save_tables, dataset, tables_to_save, show_progress, undo
+                    ))
+                    for name, df in tables_to_save.items():
+                        dataset.set_table(name, df)
+                    self._state = {
+                        'date': date,
+                        'dataset': dataset,
+                        'shape_ids': updated_shapes_df[['shape_id']] if shapes_changed else shape_ids_df,
+                        'key_index': key_index,
+                        'encoded_activations': encoded_activations,
+                        'variant_index': variant_index
+                    }
+                else:
+                    self._save_tables(dataset, tables_to_save, show_progress, undo)
+            
+            key_index.refresh_fingerprint(
+                updated_shapes_df if shapes_changed else shape_ids_df, 
+                updated_routes_df, updated_route_versions_df
+            )
+            key_index.save(self.data_folder)
+            encoded_activations.refresh_fingerprint(updated_shape_variant_activations_df)
+            encoded_activations.save(self.data_folder)
+            variant_index.refresh_fingerprint(updated_shape_variants_df)
+            variant_index.save(self.data_folder)
+            self.feed_history.record(feed_data)
             if show_progress:
                 print("Processing completed successfully!")
         
         # Return all processed data if requested
         if return_data:
+            service_ranges_df, df_exceptions = feed_data['service_ranges'], feed_data['df_exceptions']
+            if horizon is not None:
+                service_ranges_df, df_exceptions = trim_service_ranges(service_ranges_df, df_exceptions, *horizon)
+            if not shapes_changed and self._pending_save is not None:
+                # Reading shapes from the files must not race the background save
+                self.flush()
             return {
-                'shapes': updated_shapes_df,
+                'shapes': updated_shapes_df if shapes_changed else dataset.shapes,
                 'routes': updated_routes_df,
                 'route_versions': updated_route_versions_df,
                 'shape_variants': updated_shape_variants_df,
                 'shape_variant_activations': updated_shape_variant_activations_df,
                 'temporary_changes': temporary_changes_df,
                 'latest_routes': latest_routes_df,
-                'shape_variant_data': shape_variant_data
+                'route_version_changes': route_version_changes_df,
+                'route_diff': route_diff_df,
+                # Per-day rows, as build_shape_variant_data gives them
+                'shape_variant_data': build_shape_variant_data(
+                    updated_route_versions_df, expand_service_ranges(service_ranges_df),
+                    df_exceptions, show_progress=False
+                )
             }
         else:
             return {}
 
+    
+    def _update_shapes(self, date: str, dataset, shape_ids_df: pd.DataFrame, shape_variant_data: pd.DataFrame,
+                       key_index: ProcessedKeyIndex, wait_for_save: bool, 
+                       show_progress: bool) -> Tuple[dict, Optional[pd.DataFrame]]:
+        """
+        Step 8: Add the shapes used by the shape variants that are missing from the shapes table.
+        
+        Returns:
+            Tuple of (validation result, updated shapes DataFrame or None if unchanged)
+        """
+        if show_progress:
+            print("8. Updating shapes data...")
+            print_shape_summary(shape_ids_df, "Before update")
+        
+        # Validate current shape integrity
+        validation = validate_shape_integrity(shape_ids_df, shape_variant_data, key_index)
+        if not validation['is_valid'] and show_progress:
+            print(f"Found {validation['missing_count']} missing shape_ids that need to be added.")
+        
+        # Update shapes_df with missing shapes
+        updated_shapes_df = None
+        if validation['is_valid']:
+            if show_progress:
+                print("All shape_ids from shape variants already exist in shapes_df.")
+        else:
+            if wait_for_save and not dataset.is_loaded('shapes'):
+                self.flush()
+            shapes_df = dataset.shapes
+            shapes_txt = read_gtfs_shapes(date, validation['missing_shape_ids'], self.raw_data_folder)
+            updated_shapes_df = update_shapes_from_variants(
+                shapes_df, shape_variant_data, shapes_txt, show_progress, key_index
+            )
+            if updated_shapes_df is shapes_df:
+                updated_shapes_df = None
+        if show_progress:
+            print_shape_summary(updated_shapes_df if updated_shapes_df is not None else shape_ids_df, 
+                                "After update")
+        
+        return validation, updated_shapes_df
+    
+    def _save_tables(self, dataset: ProcessedDataset, tables: Dict[str, pd.DataFrame], 
+                     show_progress: bool, undo: Optional[dict] = None) -> None:
+        """
+        Save the changed CSV tables and keep the memory-mapped copies in step with them.
+        
+        undo holds the arguments of ChangeLog.record besides the generation, 
+        which is logged once the save is committed.
+        """
+        generation = save_tables_atomic(tables, self.data_folder, show_progress)
+        dataset.mark_saved(generation)
+        if undo is not None:
+            self.change_log.record(generation, **undo)
+        
+        if 'shapes' in tables:
+            dataset.write_columnar('shapes', tables['shapes'])
+        dataset.write_columnar('shape_variant_activations', tables['shape_variant_activations'])
+
+
+def build_stage_graph(cache_folder: Optional[str] = None) -> StageGraph:
+    """
+    Build the graph of the memoizable pipeline stages.
+    
+    External inputs are date and raw_data_folder (fingerprinted by the feed's 
+    content) for the feed stages, plus route_versions, horizon and show_progress 
+    for shape_variant_data.
+    
+    Args:
+        cache_folder: Folder for the memoized stage outputs. If None, nothing is cached.
+        
+    Returns:
+        StageGraph with the feed stages and shape_variant_data
+    """
+    return StageGraph([
+        # shapes.txt is only read in step 8, and only for shapes missing from the processed data.
+        # Stages hash the modules of their helpers: a loader change invalidates every stage
+        Stage('gtfs', _load_feed_tables, ['date', 'raw_data_folder'], cache=False,
+              code=[_load_feed_tables, data_loader]),
+        Stage('service_dates', _build_service_dates, ['gtfs'],
+              code=[_build_service_dates, date_utils]),
+        Stage('latest_routes', _build_latest_routes, ['gtfs', 'service_dates'],
+              code=[_build_latest_routes, route_processor]),
+        # Services as date ranges; per-day rows are only materialized for the activations
+        Stage('service_ranges', _build_service_ranges, ['gtfs'],
+              code=[_build_service_ranges, shape_processor]),
+        Stage('df_exceptions', _build_exceptions, ['gtfs'],
+              code=[_build_exceptions, shape_processor]),
+        Stage('shape_variant_data', _build_shape_variant_data,
+              ['route_versions', 'service_ranges', 'df_exceptions', 'horizon', 'show_progress'],
+              code=[_build_shape_variant_data, shape_processor])
+    ], cache_folder)
+
+
+def _load_feed_tables(date: str, raw_data_folder: Optional[str]) -> dict:
+    routes_txt, trips_txt, _, calendar_txt, calendar_dates_txt = load_gtfs_data(
+        date, raw_data_folder, load_shapes=False
+    )
+    return {'routes': routes_txt, 'trips': trips_txt, 'calendar': calendar_txt, 'calendar_dates': calendar_dates_txt}
+
+
+def _build_service_dates(gtfs: dict) -> tuple:
+    return build_service_date_mappings(gtfs['trips'], gtfs['calendar'])
+
+
+def _build_latest_routes(gtfs: dict, service_dates: tuple) -> pd.DataFrame:
+    return build_latest_routes(gtfs['trips'], service_dates[1], gtfs['routes'])
+
+
+def _build_service_ranges(gtfs: dict) -> pd.DataFrame:
+    return build_service_ranges_without_exceptions(gtfs['calendar'], gtfs['trips'])
+
+
+def _build_exceptions(gtfs: dict) -> pd.DataFrame:
+    return build_service_data_with_exceptions(gtfs['calendar_dates'], gtfs['trips'])
+
+
+def _build_shape_variant_data(route_versions: pd.DataFrame, service_ranges: pd.DataFrame,
+                              df_exceptions: pd.DataFrame, horizon: Optional[tuple], 
+                              show_progress: bool) -> pd.DataFrame:
+    if horizon is not None:
+        # Only [feed date, next feed date); the next feed covers the dates after it
+        service_ranges, df_exceptions = trim_service_ranges(service_ranges, df_exceptions, *horizon)
+    return build_shape_variant_ranges(route_versions, service_ranges, df_exceptions, show_progress)
+
+
+def _changed_route_versions(route_versions_df: pd.DataFrame, 
+                            updated_route_versions_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the route versions that were added or closed by update_route_versions.
+    
+    update_route_versions keeps existing versions in place and appends new ones,
+    so changed rows are found by position.
+    
+    Args:
+        route_versions_df: Route versions before the update
+        updated_route_versions_df: Route versions after the update
+        
+    Returns:
+        DataFrame with the new and changed route versions
+    """
+    existing_count = len(route_versions_df)
+    before = route_versions_df['valid_to'].reset_index(drop=True)
+    after = updated_route_versions_df['valid_to'].iloc[:existing_count].reset_index(drop=True)
+    closed = ~((before == after) | (before.isna() & after.isna()))
+    
+    return pd.concat([
+        updated_route_versions_df.iloc[:existing_count][closed.to_numpy()],
+        updated_route_versions_df.iloc[existing_count:]
+    ])
+
 
 def process_transit_data(date: str, data_folder: Optional[str] = None, raw_data_folder: Optional[str] = None,
                         save_data: bool = True, return_data: bool = False, show_progress: bool = True) -> dict:
@@ -146,5 +609,5 @@ def process_transit_data(date: str, data_folder: Optional[str] = None, raw_data_
         Dictionary containing all processed DataFrames if return_data=True, 
         empty dict otherwise
     """
-    processor = TransitDataProcessor(data_folder, raw_data_folder)
-    return processor.process_date(date, save_data, return_data, show_progress)
\ No newline at end of file
+    with TransitDataProcessor(data_folder, raw_data_folder) as processor:
+        return processor.process_date(date, save_data, return_data, show_progress)
\ No newline at end of file
@@ -0,0 +1,333 @@
+"""
+Lazily loaded handle on the processed transit data.
+
+Tables are read on first access only, and can be read with a subset of
+columns. Large tables are additionally kept as memory-mapped columnar files
+(one .npy file per column), so single-route queries only touch the columns
+and rows they need instead of parsing the full CSV. Id and headsign columns 
+of the columnar files hold codes of the folder's shared StringDictionary.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, List, Optional
+
+from .config import Config
+from .data_loader import (
+    PROCESSED_TABLES, PROCESSED_TABLE_DTYPES, get_processed_table_path,
+    read_processed_table, load_processed_data
+)
+from .data_saver import read_save_manifest
+from .string_dictionary import StringDictionary
+
+
+class ProcessedDataset:
+    """Lazy, column-projecting access to the processed tables."""
+
+    def __init__(self, data_folder: Optional[str] = None,
+                 mmap_tables: Iterable[str] = Config.MMAP_TABLES):
+        """
+        Initialize the dataset handle. No table is read here.
+
+        Args:
+            data_folder: Path to processed data folder. If None, uses auto-detected path.
+            mmap_tables: Tables served from memory-mapped columnar files.
+        """
+        if data_folder is None:
+            data_folder = Config.get_default_processed_data_folder()
+
+        self.data_folder = data_folder
+        self.mmap_tables = set(mmap_tables)
+        self._tables: Dict[str, pd.DataFrame] = {}
+        self._strings: Optional[StringDictionary] = None
+
+        # Create empty processed files on first use, like load_processed_data does
+        if not all(os.path.exists(get_processed_table_path(name, data_folder)) for name in PROCESSED_TABLES):
+            load_processed_data(data_folder)
+
+        self.generation = read_save_manifest(data_folder)['generation']
+
+    # Table access
+
+    def table(self, name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Get a processed table, reading it on first access.
+
+        Args:
+            name: Table name, one of PROCESSED_TABLES
+            columns: Columns to return. If None, returns all columns.
+
+        Returns:
+            DataFrame with the requested columns
+        """
+        if name in self._tables:
+            df = self._tables[name]
+            return df if columns is None else df[columns]
+
+        self._check_generation()
+        if name in self.mmap_tables:
+            df = self._read_columnar(name, columns)
+        else:
+            df = read_processed_table(name, self.data_folder, columns)
+
+        # Only full tables are cached; projections are cheap to re-read
+        if columns is None:
+            self._tables[name] = df
+        return df
+
+    def _check_generation(self) -> None:
+        """Drop cached tables if another save generation was committed since they were read."""
+        manifest = read_save_manifest(self.data_folder)
+        if manifest['generation'] != self.generation:
+            if self._tables:
+                print(f"Processed data changed (generation {self.generation} -> {manifest['generation']}), "
+                      f"dropping cached tables.")
+            self._tables = {}
+            self.generation = manifest['generation']
+
+    def mark_saved(self, generation: int) -> None:
+        """Record a generation saved by this process, keeping the cached tables."""
+        self.generation = generation
+
+    def is_loaded(self, name: str) -> bool:
+        """Whether the full table has already been read."""
+        return name in self._tables
+
+    def set_table(self, name: str, df: pd.DataFrame) -> None:
+        """Replace a cached table, e.g. after it was updated and saved."""
+        self._tables[name] = df
+
+    @property
+    def strings(self) -> StringDictionary:
+        """The folder's string dictionary, holding the strings of the interned columnar columns."""
+        if self._strings is None:
+            self._strings = StringDictionary(self.data_folder)
+        return self._strings
+    
+    def row_count(self, name: str) -> int:
+        """Number of rows of a table, without materializing it if possible."""
+        if name in self._tables:
+            return len(self._tables[name])
+        if name in self.mmap_tables:
+            return self._ensure_columnar(name)['rows']
+        return len(self.table(name, columns=[self._first_column(name)]))
+
+    @property
+    def shapes(self) -> pd.DataFrame:
+        """Shapes table."""
+        return self.table('shapes')
+
+    @property
+    def routes(self) -> pd.DataFrame:
+        """Routes table."""
+        return self.table('routes')
+
+    @property
+    def route_versions(self) -> pd.DataFrame:
+        """Route versions table."""
+        return self.table('route_versions')
+
+    @property
+    def shape_variants(self) -> pd.DataFrame:
+        """Shape variants table."""
+        return self.table('shape_variants')
+
+    @property
+    def shape_variant_activations(self) -> pd.DataFrame:
+        """Shape variant activations table."""
+        return self.table('shape_variant_activations')
+
+    @property
+    def temporary_changes(self) -> pd.DataFrame:
+        """Temporary changes table."""
+        return self.table('temporary_changes')
+
+    # Queries
+
+    def shape_ids(self) -> np.ndarray:
+        """All distinct shape_ids in the shapes table."""
+        if 'shapes' in self.mmap_tables and 'shapes' not in self._tables:
+            return self._load_categories('shapes', 'shape_id')
+        return self.table('shapes', columns=['shape_id'])['shape_id'].dropna().unique()
+
+    def shapes_for(self, shape_ids: Iterable[str]) -> pd.DataFrame:
+        """
+        Get the points of the given shapes only.
+
+        Args:
+            shape_ids: Shape ids to look up
+
+        Returns:
+            DataFrame with the shape points of the requested shapes
+        """
+        shape_ids = list(shape_ids)
+        if 'shapes' in self._tables or 'shapes' not in self.mmap_tables:
+            shapes_df = self.table('shapes')
+            return shapes_df[shapes_df['shape_id'].isin(shape_ids)].reset_index(drop=True)
+
+        return self._filter_columnar('shapes', 'shape_id', shape_ids)
+
+    def route(self, route_id: str) -> Dict[str, pd.DataFrame]:
+        """
+        Get all processed data of one route.
+
+        Args:
+            route_id: Route id to look up
+
+        Returns:
+            Dictionary with the route's routes, route_versions, shape_variants and shapes rows
+        """
+        routes_df = self.routes
+        route_versions_df = self.route_versions
+        shape_variants_df = self.shape_variants
+
+        versions = route_versions_df[route_versions_df['route_id'] == route_id].reset_index(drop=True)
+        variants = shape_variants_df[shape_variants_df['version_id'].isin(versions['version_id'])].reset_index(drop=True)
+
+        return {
+            'routes': routes_df[routes_df['route_id'] == route_id].drop_duplicates().reset_index(drop=True),
+            'route_versions': versions,
+            'shape_variants': variants,
+            'shapes': self.shapes_for(variants['shape_id'].dropna().unique())
+        }
+
+    # Columnar files
+
+    def write_columnar(self, name: str, df: pd.DataFrame) -> None:
+        """
+        Write a table's columnar files from an in-memory DataFrame.
+
+        Call this right after saving the table's CSV so the columnar copy does
+        not have to be rebuilt from the CSV on next access.
+
+        Args:
+            name: Table name
+            df: Table data, as just saved to CSV
+        """
+        table_folder = self._columnar_folder(name)
+        os.makedirs(table_folder, exist_ok=True)
+
+        columns = {}
+        for col in df.columns:
+            if col in Config.INTERNED_COLUMNS:
+                np.save(os.path.join(table_folder, col + '.npy'), self.strings.encode(df[col]))
+                columns[col] = 'interned'
+            else:
+                columns[col] = self._write_column(table_folder, col, df[col])
+
+        csv_stat = os.stat(get_processed_table_path(name, self.data_folder))
+        meta = {
+            'rows': len(df),
+            'columns': columns,
+            'source_size': csv_stat.st_size,
+            'source_mtime_ns': csv_stat.st_mtime_ns
+        }
+        with open(os.path.join(table_folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        if name in self._tables:
+            self._tables[name] = df
+
+    def _columnar_folder(self, name: str) -> str:
+        return os.path.join(self.data_folder, Config.COLUMNAR_FOLDER, name)
+
+    def _ensure_columnar(self, name: str) -> dict:
+        """Return the table's columnar metadata, rebuilding the files if the CSV changed."""
+        meta_path = os.path.join(self._columnar_folder(name), 'meta.json')
+        csv_stat = os.stat(get_processed_table_path(name, self.data_folder))
+
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if (meta['source_size'] == csv_stat.st_size and
+                    meta['source_mtime_ns'] == csv_stat.st_mtime_ns):
+                return meta
+
+        self.write_columnar(name, read_processed_table(name, self.data_folder))
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_column(table_folder: str, col: str, series: pd.Series) -> str:
+        """Write one column and return its storage kind."""
+        base = os.path.join(table_folder, col)
+
+        if pd.api.types.is_datetime64_any_dtype(series):
+            np.save(base + '.npy', series.to_numpy(dtype='datetime64[ns]'))
+            return 'datetime'
+
+        if pd.api.types.is_float_dtype(series):
+            np.save(base + '.npy', series.to_numpy(dtype='float64', na_value=np.nan))
+            return 'float'
+
+        if pd.api.types.is_integer_dtype(series) or pd.api.types.is_bool_dtype(series):
+            mask = series.isna().to_numpy()
+            np.save(base + '.npy', series.fillna(0).to_numpy(dtype='int64'))
+            np.save(base + '.mask.npy', mask)
+            return 'int'
+
+        # Strings are dictionary encoded: int32 codes plus sorted categories
+        codes, categories = pd.factorize(series.astype(object), sort=True)
+        np.save(base + '.npy', codes.astype('int32'))
+        np.save(base + '.categories.npy', np.asarray(categories, dtype=str))
+        return 'string'
+
+    def _load_categories(self, name: str, col: str) -> np.ndarray:
+        """Sorted distinct values of a string column."""
+        meta = self._ensure_columnar(name)
+        base = os.path.join(self._columnar_folder(name), col)
+        if meta['columns'][col] == 'interned':
+            codes = np.unique(np.load(base + '.npy', mmap_mode='r'))
+            return np.sort(np.asarray(self.strings.decode(codes[codes >= 0]), dtype=str))
+        return np.load(base + '.categories.npy')
+
+    def _read_column(self, name: str, col: str, kind: str, rows: Optional[np.ndarray] = None,
+                     decode: bool = True) -> pd.Series:
+        """Read one memory-mapped column, optionally only the given row positions."""
+        base = os.path.join(self._columnar_folder(name), col)
+        values = np.load(base + '.npy', mmap_mode='r')
+        values = values[rows] if rows is not None else np.asarray(values)
+
+        if kind == 'interned':
+            return self.strings.decode(values) if decode else pd.Series(values)
+
+        if kind == 'int':
+            mask = np.load(base + '.mask.npy', mmap_mode='r')
+            mask = mask[rows] if rows is not None else np.asarray(mask)
+            return pd.Series(pd.arrays.IntegerArray(values.astype('int64'), mask.astype(bool)))
+
+        if kind == 'string':
+            categories = np.load(base + '.categories.npy')
+            decoded = pd.Categorical.from_codes(values, categories.astype(object))
+            return pd.Series(decoded).astype(object)
+
+        return pd.Series(values)
+
+    def _read_columnar(self, name: str, columns: Optional[List[str]] = None,
+                       rows: Optional[np.ndarray] = None, decode: bool = True) -> pd.DataFrame:
+        meta = self._ensure_columnar(name)
+        columns = columns if columns is not None else list(meta['columns'])
+        return pd.DataFrame({
+            col: self._read_column(name, col, meta['columns'][col], rows, decode) for col in columns
+        })
+
+    def _filter_columnar(self, name: str, col: str, values: List[str]) -> pd.DataFrame:
+        """Read only the rows whose string column matches one of the values."""
+        meta = self._ensure_columnar(name)
+        if meta['columns'][col] == 'interned':
+            wanted = self.strings.encode(values, add=False)
+            wanted = wanted[wanted >= 0]
+        else:
+            categories = self._load_categories(name, col)
+            positions = np.searchsorted(categories, values)
+            positions = positions[(positions < len(categories))]
+            wanted = positions[np.isin(categories[positions], values)]
+
+        codes = np.load(os.path.join(self._columnar_folder(name), col + '.npy'), mmap_mode='r')
+        rows = np.flatnonzero(np.isin(codes, wanted))
+        return self._read_columnar(name, rows=rows)
+
+    @staticmethod
+    def _first_column(name: str) -> str:
+        return next(iter(PROCESSED_TABLE_DTYPES[name]))
@@ -1,13 +1,19 @@
 """
 Processing history tracker for transit data processing.
 Keeps track of which dates have been successfully processed.
+
+The history is stored as a small header file, an append-only log with one line
+per processing session, and a snapshot of the processed/failed date sets that
+is refreshed every Config.TRACKER_SNAPSHOT_INTERVAL sessions. Recording a
+session appends one line and rewrites only the header.
 """
 import os
 import json
-import pandas as pd
-from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Set
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set
 from .config import Config
+from .feed_inventory import FeedInventory, list_feed_dates
 
 
 class ProcessingTracker:
@@ -24,18 +30,33 @@ class ProcessingTracker:
             data_folder = Config.get_default_processed_data_folder()
         
         self.data_folder = data_folder
-        self.tracker_file = os.path.join(data_folder, 'processing_history.json')
+        self.tracker_file = os.path.join(data_folder, Config.PROCESSING_HISTORY_FILE)
+        self.sessions_file = os.path.join(data_folder, Config.PROCESSING_SESSIONS_FILE)
+        self.snapshot_file = os.path.join(data_folder, Config.PROCESSING_SNAPSHOT_FILE)
+        
+        self.processed_dates: Set[str] = set()
+        self.failed_dates: Set[str] = set()
+        self._sessions_since_snapshot = 0
+        # Sessions of a single-file history, until the first write converts it
+        self._legacy_sessions: Optional[List[Dict]] = None
+        self._inventories: Dict[str, FeedInventory] = {}
         self.history = self._load_history()
     
     def _load_history(self) -> Dict:
-        """Load processing history from file."""
+        """Load the history header, and the date sets from the snapshot and session log."""
         if os.path.exists(self.tracker_file):
             try:
                 with open(self.tracker_file, 'r') as f:
-                    return json.load(f)
+                    history = json.load(f)
             except (json.JSONDecodeError, IOError):
                 print("Warning: Could not read processing history file. Starting fresh.")
                 return self._create_empty_history()
+            
+            if 'processing_sessions' in history:
+                return self._load_legacy_history(history)
+            
+            self._load_dates()
+            return history
         else:
             return self._create_empty_history()
     
@@ -44,52 +65,184 @@ class ProcessingTracker:
         return {
             'last_update': None,
             'last_successful_date': None,
-            'processed_dates': [],
-            'failed_dates': [],
-            'processing_sessions': []
+            'session_count': 0
+        }
+    
+    def _load_dates(self) -> None:
+        """Rebuild the date sets from the last snapshot plus the sessions logged after it."""
+        log_offset = 0
+        if os.path.exists(self.snapshot_file):
+            try:
+                with open(self.snapshot_file, 'r') as f:
+                    snapshot = json.load(f)
+                self.processed_dates = set(snapshot['processed_dates'])
+                self.failed_dates = set(snapshot['failed_dates'])
+                log_offset = snapshot['log_offset']
+            except (json.JSONDecodeError, KeyError, IOError):
+                print("Warning: Could not read processing snapshot. Replaying the full session log.")
+                self.processed_dates, self.failed_dates = set(), set()
+        
+        for session in self.iter_sessions(log_offset):
+            self._apply_session(session)
+            self._sessions_since_snapshot += 1
+    
+    def _load_legacy_history(self, history: Dict) -> Dict:
+        """
+        Read a single-file history (with embedded sessions) without changing it.
+        
+        The file stays readable by older versions until the first write, which
+        converts it to the log-based layout (see _migrate_legacy_history).
+        """
+        self.processed_dates = set(history.get('processed_dates', []))
+        self.failed_dates = set(history.get('failed_dates', []))
+        self._legacy_sessions = history.get('processing_sessions', [])
+        return {
+            'last_update': history.get('last_update'),
+            'last_successful_date': history.get('last_successful_date'),
+            'session_count': len(self._legacy_sessions)
         }
     
+    def _migrate_legacy_history(self) -> None:
+        """Write the sessions of a single-file history to the log-based layout, before the first write."""
+        if self._legacy_sessions is None:
+            return
+        
+        os.makedirs(self.data_folder, exist_ok=True)
+        with open(self.sessions_file, 'w') as f:
+            for session in self._legacy_sessions:
+                f.write(json.dumps(session, default=str) + '\n')
+        self._legacy_sessions = None
+        self._write_snapshot()
+    
     def _save_history(self) -> None:
-        """Save processing history to file."""
+        """Save the history header to file."""
+        # The header replaces a single-file history, so its sessions are logged first
+        self._migrate_legacy_history()
+        
         # Ensure directory exists
         os.makedirs(os.path.dirname(self.tracker_file), exist_ok=True)
         
+        header = dict(self.history)
+        header['total_processed_dates'] = len(self.processed_dates)
+        header['total_failed_dates'] = len(self.failed_dates)
+        
         try:
             with open(self.tracker_file, 'w') as f:
-                json.dump(self.history, f, indent=2, default=str)
+                json.dump(header, f, indent=2, default=str)
         except IOError as e:
             print(f"Warning: Could not save processing history: {e}")
     
-    def get_available_dates(self, raw_data_folder: Optional[str] = None) -> Set[str]:
+    def _write_snapshot(self) -> None:
+        """Snapshot the date sets so loading only replays sessions logged afterwards."""
+        log_offset = os.path.getsize(self.sessions_file) if os.path.exists(self.sessions_file) else 0
+        snapshot = {
+            'processed_dates': sorted(self.processed_dates),
+            'failed_dates': sorted(self.failed_dates),
+            'log_offset': log_offset
+        }
+        
+        temp_path = self.snapshot_file + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(temp_path, self.snapshot_file)
+            self._sessions_since_snapshot = 0
+        except IOError as e:
+            print(f"Warning: Could not save processing snapshot: {e}")
+    
+    def _append_session(self, session: Dict) -> None:
+        """Append one session to the log and apply it to the date sets."""
+        self._migrate_legacy_history()
+        os.makedirs(os.path.dirname(self.sessions_file), exist_ok=True)
+        try:
+            with open(self.sessions_file, 'a') as f:
+                f.write(json.dumps(session, default=str) + '\n')
+        except IOError as e:
+            print(f"Warning: Could not log processing session: {e}")
+        
+        self._apply_session(session)
+        self._sessions_since_snapshot += 1
+        if self._sessions_since_snapshot >= Config.TRACKER_SNAPSHOT_INTERVAL:
+            self._write_snapshot()
+    
+    def _apply_session(self, session: Dict) -> None:
+        """Apply a session's results to the processed and failed date sets."""
+        successful_dates = session.get('successful_dates', [])
+        self.processed_dates.update(successful_dates)
+        # Failed dates are kept even if processed earlier, but removed once they succeed
+        self.failed_dates.difference_update(successful_dates)
+        self.failed_dates.update(session.get('failed_dates', []))
+        # Dates whose merge was undone (see ChangeLog.rollback) are no longer processed
+        self.processed_dates.difference_update(session.get('rolled_back_dates', []))
+    
+    def iter_sessions(self, log_offset: int = 0) -> Iterator[Dict]:
         """
-        Get all available dates from raw data folder.
+        Iterate over the logged processing sessions, oldest first.
+        
+        Args:
+            log_offset: Byte offset in the session log to start from
+            
+        Yields:
+            Session dictionaries as recorded by record_processing_session
+        """
+        if self._legacy_sessions is not None:
+            # Not converted yet (see _load_legacy_history)
+            yield from self._legacy_sessions
+            return
+        if not os.path.exists(self.sessions_file):
+            return
+        
+        with open(self.sessions_file, 'r') as f:
+            f.seek(log_offset)
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by an interrupted write
+                    continue
+    
+    def get_inventory(self, raw_data_folder: Optional[str] = None) -> FeedInventory:
+        """
+        Get the refreshed feed inventory of a raw data folder.
+        
+        The inventory is stored in the processed data folder and only rescans 
+        the raw folder when its modification time changes.
         
         Args:
             raw_data_folder: Path to raw data folder. If None, uses auto-detected path.
             
         Returns:
-            Set of available date strings
+            Up-to-date FeedInventory
         """
         if raw_data_folder is None:
             raw_data_folder = Config.get_default_raw_data_folder()
         
-        available_dates = set()
-        
-        if os.path.exists(raw_data_folder):
-            for item in os.listdir(raw_data_folder):
-                item_path = os.path.join(raw_data_folder, item)
-                if os.path.isdir(item_path) or item.endswith('.zip'):
-                    date_name = item.replace('.zip', '')
-                    # Validate date format (YYYYMMDD)
-                    if len(date_name) == 8 and date_name.isdigit():
-                        try:
-                            # Verify it's a valid date
-                            datetime.strptime(date_name, '%Y%m%d')
-                            available_dates.add(date_name)
-                        except ValueError:
-                            pass  # Skip invalid dates
-        
-        return available_dates
+        inventory = self._inventories.get(raw_data_folder)
+        if inventory is None:
+            inventory = FeedInventory(raw_data_folder, self.data_folder)
+            self._inventories[raw_data_folder] = inventory
+        
+        changes = inventory.refresh()
+        changed_processed = sorted(self.processed_dates.intersection(changes['changed']))
+        if changed_processed:
+            print(f"⚠️  {len(changed_processed)} feed(s) changed on disk after being processed: "
+                  f"{', '.join(changed_processed[:10])}")
+        return inventory
+    
+    def get_available_dates(self, raw_data_folder: Optional[str] = None) -> Set[str]:
+        """
+        Get all available dates from raw data folder.
+        
+        Only the folder is listed; no feed is read and the inventory is not 
+        refreshed, so the status summary stays cheap and read-only.
+        
+        Args:
+            raw_data_folder: Path to raw data folder. If None, uses auto-detected path.
+            
+        Returns:
+            Set of available date strings
+        """
+        return set(list_feed_dates(raw_data_folder))
     
     def get_last_processed_date(self, available_dates: Optional[Set[str]] = None) -> Optional[str]:
         """
@@ -105,10 +258,7 @@ class ProcessingTracker:
             available_dates = self.get_available_dates()
         
         # Get processed dates that still have available data
-        processed_and_available = [
-            date for date in self.history['processed_dates'] 
-            if date in available_dates
-        ]
+        processed_and_available = self.processed_dates.intersection(available_dates)
         
         if processed_and_available:
             # Return the latest processed date
@@ -116,53 +266,74 @@ class ProcessingTracker:
         
         return None
     
-    def get_dates_to_process(self, start_date: str, end_date: str, 
+    def get_dates_to_process(self, start_date: Optional[str] = None, end_date: Optional[str] = None, 
                            raw_data_folder: Optional[str] = None) -> List[str]:
         """
         Get list of dates that need to be processed.
         
         Args:
-            start_date: Start date in YYYYMMDD format
-            end_date: End date in YYYYMMDD format
+            start_date: Start date in YYYYMMDD format. If None, starts at the first feed.
+            end_date: End date in YYYYMMDD format. If None, runs to the latest feed.
             raw_data_folder: Path to raw data folder
             
         Returns:
             List of dates that need processing
         """
-        available_dates = self.get_available_dates(raw_data_folder)
-        last_processed = self.get_last_processed_date(available_dates)
-        
-        # Generate all dates in the requested range
-        start = datetime.strptime(start_date, '%Y%m%d')
-        end = datetime.strptime(end_date, '%Y%m%d')
+        inventory = self.get_inventory(raw_data_folder)
+        last_processed = self.get_last_processed_date(set(inventory.feeds))
         
-        all_requested_dates = []
-        current = start
-        while current <= end:
-            all_requested_dates.append(current.strftime('%Y%m%d'))
-            current += timedelta(days=1)
-        
-        # Filter to only available dates
-        available_requested_dates = [date for date in all_requested_dates if date in available_dates]
+        # Feed dates in the requested range, by bisecting the sorted inventory
+        available_requested_dates = inventory.dates_between(start_date, end_date)
         
         if last_processed:
             # Only process dates after the last processed date
-            dates_to_process = [date for date in available_requested_dates if date > last_processed]
+            dates_to_process = available_requested_dates[bisect_right(available_requested_dates, last_processed):]
             
             if dates_to_process:
                 print(f"📅 Last processed date: {last_processed}")
                 print(f"🔄 Resuming from: {dates_to_process[0]}")
                 print(f"📊 Processing {len(dates_to_process)} new dates out of {len(available_requested_dates)} available")
             else:
-                print(f"✅ All dates up to {end_date} have already been processed!")
+                print(f"✅ All dates up to {end_date or 'the latest feed'} have already been processed!")
                 print(f"📅 Last processed: {last_processed}")
+
+            skipped = [date for date in available_requested_dates[:bisect_right(available_requested_dates, last_processed)]
+                       if date not in self.processed_dates]
+            if skipped:
+                print(f"⏪ Skipping {len(skipped)} unprocessed date(s) before {last_processed}; "
+                      f"merge them with the insert command")
         else:
             dates_to_process = available_requested_dates
             print(f"🆕 Starting fresh processing")
             print(f"📊 Processing {len(dates_to_process)} dates")
         
         return dates_to_process
-    
+
+    def get_dates_to_insert(self, start_date: Optional[str] = None, end_date: Optional[str] = None,
+                            raw_data_folder: Optional[str] = None) -> List[str]:
+        """
+        Get the unprocessed dates before the last processed date.
+
+        get_dates_to_process resumes after the last processed date, so feeds that
+        turn up later for earlier dates are left for FeedInserter.
+
+        Args:
+            start_date: Start date in YYYYMMDD format. If None, starts at the first feed.
+            end_date: End date in YYYYMMDD format. If None, runs to the latest feed.
+            raw_data_folder: Path to raw data folder
+
+        Returns:
+            List of dates that need inserting
+        """
+        inventory = self.get_inventory(raw_data_folder)
+        last_processed = self.get_last_processed_date(set(inventory.feeds))
+        if last_processed is None:
+            return []
+
+        available_requested_dates = inventory.dates_between(start_date, end_date)
+        earlier_dates = available_requested_dates[:bisect_right(available_requested_dates, last_processed)]
+        return [date for date in earlier_dates if date not in self.processed_dates]
+
     def record_processing_session(self, start_date: str, end_date: str, 
                                 successful_dates: List[str], failed_dates: List[str]) -> None:
         """
@@ -184,21 +355,9 @@ class ProcessingTracker:
             'failed_dates': failed_dates
         }
         
-        # Add to history
-        self.history['processing_sessions'].append(session)
-        
-        # Update processed dates (add new successful dates)
-        existing_processed = set(self.history['processed_dates'])
-        existing_processed.update(successful_dates)
-        self.history['processed_dates'] = sorted(list(existing_processed))
-        
-        # Update failed dates (but don't remove them if they succeed later)
-        existing_failed = set(self.history['failed_dates'])
-        # Remove dates that succeeded this time
-        existing_failed -= set(successful_dates)
-        # Add new failed dates
-        existing_failed.update(failed_dates)
-        self.history['failed_dates'] = sorted(list(existing_failed))
+        # Log the session and update the processed and failed date sets
+        self._append_session(session)
+        self.history['session_count'] += 1
         
         # Update last successful date and last update time
         if successful_dates:
@@ -212,17 +371,40 @@ class ProcessingTracker:
         # Save to file
         self._save_history()
     
+    def record_rollback(self, date: str, rolled_back_dates: List[str]) -> None:
+        """
+        Record that the processed data was rolled back to a date.
+
+        Args:
+            date: Date the processed data was rolled back to
+            rolled_back_dates: Dates whose merge was undone
+        """
+        self._append_session({
+            'timestamp': datetime.now().isoformat(),
+            'start_date': date,
+            'end_date': date,
+            'successful_count': 0,
+            'failed_count': 0,
+            'successful_dates': [],
+            'failed_dates': [],
+            'rolled_back_dates': rolled_back_dates
+        })
+        self.history['session_count'] += 1
+        self.history['last_successful_date'] = max(self.processed_dates, default=None)
+        self.history['last_update'] = datetime.now().isoformat()
+        self._save_history()
+    
     def get_processing_summary(self) -> Dict:
         """Get a summary of processing history."""
         available_dates = self.get_available_dates()
         
         summary = {
             'total_available_dates': len(available_dates),
-            'total_processed_dates': len(self.history['processed_dates']),
-            'total_failed_dates': len(self.history['failed_dates']),
+            'total_processed_dates': len(self.processed_dates),
+            'total_failed_dates': len(self.failed_dates),
             'last_successful_date': self.history['last_successful_date'],
             'last_update': self.history['last_update'],
-            'processing_sessions': len(self.history['processing_sessions']),
+            'processing_sessions': self.history['session_count'],
             'success_rate': 0.0
         }
         
@@ -248,29 +430,41 @@ class ProcessingTracker:
         print(f"Last update: {summary['last_update'] or 'Never'}")
         print(f"Processing sessions: {summary['processing_sessions']}")
         
-        if self.history['failed_dates']:
-            print(f"\n❌ Failed dates ({len(self.history['failed_dates'])}):")
+        if self.failed_dates:
+            print(f"\n❌ Failed dates ({len(self.failed_dates)}):")
             # Show first few failed dates
-            failed_sample = self.history['failed_dates'][:10]
+            failed_sample = sorted(self.failed_dates)[:10]
             print(f"   {', '.join(failed_sample)}")
-            if len(self.history['failed_dates']) > 10:
-                print(f"   ... and {len(self.history['failed_dates']) - 10} more")
+            if len(self.failed_dates) > 10:
+                print(f"   ... and {len(self.failed_dates) - 10} more")
     
     def reset_history(self) -> None:
         """Reset processing history (use with caution!)."""
         self.history = self._create_empty_history()
+        self.processed_dates, self.failed_dates = set(), set()
+        self._legacy_sessions = None
+        for path in (self.sessions_file, self.snapshot_file):
+            if os.path.exists(path):
+                os.remove(path)
+        self._sessions_since_snapshot = 0
         self._save_history()
         print("⚠️  Processing history has been reset!")
     
     def mark_date_as_processed(self, date: str) -> None:
         """Manually mark a date as processed."""
-        if date not in self.history['processed_dates']:
-            self.history['processed_dates'].append(date)
-            self.history['processed_dates'].sort()
-            
-            # Remove from failed dates if it was there
-            if date in self.history['failed_dates']:
-                self.history['failed_dates'].remove(date)
+        if date not in self.processed_dates:
+            # Logged like a session, so replaying the log reproduces the mark
+            self._append_session({
+                'timestamp': datetime.now().isoformat(),
+                'start_date': date,
+                'end_date': date,
+                'successful_count': 1,
+                'failed_count': 0,
+                'successful_dates': [date],
+                'failed_dates': [],
+                'manual': True
+            })
+            self.history['session_count'] += 1
             
             # Update last successful date if this is the latest
             if (self.history['last_successful_date'] is None or 
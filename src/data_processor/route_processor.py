@@ -3,9 +3,13 @@ Fixed route processing functions for transit data with proper version management
 """
 import pandas as pd
 import numpy as np
-from typing import Dict, Optional
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
 
 from .config import Config
+from .key_index import ProcessedKeyIndex
+
+if TYPE_CHECKING:
+    from .route_shards import RouteShards
 
 
 def build_latest_routes(trips_df: pd.DataFrame, trip_first_date: Dict[str, Optional[str]], 
@@ -42,7 +46,69 @@ def build_latest_routes(trips_df: pd.DataFrame, trip_first_date: Dict[str, Optio
     return latest_routes_df
 
 
-def update_routes(routes_df: pd.DataFrame, latest_routes_df: pd.DataFrame, show_progress: bool = True) -> pd.DataFrame:
+def diff_latest_routes(latest_routes_df: pd.DataFrame, 
+                       previous_routes: Dict[Tuple[str, int], Tuple[str, str]],
+                       show_progress: bool = True) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Diff a feed's route patterns against those of the previously merged feed.
+    
+    Patterns are (route_id, direction_id, main_shape_id, trip_headsign) tuples. 
+    Only added and changed patterns can lead to new route versions, so version 
+    management only needs those. Patterns with missing key values are always 
+    treated as added, since they never match an existing version.
+    
+    Args:
+        latest_routes_df: Latest routes DataFrame of the new feed
+        previous_routes: Mapping of (route_id, direction_id) to (main_shape_id, trip_headsign) 
+                         of the previous feed, e.g. ProcessedKeyIndex.feed_routes
+        show_progress: Whether to print a summary of the diff
+        
+    Returns:
+        Tuple of (rows of latest_routes_df that were added or changed, 
+                  diff DataFrame with route_id, direction_id and change 
+                  ('added', 'changed' or 'removed') per differing key)
+    """
+    key_cols = ['route_id', 'direction_id']
+    pattern_cols = ['main_shape_id', 'trip_headsign']
+    
+    previous_df = pd.DataFrame(
+        [(route_id, direction_id, main_shape_id, trip_headsign) 
+         for (route_id, direction_id), (main_shape_id, trip_headsign) in previous_routes.items()],
+        columns=key_cols + ['previous_shape_id', 'previous_headsign']
+    )
+    
+    current_df = latest_routes_df[key_cols + pattern_cols].copy()
+    current_df['direction_id'] = pd.to_numeric(current_df['direction_id'], errors='coerce').astype('Int64')
+    previous_df['direction_id'] = previous_df['direction_id'].astype('Int64')
+    merged = current_df.reset_index().merge(previous_df, on=key_cols, how='left')
+    
+    added = merged['previous_shape_id'].isna() | merged[key_cols + pattern_cols].isna().any(axis=1)
+    changed = ~added & ((merged['main_shape_id'] != merged['previous_shape_id']) | 
+                        (merged['trip_headsign'] != merged['previous_headsign']))
+    
+    changed_routes_df = latest_routes_df.loc[merged.loc[added | changed, 'index']]
+    
+    current_keys = current_df[key_cols].dropna().drop_duplicates()
+    removed = previous_df[key_cols].merge(current_keys, on=key_cols, how='left', indicator=True)
+    removed = removed[removed['_merge'] == 'left_only'][key_cols]
+    
+    diff_df = pd.concat([
+        merged.loc[added, key_cols].assign(change='added'),
+        merged.loc[changed, key_cols].assign(change='changed'),
+        removed.assign(change='removed')
+    ], ignore_index=True)
+    
+    if show_progress:
+        counts = diff_df['change'].value_counts()
+        print(f"Feed diff: {counts.get('added', 0)} added, {counts.get('changed', 0)} changed, "
+              f"{counts.get('removed', 0)} removed, "
+              f"{len(latest_routes_df) - len(changed_routes_df)} unchanged route pattern(s)")
+    
+    return changed_routes_df, diff_df
+
+
+def update_routes(routes_df: pd.DataFrame, latest_routes_df: pd.DataFrame, show_progress: bool = True,
+                  key_index: Optional[ProcessedKeyIndex] = None) -> pd.DataFrame:
     """
     Update routes DataFrame with new routes.
     
@@ -50,6 +116,9 @@ def update_routes(routes_df: pd.DataFrame, latest_routes_df: pd.DataFrame, show_
         routes_df: Existing routes DataFrame
         latest_routes_df: Latest routes DataFrame
         show_progress: Whether to show progress messages
+        key_index: Key index describing routes_df. If given, existing route_ids are 
+                   looked up in it, only the added routes are checked for duplicates 
+                   and the index is updated with them.
         
     Returns:
         Updated routes DataFrame
@@ -58,7 +127,8 @@ def update_routes(routes_df: pd.DataFrame, latest_routes_df: pd.DataFrame, show_
     cols_to_use = [col for col in routes_df.columns]
 
     # Select new rows - routes not in existing routes_df 
-    new_routes = latest_routes_df[~latest_routes_df["route_id"].isin(routes_df["route_id"])][cols_to_use]
+    existing_route_ids = key_index.route_ids if key_index is not None else routes_df["route_id"]
+    new_routes = latest_routes_df[~latest_routes_df["route_id"].isin(existing_route_ids)][cols_to_use]
     
     # Concatenate new routes (handle empty DataFrames properly)
     if new_routes.empty:
@@ -68,8 +138,12 @@ def update_routes(routes_df: pd.DataFrame, latest_routes_df: pd.DataFrame, show_
     else:
         updated_routes_df = pd.concat([routes_df, new_routes], ignore_index=True)
 
-    # Check for duplicates
-    duplicates = updated_routes_df[updated_routes_df.groupby("route_id")["route_id"].transform("count") > 1]
+    # Check for duplicates (only the added rows can introduce new ones when the index is used)
+    if key_index is not None:
+        duplicates = new_routes[new_routes.duplicated("route_id", keep=False)]
+        key_index.add_route_ids(new_routes["route_id"].dropna().unique())
+    else:
+        duplicates = updated_routes_df[updated_routes_df.groupby("route_id")["route_id"].transform("count") > 1]
 
     if show_progress:
         if not duplicates.empty:
@@ -102,8 +176,60 @@ def version_exists(current_versions: pd.DataFrame, row: pd.Series) -> bool:
     )
 
 
+def close_active_versions(route_versions_df: pd.DataFrame, 
+                          new_versions_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Close active versions superseded by new versions in one grouped update.
+    
+    All active versions of a (route_id, direction_id) key are closed on the day
+    before the earliest new version of that key. When a key receives several new
+    versions at once, they are chained by valid_from (ties keep input order) and
+    only the last one stays active.
+    
+    Args:
+        route_versions_df: Existing route versions DataFrame (modified copy is returned)
+        new_versions_df: New versions with route_id, direction_id and valid_from columns
+        
+    Returns:
+        Tuple of (route versions DataFrame with closed versions, 
+                  per-key changes DataFrame, 
+                  new versions DataFrame with chained valid_to)
+    """
+    key_cols = ['route_id', 'direction_id']
+    one_day = pd.Timedelta(days=1)
+    route_versions_df = route_versions_df.copy()
+    new_versions_df = new_versions_df.copy()
+    
+    # Chain new versions of the same key: each one ends the day before the next starts
+    ordered = new_versions_df.sort_values(key_cols + ['valid_from'], kind='mergesort')
+    next_valid_from = ordered.groupby(key_cols, sort=False)['valid_from'].shift(-1)
+    new_versions_df.loc[ordered.index, 'valid_to'] = next_valid_from - one_day
+    
+    # One closing date per key: the day before its earliest new version
+    changes_df = ordered.groupby(key_cols, sort=True).agg(
+        new_count=('valid_from', 'size'),
+        valid_to=('valid_from', 'min')
+    ).reset_index()
+    changes_df['valid_to'] = changes_df['valid_to'] - one_day
+    
+    active_versions = route_versions_df.loc[route_versions_df['valid_to'].isna(), key_cols]
+    to_close = active_versions.reset_index().merge(changes_df[key_cols + ['valid_to']], on=key_cols)
+    route_versions_df.loc[to_close['index'], 'valid_to'] = to_close['valid_to'].values
+    
+    closed_counts = to_close.groupby(key_cols).size().rename('closed_count').reset_index()
+    changes_df = changes_df.merge(closed_counts, on=key_cols, how='left')
+    changes_df['closed_count'] = changes_df['closed_count'].fillna(0).astype(int)
+    changes_df.loc[changes_df['closed_count'] == 0, 'valid_to'] = pd.NaT
+    changes_df = changes_df[key_cols + ['closed_count', 'valid_to', 'new_count']]
+    
+    return route_versions_df, changes_df, new_versions_df
+
+
 def update_route_versions(route_versions_df: pd.DataFrame, latest_routes_df: pd.DataFrame, 
-                         date: str, show_progress: bool = True) -> pd.DataFrame:
+                         date: str, show_progress: bool = True, 
+                         return_changes: bool = False, fix_overlaps: bool = False,
+                         key_index: Optional[ProcessedKeyIndex] = None,
+                         shards: Optional['RouteShards'] = None):
     """
     Update route versions DataFrame with new versions, properly handling overlaps and duplicates.
     
@@ -112,9 +238,20 @@ def update_route_versions(route_versions_df: pd.DataFrame, latest_routes_df: pd.
         latest_routes_df: Latest routes DataFrame
         date: Processing date
         show_progress: Whether to show detailed progress messages
+        return_changes: Whether to also return the per-key changes DataFrame
+        fix_overlaps: Whether to repair date overlaps with fix_version_overlaps
+        key_index: Key index describing route_versions_df. If given, new versions are 
+                   detected with key lookups instead of scanning the current versions, 
+                   and the index is updated with the closed and added versions.
+        shards: Route shards to find the new versions and close the versions they 
+                supersede with, one process per shard. The version ids are the 
+                same as without sharding.
         
     Returns:
-        Updated route versions DataFrame
+        Updated route versions DataFrame, or a tuple of (updated route versions, 
+        changes) if return_changes=True. The changes DataFrame has one row per 
+        (route_id, direction_id) with new versions: closed_count, valid_to set 
+        on the closed versions and new_count.
     """
     route_versions_copy_df = route_versions_df.copy()
     
@@ -131,38 +268,34 @@ def update_route_versions(route_versions_df: pd.DataFrame, latest_routes_df: pd.
     new_versions_df["parent_version_id"] = np.nan
     new_versions_df["note"] = np.nan
 
-    # Define current versions (those without valid_to date)
-    current_versions = route_versions_df[route_versions_df["valid_to"].isna()]
-
     # Filter for truly new versions
-    new_versions_filtered = new_versions_df[~new_versions_df.apply(lambda row: version_exists(current_versions, row), axis=1)].copy()
+    if shards is not None:
+        # Filtered and closed per route shard; the ids are allocated below, in input order
+        route_versions_copy_df, changes_df, new_versions_filtered = shards.close_versions(
+            route_versions_copy_df, new_versions_df
+        )
+    elif key_index is not None:
+        new_versions_filtered = new_versions_df[~key_index.version_exists_mask(new_versions_df)].copy()
+    else:
+        # Define current versions (those without valid_to date)
+        current_versions = route_versions_df[route_versions_df["valid_to"].isna()]
+        new_versions_filtered = new_versions_df[~new_versions_df.apply(lambda row: version_exists(current_versions, row), axis=1)].copy()
 
     if new_versions_filtered.empty:
         # No new versions to add
+        if return_changes:
+            return route_versions_copy_df, _empty_version_changes()
         return route_versions_copy_df
 
-    # FIXED LOGIC: Update previous versions' valid_to date CORRECTLY
-    for _, new_row in new_versions_filtered.iterrows():
-        # Find all current (active) versions for this route and direction
-        active_versions_mask = (
-            (route_versions_copy_df["route_id"] == new_row["route_id"]) &
-            (route_versions_copy_df["direction_id"] == new_row["direction_id"]) &
-            (route_versions_copy_df["valid_to"].isna())
+    if shards is None:
+        # Close the active versions of every touched route/direction in one grouped update
+        route_versions_copy_df, changes_df, new_versions_filtered = close_active_versions(
+            route_versions_copy_df, new_versions_filtered
         )
-        
-        # Get the indices of active versions for this route/direction
-        active_indices = route_versions_copy_df[active_versions_mask].index
-        
-        if len(active_indices) > 0:
-            # Set valid_to to the day before the new version starts
-            new_valid_to = new_row["valid_from"] - pd.Timedelta(days=1)
-            
-            # Update all active versions for this route/direction
-            route_versions_copy_df.loc[active_indices, "valid_to"] = new_valid_to
-            
-            if show_progress:
-                print(f"Updated {len(active_indices)} existing version(s) for route {new_row['route_id']} direction {new_row['direction_id']}")
-                print(f"  Set valid_to to: {new_valid_to.strftime('%Y-%m-%d')}")
+    
+    if show_progress:
+        closed = changes_df[changes_df['closed_count'] > 0]
+        print(f"Closed {closed['closed_count'].sum()} existing version(s) on {len(closed)} route direction(s)")
 
     # Assign version IDs to new versions
     new_versions_filtered["version_id"] = range(next_version_id, next_version_id + len(new_versions_filtered))
@@ -176,15 +309,61 @@ def update_route_versions(route_versions_df: pd.DataFrame, latest_routes_df: pd.
         extended_route_versions_df = pd.concat([route_versions_copy_df, new_versions_filtered], ignore_index=True)
 
     # ADDITIONAL VALIDATION: Check for overlaps and fix them
-    #####extended_route_versions_df = fix_version_overlaps(extended_route_versions_df, show_progress)
+    if fix_overlaps:
+        extended_route_versions_df = fix_version_overlaps(extended_route_versions_df, show_progress)
+
+    if key_index is not None:
+        if fix_overlaps:
+            # Overlap repair may close any version, so re-read the active ones
+            key_index.active_versions = {}
+            key_index.set_active_versions(extended_route_versions_df[extended_route_versions_df["valid_to"].isna()])
+        else:
+            key_index.close_versions(changes_df[changes_df['closed_count'] > 0])
+            key_index.set_active_versions(new_versions_filtered[new_versions_filtered["valid_to"].isna()])
 
+    if return_changes:
+        return extended_route_versions_df, changes_df
     return extended_route_versions_df
 
 
+def _empty_version_changes() -> pd.DataFrame:
+    """Create an empty per-key version changes DataFrame."""
+    changes_df = pd.DataFrame(columns=['route_id', 'direction_id', 'closed_count', 'valid_to', 'new_count'])
+    changes_df['valid_to'] = pd.to_datetime(changes_df['valid_to'])
+    return changes_df
+
+
+def _sorted_with_next(route_versions_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Sort versions by (route_id, direction_id, valid_from) and attach the next
+    version of the same route/direction to every row.
+    
+    Args:
+        route_versions_df: Route versions DataFrame
+        
+    Returns:
+        Sorted DataFrame (original index kept) with next_version_id, 
+        next_valid_from and next_valid_to columns
+    """
+    key_cols = ['route_id', 'direction_id']
+    df = route_versions_df.sort_values(key_cols + ['valid_from'], kind='mergesort')
+    next_rows = df.groupby(key_cols, sort=False, dropna=False)[['version_id', 'valid_from', 'valid_to']].shift(-1)
+    df = df.assign(
+        next_version_id=next_rows['version_id'],
+        next_valid_from=next_rows['valid_from'],
+        next_valid_to=next_rows['valid_to']
+    )
+    return df
+
+
 def fix_version_overlaps(route_versions_df: pd.DataFrame, show_progress: bool = True) -> pd.DataFrame:
     """
     Fix any remaining overlaps in route versions by ensuring proper date sequencing.
     
+    Within each route/direction sorted by valid_from, a version that is still 
+    open or ends on/after the start of the next version is closed on the day 
+    before the next version starts. Row order of the input is preserved.
+    
     Args:
         route_versions_df: Route versions DataFrame that may have overlaps
         show_progress: Whether to show detailed progress messages
@@ -193,41 +372,23 @@ def fix_version_overlaps(route_versions_df: pd.DataFrame, show_progress: bool =
         DataFrame with overlaps fixed
     """
     df = route_versions_df.copy()
+    if df.empty:
+        return df
     
-    # Group by route_id and direction_id to fix overlaps within each group
-    groups = df.groupby(['route_id', 'direction_id'])
-    
-    fixed_dfs = []
-    overlap_count = 0
-    
-    for (route_id, direction_id), group in groups:
-        group_copy = group.copy().sort_values('valid_from')
-        
-        # Check for overlaps in this group
-        for i in range(len(group_copy) - 1):
-            current_row = group_copy.iloc[i]
-            next_row = group_copy.iloc[i + 1]
-            
-            # If current version has no end date, set it to day before next version starts
-            if pd.isna(current_row['valid_to']):
-                new_valid_to = next_row['valid_from'] - pd.Timedelta(days=1)
-                group_copy.iloc[i, group_copy.columns.get_loc('valid_to')] = new_valid_to
-                overlap_count += 1
-            
-            # If current version ends after next version starts, fix the overlap
-            elif current_row['valid_to'] >= next_row['valid_from']:
-                new_valid_to = next_row['valid_from'] - pd.Timedelta(days=1)
-                group_copy.iloc[i, group_copy.columns.get_loc('valid_to')] = new_valid_to
-                overlap_count += 1
-        
-        fixed_dfs.append(group_copy)
+    ordered = _sorted_with_next(df)
+    overlapping = ordered['next_valid_from'].notna() & (
+        ordered['valid_to'].isna() | (ordered['valid_to'] >= ordered['next_valid_from'])
+    )
+    overlap_count = int(overlapping.sum())
     
-    result_df = pd.concat(fixed_dfs, ignore_index=True)
+    if overlap_count > 0:
+        fixed = ordered.loc[overlapping]
+        df.loc[fixed.index, 'valid_to'] = fixed['next_valid_from'] - pd.Timedelta(days=1)
     
     if overlap_count > 0 and show_progress:
         print(f"Fixed {overlap_count} date overlap(s) in route versions")
     
-    return result_df
+    return df
 
 
 def validate_route_versions(route_versions_df: pd.DataFrame, show_details: bool = True) -> dict:
@@ -262,49 +423,49 @@ def validate_route_versions(route_versions_df: pd.DataFrame, show_details: bool
         issues['is_valid'] = False
         if show_details:
             print(f"❌ Found {len(invalid_ranges)} version(s) with invalid date ranges:")
-            for _, row in invalid_ranges.iterrows():
+            for row in issues['invalid_date_ranges']:
                 print(f"  Version {row['version_id']}: Route {row['route_id']} Dir {row['direction_id']} - {row['valid_from']} to {row['valid_to']}")
     
-    # Check for overlapping versions within same route/direction
-    groups = route_versions_df.groupby(['route_id', 'direction_id'])
+    ordered = _sorted_with_next(route_versions_df)
     
-    for (route_id, direction_id), group in groups:
-        group_sorted = group.sort_values('valid_from')
-        
-        # Check for multiple active versions (no valid_to date)
-        active_versions = group_sorted[group_sorted['valid_to'].isna()]
-        if len(active_versions) > 1:
-            issues['duplicate_active_versions'].extend(
-                active_versions[['version_id', 'route_id', 'direction_id', 'valid_from']].to_dict('records')
-            )
-            issues['is_valid'] = False
-            if show_details:
-                print(f"❌ Multiple active versions for Route {route_id} Direction {direction_id}:")
-                for _, row in active_versions.iterrows():
-                    print(f"  Version {row['version_id']}: from {row['valid_from']}")
-        
-        # Check for overlapping date ranges
-        for i in range(len(group_sorted) - 1):
-            current = group_sorted.iloc[i]
-            next_version = group_sorted.iloc[i + 1]
-            
-            if pd.notna(current['valid_to']) and current['valid_to'] >= next_version['valid_from']:
-                overlap_info = {
-                    'route_id': route_id,
-                    'direction_id': direction_id,
-                    'version1_id': current['version_id'],
-                    'version1_range': f"{current['valid_from']} to {current['valid_to']}",
-                    'version2_id': next_version['version_id'],
-                    'version2_range': f"{next_version['valid_from']} to {next_version['valid_to'] if pd.notna(next_version['valid_to']) else 'ongoing'}"
-                }
-                issues['overlapping_versions'].append(overlap_info)
-                issues['is_valid'] = False
-                if show_details:
-                    print(f"❌ Overlapping versions for Route {route_id} Direction {direction_id}:")
-                    print(f"  Version {current['version_id']}: {overlap_info['version1_range']}")
-                    print(f"  Version {next_version['version_id']}: {overlap_info['version2_range']}")
+    # Check for multiple active versions (no valid_to date) within same route/direction
+    active = ordered[ordered['valid_to'].isna()]
+    active = active[active.groupby(['route_id', 'direction_id'])['version_id'].transform('size') > 1]
+    
+    if not active.empty:
+        issues['duplicate_active_versions'] = active[['version_id', 'route_id', 'direction_id', 'valid_from']].to_dict('records')
+        issues['is_valid'] = False
+        if show_details:
+            print(f"❌ Multiple active versions for {active.groupby(['route_id', 'direction_id']).ngroups} route direction(s):")
+            for row in issues['duplicate_active_versions']:
+                print(f"  Route {row['route_id']} Direction {row['direction_id']} - Version {row['version_id']}: from {row['valid_from']}")
+    
+    # Check for overlapping date ranges between consecutive versions
+    overlaps = ordered[
+        ordered['valid_to'].notna() & 
+        ordered['next_valid_from'].notna() & 
+        (ordered['valid_to'] >= ordered['next_valid_from'])
+    ]
+    
+    for row in overlaps.to_dict('records'):
+        next_valid_to = row['next_valid_to'] if pd.notna(row['next_valid_to']) else 'ongoing'
+        overlap_info = {
+            'route_id': row['route_id'],
+            'direction_id': row['direction_id'],
+            'version1_id': row['version_id'],
+            'version1_range': f"{row['valid_from']} to {row['valid_to']}",
+            # The shift made next_version_id float; overlaps always have a next version
+            'version2_id': int(row['next_version_id']),
+            'version2_range': f"{row['next_valid_from']} to {next_valid_to}"
+        }
+        issues['overlapping_versions'].append(overlap_info)
+        issues['is_valid'] = False
+        if show_details:
+            print(f"❌ Overlapping versions for Route {row['route_id']} Direction {row['direction_id']}:")
+            print(f"  Version {overlap_info['version1_id']}: {overlap_info['version1_range']}")
+            print(f"  Version {overlap_info['version2_id']}: {overlap_info['version2_range']}")
     
     if issues['is_valid'] and show_details:
         print("✅ All route versions are valid - no overlaps or invalid date ranges found.")
     
-    return issues
\ No newline at end of file
+    return issues
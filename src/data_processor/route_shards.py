@@ -0,0 +1,250 @@
+"""
+Route-sharded execution of the route version and shape variant merges.
+
+Different routes never interact in these merges: a version is only closed by
+a new version of its own (route_id, direction_id), a shape variant belongs to
+one version and an activation to one variant. RouteShards partitions the
+processed state and a feed's new data by a hash of route_id, and runs the
+per-route part of update_route_versions and update_shape_variants_and_activations
+on a process pool, one task per shard.
+
+Ids are not allocated in the shards. New variants get placeholder ids there,
+and the caller allocates version_id and shape_variant_id from the reassembled
+results in the order a serial merge would (input order of the new versions,
+first appearance of the new variants), so the merged tables are the same as
+without sharding.
+"""
+import numpy as np
+import pandas as pd
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from .route_processor import close_active_versions
+from .shape_processor import expand_variant_activations, _activation_window
+from .variant_index import VARIANT_KEY_COLUMNS
+
+VERSION_KEY_COLUMNS = ['route_id', 'direction_id']
+VERSION_PATTERN_COLUMNS = ['route_id', 'direction_id', 'main_shape_id', 'trip_headsign']
+ACTIVATION_KEY_COLUMNS = ['date', 'shape_variant_id', 'exception_type']
+
+
+class RouteShards:
+    """Partitions of the merge by route_id hash, run on a process pool."""
+
+    def __init__(self, shard_count: int, executor: Optional[Executor] = None):
+        """
+        Initialize the shards.
+
+        Args:
+            shard_count: Number of shards
+            executor: Executor running the shard tasks. If None, a process pool
+                      with one worker per shard is started on first use.
+        """
+        if shard_count < 1:
+            raise ValueError(f"Invalid shard count: {shard_count}")
+        self.shard_count = shard_count
+        self._executor = executor
+
+    def shard_of(self, route_ids: pd.Series) -> np.ndarray:
+        """Shard of each route_id. The hash is the same in every process and run."""
+        hashes = pd.util.hash_array(route_ids.astype(str).to_numpy(dtype=object))
+        return (hashes % np.uint64(self.shard_count)).astype('int64')
+
+    def shutdown(self) -> None:
+        """Stop the worker processes (they are started again when needed)."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _run(self, task: Callable, parts: List[tuple]) -> list:
+        """Run a task on each shard's part, returning the results in shard order."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.shard_count)
+        futures = [self._executor.submit(task, *part) for part in parts]
+        return [future.result() for future in futures]
+
+    # Route versions
+
+    def close_versions(self, route_versions_df: pd.DataFrame,
+                       new_versions_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        """
+        Find the truly new versions and close the versions they supersede, per shard.
+
+        Sharded counterpart of the version_exists filter and close_active_versions
+        in update_route_versions.
+
+        Args:
+            route_versions_df: Existing route versions DataFrame (modified copy is returned)
+            new_versions_df: Candidate new versions, without version_id
+
+        Returns:
+            Tuple of (route versions DataFrame with closed versions,
+                      per-key changes DataFrame (None if there are no new versions),
+                      truly new versions with chained valid_to, in input order)
+        """
+        route_versions_df = route_versions_df.copy()
+        # Only active versions can match a new one or be closed by it
+        active = route_versions_df.loc[route_versions_df['valid_to'].isna(), VERSION_PATTERN_COLUMNS + ['valid_to']]
+        active_shards = self.shard_of(active['route_id'])
+        new_versions_df = new_versions_df.assign(_position=np.arange(len(new_versions_df)))
+        new_shards = self.shard_of(new_versions_df['route_id'])
+        parts = [(active[active_shards == shard], new_versions_df[new_shards == shard])
+                 for shard in np.unique(new_shards)]
+
+        results = [result for result in self._run(_close_versions_shard, parts) if result[1] is not None]
+        if not results:
+            return route_versions_df, None, new_versions_df.iloc[:0].drop(columns='_position')
+        for closed_valid_to, _, _ in results:
+            route_versions_df.loc[closed_valid_to.index, 'valid_to'] = closed_valid_to.to_numpy()
+        # Same order as the serial changes, which are grouped by sorted key
+        changes_df = pd.concat([changes for _, changes, _ in results], ignore_index=True)
+        changes_df = changes_df.sort_values(VERSION_KEY_COLUMNS, kind='stable').reset_index(drop=True)
+        new_versions_df = pd.concat([new_versions for _, _, new_versions in results])
+        new_versions_df = new_versions_df.sort_values('_position').drop(columns='_position')
+        return route_versions_df, changes_df, new_versions_df
+
+    # Shape variants and activations
+
+    def merge_variants(self, shape_variant_data: pd.DataFrame, shape_variants_df: pd.DataFrame,
+                       shape_variant_activations_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, Optional[tuple]]:
+        """
+        Find the new shape variants and the activations that are not active yet, per shard.
+
+        Sharded counterpart of the variant and activation matching in
+        update_shape_variants_and_activations. New variants get the placeholder
+        id -1 - (their order of first appearance) until resolve_variant_ids.
+
+        Args:
+            shape_variant_data: Shape variant data of the feed, in either form
+            shape_variants_df: Existing shape variants DataFrame
+            shape_variant_activations_df: Existing shape variant activations DataFrame
+
+        Returns:
+            Tuple of (new variants in order of first appearance, with a _variant column
+                      holding that order,
+                      new activations,
+                      (first, last) date of all the feed's activations, or None if it has none)
+        """
+        data = shape_variant_data.assign(
+            _variant=shape_variant_data.groupby(VARIANT_KEY_COLUMNS, sort=False, dropna=False).ngroup().to_numpy(),
+            _row=np.arange(len(shape_variant_data))
+        )
+        data_shards = self.shard_of(data['route_id'])
+
+        # Only variants of the feed's active versions can match, and a version belongs to one route
+        version_shards = pd.Series(data_shards, index=data['version_id'].to_numpy())
+        version_shards = version_shards[~version_shards.index.duplicated()]
+        variants = shape_variants_df[shape_variants_df['version_id'].isin(version_shards.index)]
+        variants = variants[VARIANT_KEY_COLUMNS + ['shape_variant_id']]
+        variant_shards = variants['version_id'].map(version_shards).to_numpy()
+
+        # Existing activations dated within the feed's ranges and exceptions
+        dates = pd.to_datetime(data['date'])
+        if 'weekday_mask' in data.columns:
+            dates = pd.concat([dates, data['start_date'], data['end_date']])
+        window = _activation_window(shape_variant_activations_df, dates.dropna().dt.strftime('%Y-%m-%d'))
+        history = (shape_variant_activations_df.iloc[window[0]:window[1]] if window is not None
+                   else shape_variant_activations_df)
+        shard_by_variant = pd.Series(variant_shards, index=variants['shape_variant_id'].to_numpy())
+        history = history[ACTIVATION_KEY_COLUMNS]
+        history_shards = history['shape_variant_id'].map(shard_by_variant).to_numpy()
+
+        parts = [(data[data_shards == shard], variants[variant_shards == shard], history[history_shards == shard])
+                 for shard in np.unique(data_shards)]
+        results = self._run(_merge_variants_shard, parts)
+
+        new_variants = [new for new, _, _ in results]
+        new_variants = (pd.concat(new_variants).sort_values('_variant').reset_index(drop=True) if new_variants
+                        else pd.DataFrame(columns=VARIANT_KEY_COLUMNS + ['_variant']))
+        activations = [activations for _, activations, _ in results]
+        activations = (pd.concat(activations, ignore_index=True) if activations
+                       else pd.DataFrame(columns=ACTIVATION_KEY_COLUMNS))
+        date_ranges = [date_range for _, _, date_range in results if date_range is not None]
+        date_range = ((min(first for first, _ in date_ranges), max(last for _, last in date_ranges))
+                      if date_ranges else None)
+        return new_variants, activations, date_range
+
+    @staticmethod
+    def resolve_variant_ids(activations_df: pd.DataFrame, new_variants: pd.DataFrame,
+                            new_ids) -> pd.DataFrame:
+        """
+        Replace the placeholder ids of merge_variants and restore the serial row order.
+
+        Args:
+            activations_df: New activations from merge_variants
+            new_variants: New variants from merge_variants
+            new_ids: shape_variant_id allocated to each new variant
+
+        Returns:
+            Activations in the order the serial merge emits them
+        """
+        variant_ids = activations_df['shape_variant_id'].to_numpy(dtype='int64')
+        is_placeholder = variant_ids < 0
+        if is_placeholder.any():
+            allocated = pd.Series(np.asarray(new_ids, dtype='int64'),
+                                  index=-1 - new_variants['_variant'].to_numpy(dtype='int64'))
+            variant_ids = variant_ids.copy()
+            variant_ids[is_placeholder] = allocated.loc[variant_ids[is_placeholder]].to_numpy()
+        activations_df = activations_df.assign(shape_variant_id=variant_ids)
+        if '_row' in activations_df.columns:
+            # Per-day data emits activations in row order
+            activations_df = activations_df.sort_values('_row', kind='stable').drop(columns='_row')
+        else:
+            # Range data emits them sorted (see expand_variant_activations); all the rows
+            # of a variant come from one shard, so its ties keep their order
+            activations_df = activations_df.sort_values(['date', 'shape_variant_id'], kind='stable')
+        return activations_df.reset_index(drop=True)
+
+
+def _close_versions_shard(active_versions_df: pd.DataFrame, new_versions_df: pd.DataFrame) -> tuple:
+    """
+    Shard task of RouteShards.close_versions.
+
+    Returns:
+        Tuple of (valid_to of the closed versions, indexed like active_versions_df,
+                  changes DataFrame or None if no version is new, new versions)
+    """
+    new_versions_df = new_versions_df[~_version_exists_mask(active_versions_df, new_versions_df)]
+    if new_versions_df.empty:
+        return None, None, new_versions_df
+    closed_df, changes_df, new_versions_df = close_active_versions(active_versions_df, new_versions_df)
+    return closed_df['valid_to'].dropna(), changes_df, new_versions_df
+
+
+def _version_exists_mask(active_versions_df: pd.DataFrame, new_versions_df: pd.DataFrame) -> np.ndarray:
+    """Vectorized version_exists: rows with a missing key value never match."""
+    active_keys = active_versions_df[VERSION_PATTERN_COLUMNS].dropna().drop_duplicates()
+    new_keys = new_versions_df[VERSION_PATTERN_COLUMNS]
+    matched = new_keys.merge(active_keys, on=VERSION_PATTERN_COLUMNS, how='left', indicator=True)
+    return (matched['_merge'] == 'both').to_numpy() & new_keys.notna().all(axis=1).to_numpy()
+
+
+def _merge_variants_shard(shape_variant_data: pd.DataFrame, shape_variants_df: pd.DataFrame,
+                          history_df: pd.DataFrame) -> tuple:
+    """
+    Shard task of RouteShards.merge_variants.
+
+    Returns:
+        Tuple of (new variants, new activations, (first, last) activation date or None)
+    """
+    variants = shape_variant_data.drop_duplicates('_variant')[VARIANT_KEY_COLUMNS + ['_variant']]
+    matched = variants.merge(shape_variants_df, on=VARIANT_KEY_COLUMNS, how='left')
+    is_new = matched['shape_variant_id'].isna().to_numpy()
+    variant_ids = np.where(is_new, -1 - matched['_variant'].to_numpy(dtype='int64'),
+                           matched['shape_variant_id'].fillna(-1).to_numpy(dtype='int64'))
+    variant_ids = pd.Series(variant_ids, index=matched['_variant'].to_numpy())
+    data = shape_variant_data.assign(
+        shape_variant_id=variant_ids.loc[shape_variant_data['_variant'].to_numpy()].to_numpy()
+    )
+
+    if 'weekday_mask' in data.columns:
+        activations = expand_variant_activations(data)
+    else:
+        activations = data[ACTIVATION_KEY_COLUMNS + ['_row']].copy()
+    activations['exception_type'] = activations['exception_type'].astype('float64')
+    date_range = (activations['date'].min(), activations['date'].max()) if not activations.empty else None
+
+    if not history_df.empty:
+        matched_activations = activations.merge(history_df, on=ACTIVATION_KEY_COLUMNS, how='left', indicator=True)
+        activations = matched_activations[matched_activations['_merge'] == 'left_only'].drop('_merge', axis=1)
+    return matched.loc[is_new, VARIANT_KEY_COLUMNS + ['_variant']], activations.reset_index(drop=True), date_range
@@ -4,9 +4,16 @@ Fixed to avoid pandas concatenation warnings.
 """
 import pandas as pd
 import numpy as np
-from typing import Dict, List
+from typing import TYPE_CHECKING, Dict, List, Optional
 
 from .config import Config
+from .activation_encoding import EncodedActivations
+from .variant_index import ShapeVariantIndex
+
+if TYPE_CHECKING:
+    from .route_shards import RouteShards
+
+WEEKDAY_COLUMNS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
 
 
 def build_service_data_without_exceptions(trip_dates: Dict[str, List[str]], 
@@ -37,6 +44,108 @@ def build_service_data_without_exceptions(trip_dates: Dict[str, List[str]],
     return df_noexceptions
 
 
+def build_service_ranges_without_exceptions(calendar_df: pd.DataFrame, 
+                                           trips_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Build service data without calendar exceptions as date ranges.
+    
+    Range-based counterpart of build_service_data_without_exceptions: each 
+    pattern keeps the service interval and weekday mask of its service 
+    instead of one row per active date. Use expand_service_ranges to get 
+    the per-day rows.
+    
+    Args:
+        calendar_df: DataFrame with calendar data
+        trips_df: DataFrame with trip data
+        
+    Returns:
+        DataFrame with one row per pattern and its service's start_date, end_date,
+        weekday_mask (bit 0 is Monday) and first_date (first active date)
+    """
+    # Like get_active_dates, the first calendar row of a service is used
+    calendar = calendar_df.drop_duplicates('service_id', keep='first')
+    start_dates = _to_dates(calendar['start_date'])
+    end_dates = _to_dates(calendar['end_date'])
+    weekday_masks = np.zeros(len(calendar), dtype='int64')
+    for i, day_column in enumerate(WEEKDAY_COLUMNS):
+        weekday_masks |= (calendar[day_column] == 1).to_numpy().astype('int64') << i
+    
+    services = pd.DataFrame({
+        'service_id': calendar['service_id'],
+        'start_date': start_dates,
+        'end_date': end_dates,
+        'weekday_mask': weekday_masks,
+        'first_date': _first_active_dates(start_dates, end_dates, weekday_masks)
+    })
+    services = services[services['first_date'].notna()]
+    
+    inservice_df = trips_df[trips_df["service_id"].isin(services['service_id'])]
+    inservice_df = inservice_df[["service_id", "route_id", "shape_id", "trip_headsign", "direction_id"]]
+    inservice_df = inservice_df.groupby(["route_id", "shape_id", "trip_headsign", "direction_id"]).agg("first").reset_index()
+    
+    service_ranges_df = inservice_df.merge(services, on='service_id', how='left')
+    return service_ranges_df.drop(columns=['service_id'])
+
+
+def expand_service_ranges(service_ranges_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Materialize range-based service data into one row per pattern and date.
+    
+    Args:
+        service_ranges_df: DataFrame from build_service_ranges_without_exceptions
+        
+    Returns:
+        DataFrame like build_service_data_without_exceptions returns
+    """
+    pattern_index, days = _expand_ranges(service_ranges_df)
+    df_noexceptions = service_ranges_df[["route_id", "shape_id", "trip_headsign", "direction_id"]].iloc[pattern_index]
+    df_noexceptions = df_noexceptions.assign(
+        date=np.datetime_as_string(days.astype('datetime64[D]')).astype(object),
+        exception_type=np.nan
+    )
+    return df_noexceptions
+
+
+def trim_service_ranges(service_ranges_df: pd.DataFrame, df_exceptions: pd.DataFrame,
+                        start_date: Optional[str] = None, end_date: Optional[str] = None) -> tuple:
+    """
+    Restrict range-based service data to the dates in [start_date, end_date).
+    
+    Used to emit a feed's activations only up to the next feed's date, which
+    takes over from there. Patterns left without an active date are dropped.
+    
+    Args:
+        service_ranges_df: DataFrame from build_service_ranges_without_exceptions
+        df_exceptions: DataFrame from build_service_data_with_exceptions
+        start_date: First date kept (YYYYMMDD). If None, the start is not trimmed.
+        end_date: First date no longer kept (YYYYMMDD). If None, the end is not trimmed.
+        
+    Returns:
+        Tuple of trimmed (service_ranges_df, df_exceptions)
+    """
+    start_dates = service_ranges_df['start_date']
+    end_dates = service_ranges_df['end_date']
+    exception_dates = pd.to_datetime(df_exceptions['date'])
+    keep_exceptions = pd.Series(True, index=df_exceptions.index)
+    
+    if start_date is not None:
+        first_kept = pd.to_datetime(start_date, format='%Y%m%d')
+        start_dates = start_dates.clip(lower=first_kept)
+        keep_exceptions &= exception_dates >= first_kept
+    if end_date is not None:
+        last_kept = pd.to_datetime(end_date, format='%Y%m%d') - pd.Timedelta(days=1)
+        end_dates = end_dates.clip(upper=last_kept)
+        keep_exceptions &= exception_dates <= last_kept
+    
+    trimmed_ranges = service_ranges_df.assign(
+        start_date=start_dates,
+        end_date=end_dates,
+        first_date=_first_active_dates(start_dates, end_dates, service_ranges_df['weekday_mask'].to_numpy())
+    )
+    trimmed_ranges = trimmed_ranges[trimmed_ranges['first_date'].notna()].reset_index(drop=True)
+    return trimmed_ranges, df_exceptions[keep_exceptions].reset_index(drop=True)
+
+
 def build_service_data_with_exceptions(calendar_dates_df: pd.DataFrame, 
                                      trips_df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -151,10 +260,64 @@ def build_shape_variant_data(route_versions_df: pd.DataFrame, df_noexceptions: p
     return return_df
 
 
+def build_shape_variant_ranges(route_versions_df: pd.DataFrame, service_ranges_df: pd.DataFrame, 
+                               df_exceptions: pd.DataFrame, show_progress: bool = True) -> pd.DataFrame:
+    """
+    Build shape variant data from range-based service data, without per-day rows.
+    
+    Range counterpart of build_shape_variant_data. Each pattern has one row 
+    carrying its service's start_date, end_date and weekday_mask, plus one row 
+    per calendar exception (with date and exception_type, and no range). An 
+    exception replaces the range's activation on its date. The date of a range 
+    row is its first active date, so rows keep the order of first appearance 
+    that build_shape_variant_data gives. update_shape_variants_and_activations 
+    accepts either form.
+    
+    Args:
+        route_versions_df: DataFrame with route versions
+        service_ranges_df: DataFrame from build_service_ranges_without_exceptions
+        df_exceptions: DataFrame with service data with exceptions
+        show_progress: Whether to show progress messages
+        
+    Returns:
+        DataFrame with shape variant data in range form
+    """
+    valid_routes = route_versions_df[route_versions_df["valid_to"].isna()][["version_id", "route_id", "direction_id", "main_shape_id"]]
+    
+    pattern_columns = ['route_id', 'shape_id', 'trip_headsign', 'direction_id']
+    ranges = service_ranges_df[pattern_columns + ['start_date', 'end_date', 'weekday_mask']].copy()
+    ranges['date'] = service_ranges_df['first_date'].dt.strftime('%Y-%m-%d')
+    ranges['exception_type'] = np.nan
+    exceptions = df_exceptions[pattern_columns + ['date', 'exception_type']].copy()
+    exceptions['date'] = pd.to_datetime(exceptions['date']).dt.strftime('%Y-%m-%d')
+    
+    if show_progress:
+        # Same count as merge_service_data: exception dates that replace a range date
+        overlaps = exceptions.merge(ranges.drop(columns=['date', 'exception_type']), on=pattern_columns)
+        overlap_dates = pd.to_datetime(overlaps['date'])
+        replaced = ((overlap_dates >= overlaps['start_date']) & (overlap_dates <= overlaps['end_date']) &
+                    (((overlaps['weekday_mask'].to_numpy() >> overlap_dates.dt.weekday.to_numpy()) & 1) == 1))
+        print(f"Removed {int(replaced.sum())} duplicate rows where only exception_type differed (NaN vs non-NaN).")
+    
+    combined = pd.concat([ranges, exceptions], ignore_index=True)
+    combined = combined[pattern_columns + ['date', 'exception_type', 'start_date', 'end_date', 'weekday_mask']]
+    sort_columns = ['date', 'route_id', 'direction_id', 'shape_id', 'trip_headsign', 'exception_type']
+    combined = combined.sort_values(by=sort_columns).reset_index(drop=True)
+    
+    return_df = pd.merge(valid_routes, combined, on=["route_id", "direction_id"])
+    return_df["main_shape_id"] = (return_df["main_shape_id"] == return_df["shape_id"]).astype(int)
+    return_df = return_df.rename(columns={"main_shape_id": "is_main"})
+    return return_df
+
+
 def update_shape_variants_and_activations(shape_variant_data: pd.DataFrame, 
                                          shape_variants_df: pd.DataFrame,
                                          shape_variant_activations_df: pd.DataFrame,
-                                         show_progress: bool = True) -> tuple[pd.DataFrame, pd.DataFrame]:
+                                         show_progress: bool = True,
+                                         return_new: bool = False,
+                                         encoded_activations: Optional[EncodedActivations] = None,
+                                         variant_index: Optional[ShapeVariantIndex] = None,
+                                         shards: Optional['RouteShards'] = None) -> tuple:
     """
     Update shape variants and activations DataFrames with new data.
     
@@ -163,15 +326,34 @@ def update_shape_variants_and_activations(shape_variant_data: pd.DataFrame,
         shape_variants_df: Existing shape variants DataFrame
         shape_variant_activations_df: Existing shape variant activations DataFrame
         show_progress: Whether to show progress messages
+        return_new: Whether to also return the activations added by this update
+        encoded_activations: Run-length encoding of shape_variant_activations_df. If given,
+                             new activations are looked up in it instead of merged against
+                             the full table, and it is updated in place.
+        variant_index: Index of the shape variant keys of shape_variants_df. If given,
+                       existing variants are found and new ids are allocated with it 
+                       instead of merges against the full table, and it is updated in place.
+        shards: Route shards to match variants and activations with, one process per 
+                shard. The indexes are then only updated, and the shape_variant_ids 
+                are the same as without sharding.
         
     Returns:
-        Tuple of updated (shape_variants_df, shape_variant_activations_df)
+        Tuple of updated (shape_variants_df, shape_variant_activations_df), 
+        followed by the added activations DataFrame if return_new=True
     """
     # Get unique shape variants from merged_df
     new_variants = shape_variant_data[['version_id', 'shape_id', 'trip_headsign', 'is_main']].drop_duplicates().reset_index(drop=True)
 
     # Check which variants are already in shape_variants_df
-    if not shape_variants_df.empty:
+    if shards is not None:
+        # New variants get their ids below, in order of first appearance
+        truly_new_variants, shard_activations, activation_dates = shards.merge_variants(
+            shape_variant_data, shape_variants_df, shape_variant_activations_df
+        )
+    elif variant_index is not None:
+        variant_ids, is_new_variant = variant_index.assign(new_variants)
+        truly_new_variants = new_variants[is_new_variant].reset_index(drop=True)
+    elif not shape_variants_df.empty:
         existing_variants = shape_variants_df[['version_id', 'shape_id', 'trip_headsign', 'is_main']]
         # Find variants that don't already exist
         merged_check = new_variants.merge(
@@ -187,14 +369,20 @@ def update_shape_variants_and_activations(shape_variant_data: pd.DataFrame,
     # Add new variants to shape_variants_df
     if not truly_new_variants.empty:
         # Determine starting shape_variant_id
-        if shape_variants_df.empty:
-            start_id = Config.START_SHAPE_VARIANT_ID
+        if shards is not None and variant_index is not None:
+            # The variants are new to the index too, so they get its next ids in order
+            new_ids = variant_index.assign(truly_new_variants)[0]
+        elif variant_index is not None:
+            new_ids = variant_ids[is_new_variant]
+        elif shape_variants_df.empty:
+            new_ids = range(Config.START_SHAPE_VARIANT_ID, Config.START_SHAPE_VARIANT_ID + len(truly_new_variants))
         else:
             start_id = shape_variants_df['shape_variant_id'].max() + 1
+            new_ids = range(start_id, start_id + len(truly_new_variants))
         
         # Create new variant records
         new_variant_records = truly_new_variants.copy()
-        new_variant_records['shape_variant_id'] = range(start_id, start_id + len(truly_new_variants))
+        new_variant_records['shape_variant_id'] = new_ids
         new_variant_records['note'] = None
         new_variant_records = new_variant_records[['shape_variant_id', 'version_id', 'shape_id', 'trip_headsign', 'is_main', 'note']]
         
@@ -204,42 +392,87 @@ def update_shape_variants_and_activations(shape_variant_data: pd.DataFrame,
         else:
             shape_variants_df = pd.concat([shape_variants_df, new_variant_records], ignore_index=True)
 
-    # Create mapping for all variants (existing + new)
-    variant_mapping = shape_variants_df[['shape_variant_id', 'version_id', 'shape_id', 'trip_headsign', 'is_main']].copy()
-
-    # Merge with variant mapping to get shape_variant_id for each row
-    merged_with_variant_id = shape_variant_data.merge(
-        variant_mapping, 
-        on=['version_id', 'shape_id', 'trip_headsign', 'is_main'], 
-        how='left'
-    )
-
-    # Create new activation records
-    new_activations = merged_with_variant_id[['date', 'shape_variant_id', 'exception_type']].copy()
-    new_activations['exception_type'] = new_activations['exception_type'].astype('float64')
-
-    # Check which activations are already in shape_variant_activations_df
-    if not shape_variant_activations_df.empty:
-        # Find activations that don't already exist
-        merged_activations_check = new_activations.merge(
-            shape_variant_activations_df, 
-            on=['date', 'shape_variant_id', 'exception_type'], 
-            how='left', 
-            indicator=True
+    if shards is not None:
+        # The shards matched the activations against the history already
+        truly_new_activations = shards.resolve_variant_ids(
+            shard_activations, truly_new_variants, new_ids if not truly_new_variants.empty else []
         )
-        truly_new_activations = merged_activations_check[merged_activations_check['_merge'] == 'left_only'].drop('_merge', axis=1).reset_index(drop=True)
+        window = _activation_window(shape_variant_activations_df, pd.Series(activation_dates or [], dtype=object))
+        if window is not None:
+            window_start, window_stop = window
+            history_window = shape_variant_activations_df.iloc[window_start:window_stop]
+        if encoded_activations is not None:
+            encoded_activations.add(truly_new_activations)
     else:
-        truly_new_activations = new_activations
+        if variant_index is not None:
+            # Groups are numbered in order of first appearance, like the rows of new_variants
+            variant_groups = shape_variant_data.groupby(
+                ['version_id', 'shape_id', 'trip_headsign', 'is_main'], sort=False, dropna=False
+            ).ngroup().to_numpy()
+            merged_with_variant_id = shape_variant_data.assign(
+                shape_variant_id=variant_ids[variant_groups]
+            ).reset_index(drop=True)
+        else:
+            # Create mapping for all variants (existing + new)
+            variant_mapping = shape_variants_df[['shape_variant_id', 'version_id', 'shape_id', 'trip_headsign', 'is_main']].copy()
+
+            # Merge with variant mapping to get shape_variant_id for each row
+            merged_with_variant_id = shape_variant_data.merge(
+                variant_mapping, 
+                on=['version_id', 'shape_id', 'trip_headsign', 'is_main'], 
+                how='left'
+            )
+
+        # Create new activation records
+        if 'weekday_mask' in merged_with_variant_id.columns:
+            new_activations = expand_variant_activations(merged_with_variant_id)
+        else:
+            new_activations = merged_with_variant_id[['date', 'shape_variant_id', 'exception_type']].copy()
+        new_activations['exception_type'] = new_activations['exception_type'].astype('float64')
+
+        # Only the history rows in the date window of the new activations can match them
+        window = _activation_window(shape_variant_activations_df, new_activations['date'])
+        if window is not None:
+            window_start, window_stop = window
+            history_window = shape_variant_activations_df.iloc[window_start:window_stop]
+        else:
+            history_window = shape_variant_activations_df
+
+        # Check which activations are already in shape_variant_activations_df
+        if encoded_activations is not None:
+            truly_new_activations = encoded_activations.add(new_activations)
+        elif not history_window.empty:
+            # Find activations that don't already exist
+            merged_activations_check = new_activations.merge(
+                history_window, 
+                on=['date', 'shape_variant_id', 'exception_type'], 
+                how='left', 
+                indicator=True
+            )
+            truly_new_activations = merged_activations_check[merged_activations_check['_merge'] == 'left_only'].drop('_merge', axis=1).reset_index(drop=True)
+        else:
+            truly_new_activations = new_activations
 
     # Add new activations to shape_variant_activations_df (handle empty DataFrames properly)
-    if not truly_new_activations.empty:
-        if shape_variant_activations_df.empty:
-            shape_variant_activations_df = truly_new_activations.copy()
-        else:
-            shape_variant_activations_df = pd.concat([shape_variant_activations_df, truly_new_activations], ignore_index=True)
+    if window is not None:
+        if not truly_new_activations.empty:
+            # Rows before and after the window keep their (sorted) place
+            updated_window = pd.concat([history_window, truly_new_activations], ignore_index=True)
+            updated_window = updated_window.sort_values(['date', 'shape_variant_id'])
+            shape_variant_activations_df = pd.concat([
+                shape_variant_activations_df.iloc[:window_start], 
+                updated_window, 
+                shape_variant_activations_df.iloc[window_stop:]
+            ], ignore_index=True)
+    else:
+        if not truly_new_activations.empty:
+            if shape_variant_activations_df.empty:
+                shape_variant_activations_df = truly_new_activations.copy()
+            else:
+                shape_variant_activations_df = pd.concat([shape_variant_activations_df, truly_new_activations], ignore_index=True)
 
-    shape_variant_activations_df.sort_values(['date', 'shape_variant_id'], inplace=True)
-    shape_variant_activations_df.reset_index(drop=True, inplace=True)
+        shape_variant_activations_df.sort_values(['date', 'shape_variant_id'], inplace=True)
+        shape_variant_activations_df.reset_index(drop=True, inplace=True)
 
     # Display results
     if show_progress:
@@ -265,4 +498,92 @@ def update_shape_variants_and_activations(shape_variant_data: pd.DataFrame,
         else:
             print("No new activations added")
 
-    return shape_variants_df, shape_variant_activations_df
\ No newline at end of file
+    if return_new:
+        return shape_variants_df, shape_variant_activations_df, truly_new_activations
+    return shape_variants_df, shape_variant_activations_df
+
+
+def expand_variant_activations(shape_variant_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Per-day activations of range-form shape variant data (see build_shape_variant_ranges).
+    
+    Args:
+        shape_variant_data: Range-form shape variant data with shape_variant_id
+        
+    Returns:
+        DataFrame with date, shape_variant_id and exception_type, sorted by date and shape_variant_id
+    """
+    is_range = shape_variant_data['weekday_mask'].notna()
+    ranges = shape_variant_data[is_range]
+    exceptions = shape_variant_data[~is_range][['date', 'shape_variant_id', 'exception_type']]
+    
+    positions, days = _expand_ranges(ranges)
+    variant_ids = ranges['shape_variant_id'].to_numpy(dtype='int64')[positions]
+    
+    # A calendar exception replaces the range's activation of the same variant on its date
+    exception_days = pd.to_datetime(exceptions['date']).to_numpy(dtype='datetime64[D]').astype('int64')
+    exception_keys = exceptions['shape_variant_id'].to_numpy(dtype='int64') * 1_000_000 + exception_days
+    keep = ~np.isin(variant_ids * 1_000_000 + days, exception_keys)
+    
+    range_activations = pd.DataFrame({
+        'date': np.datetime_as_string(days[keep].astype('datetime64[D]')).astype(object),
+        'shape_variant_id': variant_ids[keep],
+        'exception_type': np.nan
+    })
+    activations = pd.concat([range_activations, exceptions], ignore_index=True)
+    return activations.sort_values(['date', 'shape_variant_id'], kind='stable').reset_index(drop=True)
+
+
+def _activation_window(shape_variant_activations_df: pd.DataFrame, dates: pd.Series) -> Optional[tuple]:
+    """
+    Row positions of the activations dated between the first and last of the given dates.
+    
+    Returns:
+        Tuple of (start, stop) positions, or None if the activations are empty 
+        or not sorted by date (as update_shape_variants_and_activations leaves them)
+    """
+    if shape_variant_activations_df.empty or dates.empty:
+        return None
+    history_dates = shape_variant_activations_df['date']
+    if not history_dates.is_monotonic_increasing:
+        return None
+    history_dates = history_dates.to_numpy()
+    start = int(np.searchsorted(history_dates, dates.min(), side='left'))
+    stop = int(np.searchsorted(history_dates, dates.max(), side='right'))
+    return start, stop
+
+
+def _to_dates(values: pd.Series) -> pd.Series:
+    """Parse GTFS dates (YYYYMMDD), leaving already parsed dates as they are."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values.astype(str), format='%Y%m%d')
+
+
+def _first_active_dates(start_dates: pd.Series, end_dates: pd.Series, weekday_masks: np.ndarray) -> pd.Series:
+    """First date of each interval falling on an active weekday (NaT if there is none)."""
+    first_dates = pd.Series(pd.NaT, index=start_dates.index, dtype='datetime64[ns]')
+    for offset in range(6, -1, -1):
+        candidates = start_dates + pd.Timedelta(days=offset)
+        active = (((weekday_masks >> candidates.dt.weekday.to_numpy()) & 1) == 1) & (candidates <= end_dates).to_numpy()
+        first_dates = first_dates.mask(active, candidates)
+    return first_dates
+
+
+def _expand_ranges(ranges_df: pd.DataFrame) -> tuple:
+    """
+    Expand start_date/end_date/weekday_mask ranges into their active days.
+    
+    Returns:
+        Tuple of (row position of each day, day numbers counted from 1970-01-01)
+    """
+    starts = ranges_df['start_date'].to_numpy(dtype='datetime64[D]').astype('int64')
+    ends = ranges_df['end_date'].to_numpy(dtype='datetime64[D]').astype('int64')
+    masks = ranges_df['weekday_mask'].to_numpy(dtype='int64')
+    
+    lengths = np.maximum(ends - starts + 1, 0)
+    positions = np.repeat(np.arange(len(ranges_df)), lengths)
+    days = starts[positions] + (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    # 1970-01-01 was a Thursday, so day + 3 is 0 on Mondays (mod 7)
+    active = ((masks[positions] >> ((days + 3) % 7)) & 1) == 1
+    return positions[active], days[active]
@@ -3,11 +3,14 @@ Shape data management functions for transit data processing.
 Fixed to avoid pandas concatenation warnings.
 """
 import pandas as pd
-from typing import Set, List
+from typing import Set, List, Optional
+
+from .key_index import ProcessedKeyIndex
 
 
 def update_shapes_from_variants(shapes_df: pd.DataFrame, shape_variant_data: pd.DataFrame, 
-                               shapes_txt: pd.DataFrame, show_progress: bool = True) -> pd.DataFrame:
+                               shapes_txt: pd.DataFrame, show_progress: bool = True,
+                               key_index: Optional[ProcessedKeyIndex] = None) -> pd.DataFrame:
     """
     Update shapes_df with any missing shape_ids from shape_variant_data.
     
@@ -16,6 +19,8 @@ def update_shapes_from_variants(shapes_df: pd.DataFrame, shape_variant_data: pd.
         shape_variant_data: DataFrame containing shape variant data with shape_id column
         shapes_txt: Source shapes data from GTFS
         show_progress: Whether to show progress messages
+        key_index: Key index describing shapes_df. If given, it is used instead of 
+                   scanning shapes_df and is updated with the added shape_ids.
         
     Returns:
         Updated shapes DataFrame with new shapes added
@@ -23,14 +28,8 @@ def update_shapes_from_variants(shapes_df: pd.DataFrame, shape_variant_data: pd.
     # Get all shape_ids from variant data
     variant_shape_ids = set(shape_variant_data['shape_id'].unique())
     
-    # Get existing shape_ids in shapes_df
-    if shapes_df.empty:
-        existing_shape_ids = set()
-    else:
-        existing_shape_ids = set(shapes_df['shape_id'].unique())
-    
     # Find missing shape_ids
-    missing_shape_ids = variant_shape_ids - existing_shape_ids
+    missing_shape_ids = _find_missing_shape_ids(shapes_df, variant_shape_ids, key_index)
     
     if not missing_shape_ids:
         if show_progress:
@@ -68,6 +67,9 @@ def update_shapes_from_variants(shapes_df: pd.DataFrame, shape_variant_data: pd.
         # Sort by shape_id and shape_pt_sequence for consistency
         updated_shapes_df = updated_shapes_df.sort_values(['shape_id', 'shape_pt_sequence']).reset_index(drop=True)
         
+        if key_index is not None:
+            key_index.add_shape_ids(found_shape_ids)
+        
         if show_progress:
             print(f"Added {len(missing_shapes)} shape records to shapes_df.")
             print(f"New shapes_df shape: {updated_shapes_df.shape}")
@@ -77,30 +79,33 @@ def update_shapes_from_variants(shapes_df: pd.DataFrame, shape_variant_data: pd.
     return shapes_df
 
 
-def validate_shape_integrity(shapes_df: pd.DataFrame, shape_variant_data: pd.DataFrame) -> dict:
+def validate_shape_integrity(shapes_df: pd.DataFrame, shape_variant_data: pd.DataFrame,
+                             key_index: Optional[ProcessedKeyIndex] = None) -> dict:
     """
     Validate that all shape_ids in shape_variant_data exist in shapes_df.
     
     Args:
         shapes_df: Shapes DataFrame
         shape_variant_data: Shape variant data DataFrame
+        key_index: Key index describing shapes_df. If given, only the variant 
+                   shape_ids are looked up and shapes_df is not scanned.
         
     Returns:
         Dictionary with validation results
     """
     variant_shape_ids = set(shape_variant_data['shape_id'].unique())
     
-    if shapes_df.empty:
-        existing_shape_ids = set()
-    else:
-        existing_shape_ids = set(shapes_df['shape_id'].unique())
+    missing_shape_ids = _find_missing_shape_ids(shapes_df, variant_shape_ids, key_index)
     
-    missing_shape_ids = variant_shape_ids - existing_shape_ids
+    if key_index is not None:
+        existing_count = len(key_index.shape_ids)
+    else:
+        existing_count = shapes_df['shape_id'].nunique()
     
     validation_result = {
         'is_valid': len(missing_shape_ids) == 0,
         'total_variant_shapes': len(variant_shape_ids),
-        'existing_shapes': len(existing_shape_ids),
+        'existing_shapes': existing_count,
         'missing_shape_ids': sorted(list(missing_shape_ids)),
         'missing_count': len(missing_shape_ids)
     }
@@ -108,6 +113,18 @@ def validate_shape_integrity(shapes_df: pd.DataFrame, shape_variant_data: pd.Dat
     return validation_result
 
 
+def _find_missing_shape_ids(shapes_df: pd.DataFrame, shape_ids: Set[str],
+                            key_index: Optional[ProcessedKeyIndex] = None) -> Set[str]:
+    """Return the shape_ids that are not in shapes_df, using the key index if given."""
+    if key_index is not None:
+        return key_index.missing_shape_ids(shape_ids)
+    
+    if shapes_df.empty:
+        return set(shape_ids)
+    
+    return set(shape_ids) - set(shapes_df['shape_id'].unique())
+
+
 def get_shape_statistics(shapes_df: pd.DataFrame) -> dict:
     """
     Get statistics about the shapes DataFrame.
@@ -0,0 +1,296 @@
+"""
+SQLite backend for the processed transit data.
+
+Stores the processed tables in one database file with indexes on the lookup
+keys. Each processed date is committed in a single transaction as a set of
+incremental upserts, so a crash never leaves the tables out of step with each
+other, and nothing is rewritten in full.
+"""
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from .config import Config
+from .data_loader import (
+    PROCESSED_TABLES, PROCESSED_TABLE_DTYPES, PROCESSED_TABLE_DATE_COLUMNS,
+    load_processed_data
+)
+
+
+# Column definitions per table; the column order matches the CSV files
+TABLE_SCHEMAS = {
+    'shapes': [
+        ('shape_id', 'TEXT'), ('shape_pt_lat', 'REAL'), ('shape_pt_lon', 'REAL'),
+        ('shape_pt_sequence', 'INTEGER'), ('shape_dist_traveled', 'REAL'), ('shape_bkk_ref', 'TEXT')
+    ],
+    'routes': [
+        ('route_id', 'TEXT'), ('agency_id', 'TEXT'), ('route_short_name', 'TEXT'),
+        ('route_type', 'INTEGER'), ('route_color', 'TEXT'), ('route_text_color', 'TEXT')
+    ],
+    'route_versions': [
+        ('route_id', 'TEXT'), ('main_shape_id', 'TEXT'), ('trip_headsign', 'TEXT'),
+        ('direction_id', 'INTEGER'), ('route_desc', 'TEXT'), ('valid_from', 'TEXT'), ('valid_to', 'TEXT'),
+        ('parent_version_id', 'INTEGER'), ('note', 'TEXT'), ('version_id', 'INTEGER PRIMARY KEY')
+    ],
+    'shape_variants': [
+        ('shape_variant_id', 'INTEGER PRIMARY KEY'), ('version_id', 'INTEGER'), ('shape_id', 'TEXT'),
+        ('trip_headsign', 'TEXT'), ('is_main', 'INTEGER'), ('note', 'TEXT')
+    ],
+    'shape_variant_activations': [
+        ('date', 'TEXT'), ('shape_variant_id', 'INTEGER'), ('exception_type', 'REAL')
+    ],
+    'temporary_changes': [
+        ('detour_id', 'TEXT'), ('route_id', 'TEXT'), ('start_date', 'TEXT'), ('end_date', 'TEXT'),
+        ('affects_version_id', 'INTEGER'), ('description', 'TEXT')
+    ]
+}
+
+TABLE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_shapes_shape_id ON shapes (shape_id, shape_pt_sequence)',
+    'CREATE INDEX IF NOT EXISTS idx_routes_route_id ON routes (route_id)',
+    'CREATE INDEX IF NOT EXISTS idx_route_versions_key ON route_versions (route_id, direction_id, valid_to)',
+    'CREATE INDEX IF NOT EXISTS idx_shape_variants_key ON shape_variants (version_id, shape_id, trip_headsign, is_main)',
+    'CREATE INDEX IF NOT EXISTS idx_activations_date ON shape_variant_activations (date, shape_variant_id)',
+    'CREATE INDEX IF NOT EXISTS idx_activations_variant ON shape_variant_activations (shape_variant_id)'
+]
+
+# Tables whose upserts replace existing rows with the same primary key
+UPSERT_TABLES = {'route_versions', 'shape_variants'}
+
+
+class SQLiteProcessedStore:
+    """Processed tables in an SQLite database with transactional per-date commits."""
+
+    def __init__(self, db_path: Optional[str] = None, data_folder: Optional[str] = None):
+        """
+        Open (and create if needed) the processed data database.
+
+        Args:
+            db_path: Path of the database file. If None, uses Config.SQLITE_FILE in data_folder.
+            data_folder: Processed data folder, used when db_path is None.
+                         If None, uses auto-detected path.
+        """
+        if db_path is None:
+            if data_folder is None:
+                data_folder = Config.get_default_processed_data_folder()
+            db_path = os.path.join(data_folder, Config.SQLITE_FILE)
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self._create_schema()
+        self._tables: Dict[str, pd.DataFrame] = {}
+
+    def _create_schema(self) -> None:
+        """Create tables and indexes if they do not exist."""
+        with self.conn:
+            for name, columns in TABLE_SCHEMAS.items():
+                column_defs = ', '.join(f'{col} {col_type}' for col, col_type in columns)
+                self.conn.execute(f'CREATE TABLE IF NOT EXISTS {name} ({column_defs})')
+            for statement in TABLE_INDEXES:
+                self.conn.execute(statement)
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS processed_dates (date TEXT PRIMARY KEY, committed_at TEXT)'
+            )
+
+    def close(self) -> None:
+        """Close the database connection."""
+        self.conn.close()
+
+    # Reading
+
+    def table(self, name: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Read a processed table with the same dtypes as the CSV loader.
+
+        Args:
+            name: Table name, one of PROCESSED_TABLES
+            columns: Columns to read. If None, reads all columns.
+
+        Returns:
+            DataFrame with the table data
+        """
+        if name in self._tables:
+            df = self._tables[name]
+            return df if columns is None else df[columns]
+
+        df = self._query(name, columns)
+        if columns is None:
+            self._tables[name] = df
+        return df
+
+    def _query(self, name: str, columns: Optional[List[str]] = None, where: str = '',
+               params: Iterable = ()) -> pd.DataFrame:
+        """Run a SELECT on one table and restore the CSV loader's dtypes."""
+        if name not in TABLE_SCHEMAS:
+            raise ValueError(f"Unknown processed table: {name}")
+        if columns is None:
+            columns = [col for col, _ in TABLE_SCHEMAS[name]]
+
+        query = f"SELECT {', '.join(columns)} FROM {name} {where}"
+        df = pd.read_sql_query(query, self.conn, params=list(params))
+        return self._restore_dtypes(name, df)
+
+    @staticmethod
+    def _restore_dtypes(name: str, df: pd.DataFrame) -> pd.DataFrame:
+        dtypes = {col: dtype for col, dtype in PROCESSED_TABLE_DTYPES[name].items() if col in df.columns}
+        df = df.astype(dtypes)
+        for col in PROCESSED_TABLE_DATE_COLUMNS.get(name, []):
+            if col in df.columns:
+                df[col] = pd.to_datetime(df[col])
+        return df
+
+    @property
+    def shapes(self) -> pd.DataFrame:
+        """Shapes table."""
+        return self.table('shapes')
+
+    @property
+    def routes(self) -> pd.DataFrame:
+        """Routes table."""
+        return self.table('routes')
+
+    @property
+    def route_versions(self) -> pd.DataFrame:
+        """Route versions table."""
+        return self.table('route_versions')
+
+    @property
+    def shape_variants(self) -> pd.DataFrame:
+        """Shape variants table."""
+        return self.table('shape_variants')
+
+    @property
+    def shape_variant_activations(self) -> pd.DataFrame:
+        """Shape variant activations table."""
+        return self.table('shape_variant_activations')
+
+    @property
+    def temporary_changes(self) -> pd.DataFrame:
+        """Temporary changes table."""
+        return self.table('temporary_changes')
+
+    def load_processed_data(self) -> tuple:
+        """Read all tables, in the same order as data_loader.load_processed_data."""
+        return tuple(self.table(name) for name in PROCESSED_TABLES)
+
+    def shapes_for(self, shape_ids: Iterable[str]) -> pd.DataFrame:
+        """
+        Get the points of the given shapes with an indexed lookup.
+
+        Args:
+            shape_ids: Shape ids to look up
+
+        Returns:
+            DataFrame with the shape points of the requested shapes
+        """
+        shape_ids = list(shape_ids)
+        if not shape_ids:
+            return self._query('shapes', where='WHERE 0')
+        placeholders = ', '.join('?' * len(shape_ids))
+        return self._query(
+            'shapes', where=f'WHERE shape_id IN ({placeholders}) ORDER BY shape_id, shape_pt_sequence',
+            params=shape_ids
+        )
+
+    def route(self, route_id: str) -> Dict[str, pd.DataFrame]:
+        """
+        Get all processed data of one route with indexed lookups.
+
+        Args:
+            route_id: Route id to look up
+
+        Returns:
+            Dictionary with the route's routes, route_versions, shape_variants and shapes rows
+        """
+        versions = self._query('route_versions', where='WHERE route_id = ?', params=[route_id])
+        version_ids = [int(v) for v in versions['version_id'].dropna()]
+        placeholders = ', '.join('?' * len(version_ids)) or 'NULL'
+        variants = self._query('shape_variants', where=f'WHERE version_id IN ({placeholders})', params=version_ids)
+
+        return {
+            'routes': self._query('routes', where='WHERE route_id = ?', params=[route_id]).drop_duplicates(),
+            'route_versions': versions,
+            'shape_variants': variants,
+            'shapes': self.shapes_for(variants['shape_id'].dropna().unique())
+        }
+
+    def get_processed_dates(self) -> List[str]:
+        """Dates whose changes have been committed, in date order."""
+        return [row[0] for row in self.conn.execute('SELECT date FROM processed_dates ORDER BY date')]
+
+    # Writing
+
+    def commit_date(self, date: str, changes: Dict[str, pd.DataFrame]) -> None:
+        """
+        Apply one date's changes in a single transaction.
+
+        Rows of route_versions and shape_variants replace existing rows with the
+        same version_id / shape_variant_id; rows of the other tables are appended.
+        Either all changes and the processed_dates entry are stored, or none.
+
+        Args:
+            date: Processed date string (e.g., '20131018')
+            changes: New or changed rows per table name
+        """
+        with self.conn:
+            for name, df in changes.items():
+                self._write_rows(name, df)
+            self.conn.execute(
+                'INSERT OR REPLACE INTO processed_dates (date, committed_at) VALUES (?, ?)',
+                (date, datetime.now().isoformat())
+            )
+
+        # Cached full tables are now stale
+        self._tables = {}
+
+    def _write_rows(self, name: str, df: pd.DataFrame) -> None:
+        """Insert (or replace by primary key) rows inside the current transaction."""
+        if df is None or df.empty:
+            return
+
+        columns = [col for col, _ in TABLE_SCHEMAS[name]]
+        rows = self._to_records(df.reindex(columns=columns))
+        verb = 'INSERT OR REPLACE' if name in UPSERT_TABLES else 'INSERT'
+        placeholders = ', '.join('?' * len(columns))
+        self.conn.executemany(f"{verb} INTO {name} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+    @staticmethod
+    def _to_records(df: pd.DataFrame) -> List[tuple]:
+        """Convert a DataFrame into SQLite-compatible row tuples (None for missing values)."""
+        converted = {}
+        for col in df.columns:
+            series = df[col]
+            if pd.api.types.is_datetime64_any_dtype(series):
+                values = series.dt.strftime('%Y-%m-%d')
+            else:
+                values = series
+            values = values.astype(object).where(values.notna(), None)
+            converted[col] = [v.item() if isinstance(v, np.generic) else v for v in values]
+        return list(zip(*converted.values()))
+
+    def import_dataframes(self, tables: Dict[str, pd.DataFrame]) -> None:
+        """
+        Replace the content of the given tables in one transaction.
+
+        Args:
+            tables: Full table data per table name
+        """
+        with self.conn:
+            for name, df in tables.items():
+                self.conn.execute(f'DELETE FROM {name}')
+                self._write_rows(name, df)
+        self._tables = {}
+
+    def import_csv(self, data_folder: Optional[str] = None) -> None:
+        """
+        Import the processed CSV files into the database, replacing its content.
+
+        Args:
+            data_folder: Processed data folder. If None, uses auto-detected path.
+        """
+        self.import_dataframes(dict(zip(PROCESSED_TABLES, load_processed_data(data_folder))))
@@ -0,0 +1,257 @@
+"""
+Declarative processing stage graph with disk-memoized stage outputs.
+
+Each stage names the stages (or external inputs) it consumes. A stage's cache
+key is derived from its own code, its inputs' keys and the fingerprints of the
+external inputs, so changing one stage's code only invalidates that stage and
+the stages depending on it. Stages whose inputs are ready run concurrently,
+and stages whose outputs are cached are not run at all - nor are their inputs,
+if nothing else needs them.
+"""
+import os
+import inspect
+import hashlib
+import pickle
+import sys
+import types
+import pandas as pd
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+from .config import Config
+
+
+class Stage:
+    """One node of a StageGraph."""
+
+    def __init__(self, name: str, func: Callable, inputs: Sequence[str] = (), cache: bool = True,
+                 code: Optional[Sequence[Any]] = None):
+        """
+        Define a stage.
+
+        Args:
+            name: Stage name, also the name its output is available under
+            func: Function called with the inputs as keyword arguments
+            inputs: Names of the stages or external inputs passed to func
+            cache: Whether the output is memoized on disk
+            code: Functions or modules whose source code is part of the cache key.
+                  A module also brings in the modules of its own package it
+                  imports, so helpers and constants it uses are covered.
+                  If None, only func is used.
+        """
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.cache = cache
+        self.code_hash = _hash_code(code if code is not None else [func])
+
+
+class StageGraph:
+    """A set of stages evaluated on demand, with outputs cached on disk."""
+
+    def __init__(self, stages: Iterable[Stage], cache_folder: Optional[str] = None,
+                 max_workers: int = 4, max_partitions: int = Config.STAGE_CACHE_MAX_PARTITIONS):
+        """
+        Build the graph.
+
+        Args:
+            stages: Stages of the graph; inputs not produced by a stage are external inputs
+            cache_folder: Folder for the memoized outputs. If None, nothing is cached.
+            max_workers: Number of stages that may run at once
+            max_partitions: Number of partitions (e.g. dates) kept in the cache per stage
+        """
+        self.stages: Dict[str, Stage] = {stage.name: stage for stage in stages}
+        self.cache_folder = cache_folder
+        self.max_workers = max_workers
+        self.max_partitions = max_partitions
+
+    def keys(self, fingerprints: Dict[str, Optional[str]]) -> Dict[str, Optional[str]]:
+        """
+        Compute the cache key of every stage.
+
+        Args:
+            fingerprints: Fingerprint of each external input. None (or a missing 
+                          input) means unknown, which disables caching of all 
+                          stages depending on it.
+
+        Returns:
+            Cache key per stage name (None if not cacheable)
+        """
+        keys: Dict[str, Optional[str]] = dict(fingerprints)
+
+        def key_of(name: str) -> Optional[str]:
+            if name in keys:
+                return keys[name]
+            if name not in self.stages:
+                # External input not given in this run
+                return None
+            stage = self.stages[name]
+            input_keys = [key_of(input_name) for input_name in stage.inputs]
+            if any(key is None for key in input_keys):
+                keys[name] = None
+            else:
+                parts = [name, stage.code_hash, pd.__version__] + input_keys
+                keys[name] = hashlib.sha256('\n'.join(parts).encode()).hexdigest()[:32]
+            return keys[name]
+
+        for name in self.stages:
+            key_of(name)
+        return {name: keys[name] for name in self.stages}
+
+    def run(self, targets: Sequence[str], inputs: Dict[str, Any], fingerprints: Dict[str, Optional[str]],
+            known: Optional[Dict[str, Any]] = None, partition: str = '',
+            show_progress: bool = False) -> Dict[str, Any]:
+        """
+        Evaluate the target stages.
+
+        Args:
+            targets: Names of the stages whose outputs are wanted
+            inputs: Values of the external inputs
+            fingerprints: Fingerprints of the external inputs (see keys)
+            known: Stage outputs already available in memory; they are not recomputed
+            partition: Cache partition of this run (e.g. the date), used for eviction
+            show_progress: Whether to print which stages ran and which were cached
+
+        Returns:
+            Dictionary with the output of each target stage
+        """
+        keys = self.keys(fingerprints)
+        values: Dict[str, Any] = dict(inputs)
+        values.update(known or {})
+
+        # Walk back from the targets, stopping at values that are known or cached
+        to_run: List[str] = []
+        visited = set()
+
+        def plan(name: str) -> None:
+            if name in visited or name in values:
+                return
+            visited.add(name)
+            stage = self.stages[name]
+            cached = self._read_cache(stage, keys[name], partition)
+            if cached is not None:
+                values[name] = cached[0]
+                if show_progress:
+                    print(f"   [cached] {name}")
+                return
+            for input_name in stage.inputs:
+                plan(input_name)
+            to_run.append(name)
+
+        for target in targets:
+            plan(target)
+
+        if to_run:
+            self._execute(to_run, values, keys, partition, show_progress)
+
+        return {target: values[target] for target in targets}
+
+    def _execute(self, to_run: List[str], values: Dict[str, Any], keys: Dict[str, Optional[str]],
+                 partition: str, show_progress: bool) -> None:
+        """Run the planned stages, each as soon as its inputs are available."""
+        pending = list(to_run)
+        running: Dict[Future, str] = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [name for name in pending
+                         if all(input_name in values for input_name in self.stages[name].inputs)]
+                for name in ready:
+                    pending.remove(name)
+                    stage = self.stages[name]
+                    kwargs = {input_name: values[input_name] for input_name in stage.inputs}
+                    running[executor.submit(stage.func, **kwargs)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    values[name] = future.result()
+                    if show_progress:
+                        print(f"   [ran] {name}")
+                    self._write_cache(self.stages[name], keys[name], partition, values[name])
+
+    # Disk cache
+
+    def _cache_path(self, stage: Stage, key: str, partition: str) -> str:
+        return os.path.join(self.cache_folder, stage.name, f'{partition}_{key}.pkl')
+
+    def _read_cache(self, stage: Stage, key: Optional[str], partition: str) -> Optional[tuple]:
+        """Return (output,) if the stage output is cached, otherwise None."""
+        if not stage.cache or key is None or self.cache_folder is None:
+            return None
+        path = self._cache_path(stage, key, partition)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return (pickle.load(f),)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, OSError):
+            print(f"Warning: Could not read cached output of stage {stage.name}. Recomputing it.")
+            return None
+
+    def _write_cache(self, stage: Stage, key: Optional[str], partition: str, output: Any) -> None:
+        """Store a stage output and evict outdated entries."""
+        if not stage.cache or key is None or self.cache_folder is None:
+            return
+        stage_folder = os.path.join(self.cache_folder, stage.name)
+        os.makedirs(stage_folder, exist_ok=True)
+        path = self._cache_path(stage, key, partition)
+
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Warning: Could not cache output of stage {stage.name}: {e}")
+            return
+
+        self._evict(stage_folder, partition, os.path.basename(path))
+
+    def _evict(self, stage_folder: str, partition: str, keep: str) -> None:
+        """Drop other keys of the same partition, and the least recently written partitions."""
+        entries = [entry for entry in os.scandir(stage_folder) if entry.name.endswith('.pkl')]
+        for entry in entries:
+            if entry.name != keep and entry.name.startswith(f'{partition}_'):
+                os.remove(entry.path)
+
+        entries = sorted((entry for entry in os.scandir(stage_folder) if entry.name.endswith('.pkl')),
+                         key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+        for entry in entries[self.max_partitions:]:
+            os.remove(entry.path)
+
+
+def _hash_code(code: Sequence[Any]) -> str:
+    """Hash the source code of the given functions and modules (bytecode if the source is unavailable)."""
+    digest = hashlib.sha256()
+    for item in code:
+        if isinstance(item, types.ModuleType):
+            for module in _module_closure(item):
+                digest.update(module.__name__.encode())
+                digest.update(_source(module))
+        else:
+            digest.update(_source(item))
+    return digest.hexdigest()[:16]
+
+
+def _source(item: Any) -> bytes:
+    try:
+        return inspect.getsource(item).encode()
+    except (OSError, TypeError):
+        return item.__code__.co_code if hasattr(item, '__code__') else repr(item).encode()
+
+
+def _module_closure(module: types.ModuleType) -> List[types.ModuleType]:
+    """The module and the modules of its package it imports, directly or not, sorted by name."""
+    package = module.__package__
+    found = {module.__name__: module}
+    to_visit = [module]
+    while to_visit:
+        for value in vars(to_visit.pop()).values():
+            name = value.__name__ if isinstance(value, types.ModuleType) else getattr(value, '__module__', None)
+            if (not package or not isinstance(name, str) or name in found
+                    or name.rpartition('.')[0] != package or name not in sys.modules):
+                continue
+            found[name] = sys.modules[name]
+            to_visit.append(found[name])
+    return [found[name] for name in sorted(found)]
@@ -0,0 +1,176 @@
+"""
+Streaming handoff from the feed downloader to the processing pipeline.
+
+Feeds are queued for processing as soon as their download finishes and
+verifies. The feed-only stages run concurrently for any queued feed, while
+the state-merge stages run strictly in date order.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Optional
+
+from .pipeline import TransitDataProcessor
+from .processing_tracker import ProcessingTracker
+
+
+class StreamingFeedProcessor:
+    """Processes feeds while the downloader is still fetching older/newer ones."""
+
+    def __init__(self, data_folder: Optional[str] = None, raw_data_folder: Optional[str] = None,
+                 use_tracker: bool = True, prepare_workers: int = 2, save_data: bool = True,
+                 show_progress: bool = False):
+        """
+        Initialize the streaming processor.
+
+        Args:
+            data_folder: Path to processed data folder. If None, uses auto-detected path.
+            raw_data_folder: Path to raw data folder. If None, uses auto-detected path.
+            use_tracker: Whether to record each merged feed in the processing history.
+            prepare_workers: Number of feeds whose feed-only stages may run at once.
+            save_data: Whether to save processed data after each merged feed.
+            show_progress: Whether to show internal processing steps.
+        """
+        self.processor = TransitDataProcessor(data_folder, raw_data_folder)
+        self.save_data = save_data
+        self.show_progress = show_progress
+        self.tracker = ProcessingTracker(data_folder) if use_tracker else None
+
+        self._executor = ThreadPoolExecutor(max_workers=prepare_workers)
+        self._condition = threading.Condition()
+        self._expected = set()
+        self._prepared: Dict[str, Future] = {}
+        # Never merge a feed older than one already merged into the processed data
+        self._last_merged: Optional[str] = (
+            self.tracker.history['last_successful_date'] if self.tracker is not None else None
+        )
+        self._closed = False
+        self.results: Dict[str, Dict] = {}
+
+        self._merge_thread = threading.Thread(target=self._merge_loop, daemon=True)
+        self._merge_thread.start()
+
+    def expect(self, dates: List[str]) -> None:
+        """
+        Announce dates that are going to be downloaded.
+
+        A feed is only merged once every earlier expected date has either been
+        merged or reported as failed, so announcing the full download plan up
+        front is what enforces date order.
+
+        Args:
+            dates: List of date strings in YYYYMMDD format
+        """
+        with self._condition:
+            self._expected.update(
+                date for date in dates
+                if self._last_merged is None or date > self._last_merged
+            )
+            self._condition.notify_all()
+
+    def feed_ready(self, date: str) -> None:
+        """
+        Queue a downloaded and verified feed for processing.
+
+        Args:
+            date: Date string in YYYYMMDD format
+        """
+        with self._condition:
+            if self._last_merged is not None and date <= self._last_merged:
+                print(f"⚠ Feed {date} arrived after {self._last_merged} was merged, skipping")
+                self._expected.discard(date)
+                self._condition.notify_all()
+                return
+
+            self._expected.add(date)
+            self._prepared[date] = self._executor.submit(
+                self.processor.prepare_feed, date, self.show_progress
+            )
+            self._prepared[date].add_done_callback(lambda _: self._notify())
+            self._condition.notify_all()
+
+    def feed_failed(self, date: str, error: str = '') -> None:
+        """
+        Report that a feed could not be downloaded, so later feeds stop waiting for it.
+
+        Args:
+            date: Date string in YYYYMMDD format
+            error: Error message from the downloader
+        """
+        with self._condition:
+            self._expected.discard(date)
+            self._condition.notify_all()
+
+    def close(self, wait: bool = True) -> Dict[str, Dict]:
+        """
+        Stop accepting feeds and finish merging the queued ones.
+
+        Args:
+            wait: Whether to block until all queued feeds are merged
+
+        Returns:
+            Dictionary with processing results keyed by date
+        """
+        with self._condition:
+            # Dates that were announced but never arrived will not arrive anymore
+            self._expected.intersection_update(self._prepared.keys())
+            self._closed = True
+            self._condition.notify_all()
+
+        if wait:
+            self._merge_thread.join()
+            self._executor.shutdown(wait=True)
+            self.processor.close()
+
+        return self.results
+
+    def _notify(self) -> None:
+        """Wake up the merge thread."""
+        with self._condition:
+            self._condition.notify_all()
+
+    def _next_mergeable(self) -> Optional[str]:
+        """Return the oldest expected date if its feed is prepared, otherwise None."""
+        if not self._expected:
+            return None
+
+        next_date = min(self._expected)
+        future = self._prepared.get(next_date)
+        if future is not None and future.done():
+            return next_date
+        return None
+
+    def _merge_loop(self) -> None:
+        """Merge prepared feeds one by one in date order."""
+        while True:
+            with self._condition:
+                next_date = self._next_mergeable()
+                while next_date is None:
+                    if self._closed and not self._expected:
+                        return
+                    self._condition.wait()
+                    next_date = self._next_mergeable()
+
+                future = self._prepared.pop(next_date)
+                self._expected.discard(next_date)
+
+            self._merge_one(next_date, future)
+
+    def _merge_one(self, date: str, future: Future) -> None:
+        """Run the state-merge stages for one prepared feed and record the outcome."""
+        try:
+            feed_data = future.result()
+            self.processor.merge_feed(feed_data, save_data=self.save_data, show_progress=self.show_progress)
+            self.results[date] = {'status': 'success', 'data': None, 'error': None}
+            print(f"✓ Processed {date}")
+        except Exception as e:
+            self.results[date] = {'status': 'failed', 'data': None, 'error': str(e)}
+            print(f"✗ Failed to process {date}: {e}")
+
+        with self._condition:
+            self._last_merged = date
+
+        if self.tracker is not None:
+            succeeded = self.results[date]['status'] == 'success'
+            self.tracker.record_processing_session(
+                date, date, [date] if succeeded else [], [] if succeeded else [date]
+            )
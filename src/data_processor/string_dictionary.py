@@ -0,0 +1,155 @@
+"""
+Persistent, append-only string interning dictionary.
+
+Maps the strings of the id and headsign columns (Config.INTERNED_COLUMNS) of
+the columnar files (see ProcessedDataset) to int32 codes shared by all
+columnar tables of a processed data folder, so a code stays valid when a
+table's columnar copy is rebuilt. The CSV files and the pipeline's frames
+keep plain strings. Codes are never reassigned: new strings are appended to
+the dictionary file, one JSON string per line, and the code of a string is
+its line number. Appends are serialized across processes by a lock file, and
+each appender reads the strings appended before it under that lock.
+"""
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from .config import Config
+
+
+class StringDictionary:
+    """Append-only mapping of strings to int32 codes, stored next to the processed data."""
+
+    def __init__(self, data_folder: Optional[str] = None):
+        """
+        Initialize the dictionary and load its saved strings.
+
+        Args:
+            data_folder: Processed data folder the dictionary file is stored in.
+                         If None, uses auto-detected path.
+        """
+        if data_folder is None:
+            data_folder = Config.get_default_processed_data_folder()
+
+        self.path = os.path.join(data_folder, Config.STRING_DICTIONARY_FILE)
+        self.strings: List[str] = []
+        self.codes: Dict[str, int] = {}
+        self._file_size = 0
+        self._lock = threading.Lock()
+        self._read_new_strings()
+
+    def __len__(self) -> int:
+        """Number of interned strings."""
+        return len(self.strings)
+
+    def encode(self, values: Iterable, add: bool = True) -> np.ndarray:
+        """
+        Get the codes of the given strings.
+
+        Args:
+            values: Strings to encode; missing values get code -1
+            add: Whether to intern strings that are not in the dictionary yet.
+                 If False, they get code -1.
+
+        Returns:
+            int32 array of codes
+        """
+        values = pd.Series(values, dtype=object)
+        uniques = values.dropna().unique()
+
+        with self._lock:
+            new_strings = [str(value) for value in uniques if str(value) not in self.codes] if add else []
+            if new_strings:
+                self._append(new_strings)
+            unique_codes = np.array([self.codes.get(str(value), -1) for value in uniques], dtype='int32')
+
+        codes = np.full(len(values), -1, dtype='int32')
+        present = values.notna().to_numpy()
+        codes[present] = unique_codes[pd.Index(uniques).get_indexer(values[present])]
+        return codes
+
+    def decode(self, codes: np.ndarray) -> pd.Series:
+        """
+        Get the strings of the given codes.
+
+        Args:
+            codes: Codes returned by encode; -1 decodes to a missing value
+
+        Returns:
+            Series of strings (object dtype)
+        """
+        codes = np.asarray(codes)
+        if len(codes) and codes.max() >= len(self.strings):
+            # Codes interned by another process since this one loaded the dictionary
+            with self._lock:
+                self._read_new_strings()
+        return pd.Series(pd.Categorical.from_codes(codes, self.strings)).astype(object)
+
+    def _append(self, new_strings: List[str]) -> None:
+        """Intern new strings and append them to the dictionary file (thread lock held)."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._file_lock():
+            # Strings appended by other processes keep their codes
+            self._read_new_strings()
+            new_strings = [string for string in dict.fromkeys(new_strings) if string not in self.codes]
+            if not new_strings:
+                return
+
+            data = ''.join(json.dumps(string) + '\n' for string in new_strings).encode()
+            with open(self.path, 'ab') as f:
+                # With the lock held, a last line without a newline is an interrupted append
+                f.truncate(self._file_size)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            # The strings are on the lines following those read, so their codes are those line numbers
+            for string in new_strings:
+                self.codes[string] = len(self.strings)
+                self.strings.append(string)
+            self._file_size += len(data)
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """Hold the dictionary's lock file, excluding appends by other processes."""
+        with open(self.path + '.lock', 'a+b') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _read_new_strings(self) -> None:
+        """Read the complete lines appended to the file since it was last read."""
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            f.seek(self._file_size)
+            data = f.read()
+
+        # A last line without a newline is an append still in flight (or an interrupted one)
+        complete = data[:data.rfind(b'\n') + 1]
+        for line in complete.splitlines():
+            string = json.loads(line)
+            self.codes[string] = len(self.strings)
+            self.strings.append(string)
+        self._file_size += len(complete)
@@ -0,0 +1,180 @@
+"""
+Persistent index of the shape variant keys.
+
+A shape variant is identified by (version_id, shape_id, trip_headsign,
+is_main). ShapeVariantIndex maps these keys to their shape_variant_id, so
+finding the existing variants of a date and assigning ids to new ones are
+dictionary probes instead of merges on four columns (one of them free text)
+against the full shape_variants table. New ids are allocated sequentially,
+continuing from the largest id, or from Config.START_SHAPE_VARIANT_ID.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional, Tuple
+
+from .config import Config
+from .key_index import content_hash
+
+VARIANT_KEY_COLUMNS = ['version_id', 'shape_id', 'trip_headsign', 'is_main']
+
+
+class ShapeVariantIndex:
+    """Mapping of shape variant keys to shape_variant_id, maintained as variants are added."""
+
+    def __init__(self):
+        """Initialize an empty index."""
+        self.ids: Dict[tuple, int] = {}
+        self.next_id = Config.START_SHAPE_VARIANT_ID
+        self.fingerprint: Dict[str, int] = {}
+
+    @classmethod
+    def from_variants(cls, shape_variants_df: pd.DataFrame) -> 'ShapeVariantIndex':
+        """
+        Build the index with a full scan of the shape variants table.
+
+        Args:
+            shape_variants_df: Shape variants DataFrame
+
+        Returns:
+            Populated ShapeVariantIndex
+        """
+        index = cls()
+        variant_ids = shape_variants_df['shape_variant_id'].to_numpy(dtype='int64', na_value=-1)
+        for key, variant_id in zip(_variant_keys(shape_variants_df), variant_ids.tolist()):
+            # Like the merge it replaces, a key listed twice resolves to its first id
+            index.ids.setdefault(key, variant_id)
+        if not shape_variants_df.empty:
+            index.next_id = int(shape_variants_df['shape_variant_id'].max()) + 1
+        index.fingerprint = cls.table_fingerprint(shape_variants_df)
+        return index
+
+    @classmethod
+    def load(cls, shape_variants_df: pd.DataFrame, data_folder: Optional[str] = None) -> 'ShapeVariantIndex':
+        """
+        Load the saved index, or rebuild it if it does not match the given table.
+
+        Args:
+            shape_variants_df: Shape variants DataFrame the index must describe
+            data_folder: Custom data folder path. If None, uses auto-detected path.
+
+        Returns:
+            ShapeVariantIndex consistent with the given table
+        """
+        path = cls.get_path(data_folder)
+        fingerprint = cls.table_fingerprint(shape_variants_df)
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    saved = json.load(f)
+                if saved.get('fingerprint') == fingerprint:
+                    index = cls()
+                    for version_id, shape_id, trip_headsign, is_main, variant_id in saved['variants']:
+                        index.ids[(version_id, shape_id, trip_headsign, is_main)] = variant_id
+                    index.next_id = saved['next_id']
+                    index.fingerprint = fingerprint
+                    return index
+            except (json.JSONDecodeError, KeyError, ValueError, IOError):
+                print("Warning: Could not read shape variant index file. Rebuilding it.")
+
+        return cls.from_variants(shape_variants_df)
+
+    def save(self, data_folder: Optional[str] = None) -> None:
+        """
+        Save the index next to the shape variants file.
+
+        Args:
+            data_folder: Custom data folder path. If None, uses auto-detected path.
+        """
+        path = self.get_path(data_folder)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        data = {
+            'fingerprint': self.fingerprint,
+            'next_id': self.next_id,
+            'variants': [list(key) + [variant_id] for key, variant_id in self.ids.items()]
+        }
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def get_path(data_folder: Optional[str] = None) -> str:
+        """Get the path of the shape variant index file."""
+        if data_folder is None:
+            data_folder = Config.get_default_processed_data_folder()
+        return os.path.join(data_folder, Config.VARIANT_INDEX_FILE)
+
+    @staticmethod
+    def table_fingerprint(shape_variants_df: pd.DataFrame) -> Dict[str, int]:
+        """Cheap fingerprint used to detect a table changed behind the index's back."""
+        return {
+            'rows': len(shape_variants_df),
+            'max_shape_variant_id': (int(shape_variants_df['shape_variant_id'].max())
+                                     if not shape_variants_df.empty else 0),
+            # Edits that keep the row count still change the keys
+            'content': content_hash(shape_variants_df, ['shape_variant_id'] + VARIANT_KEY_COLUMNS)
+        }
+
+    def refresh_fingerprint(self, shape_variants_df: pd.DataFrame) -> None:
+        """Record that the index now describes the given table."""
+        self.fingerprint = self.table_fingerprint(shape_variants_df)
+
+    def __len__(self) -> int:
+        """Number of indexed variants."""
+        return len(self.ids)
+
+    # Lookups
+
+    def lookup(self, variants_df: pd.DataFrame) -> np.ndarray:
+        """
+        Get the shape_variant_id of each row's key.
+
+        Args:
+            variants_df: DataFrame with version_id, shape_id, trip_headsign and is_main
+
+        Returns:
+            Array of shape_variant_ids, -1 for keys that are not indexed
+        """
+        return np.array([self.ids.get(key, -1) for key in _variant_keys(variants_df)], dtype='int64')
+
+    def assign(self, variants_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the shape_variant_id of each row's key, allocating ids to new keys.
+
+        New keys get sequential ids in row order, so the rows should be
+        distinct variants in order of first appearance.
+
+        Args:
+            variants_df: DataFrame with version_id, shape_id, trip_headsign and is_main
+
+        Returns:
+            Tuple of (shape_variant_ids, boolean array marking the rows that got a new id)
+        """
+        keys = _variant_keys(variants_df)
+        variant_ids = np.empty(len(keys), dtype='int64')
+        is_new = np.zeros(len(keys), dtype=bool)
+        for i, key in enumerate(keys):
+            variant_id = self.ids.get(key)
+            if variant_id is None:
+                variant_id = self.ids[key] = self.next_id
+                self.next_id += 1
+                is_new[i] = True
+            variant_ids[i] = variant_id
+        return variant_ids, is_new
+
+
+def _variant_keys(variants_df: pd.DataFrame) -> List[tuple]:
+    """Hashable keys of the rows, with ints for the id columns and None for missing values."""
+    keys = []
+    for version_id, shape_id, trip_headsign, is_main in variants_df[VARIANT_KEY_COLUMNS].itertuples(index=False):
+        keys.append((
+            None if pd.isna(version_id) else int(version_id),
+            None if pd.isna(shape_id) else shape_id,
+            None if pd.isna(trip_headsign) else trip_headsign,
+            None if pd.isna(is_main) else int(is_main)
+        ))
+    return keys
@@ -0,0 +1,115 @@
+import os
+import sys
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The package lives in src/ and is not installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from data_processor.data_loader import read_processed_table
+
+VERSION_COLUMNS = ['route_id', 'direction_id', 'main_shape_id', 'trip_headsign', 'route_desc', 'valid_from', 'valid_to']
+PROCESSED_TABLES = ['routes', 'route_versions', 'shape_variants', 'shape_variant_activations', 'shapes']
+
+
+def write_synthetic_feeds(raw_folder, seed, feed_count=8):
+    """
+    Write random GTFS feeds of a few routes, some as folders and some as zips.
+
+    Routes come and go, patterns change, services and exceptions overlap the
+    next feeds, so the feeds exercise new, closed and reopened versions.
+
+    Returns:
+        Sorted feed dates (YYYYMMDD)
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(raw_folder, exist_ok=True)
+    routes = [f'R{i}' for i in range(8)]
+    shapes = [f'S{i}' for i in range(8)]
+    headsigns = ['A', 'B', 'C']
+    patterns = {}
+    dates = sorted(set(pd.Timestamp('2014-01-01') + pd.to_timedelta(np.cumsum(rng.integers(3, 20, feed_count)), 'D')))
+
+    for feed_index, date in enumerate(dates):
+        present = [route for route in routes if rng.random() < 0.85]
+        routes_txt = "route_id,agency_id,route_short_name,route_type,route_color,route_text_color,route_desc\n"
+        for route in present:
+            routes_txt += f"{route},BKK,{route[1:]},3,FF0000,000000,{route} desc{feed_index % 2 if rng.random() < 0.2 else ''}\n"
+
+        calendar_txt = "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+        for service in range(4):
+            start = date + pd.Timedelta(days=int(rng.integers(-5, 10)))
+            end = start + pd.Timedelta(days=int(rng.integers(-1, 60)))
+            calendar_txt += f"V{service}," + ",".join(map(str, rng.integers(0, 2, 7))) + f",{start:%Y%m%d},{end:%Y%m%d}\n"
+        calendar_dates_txt = "service_id,date,exception_type\n"
+        for _ in range(5):
+            exception_date = date + pd.Timedelta(days=int(rng.integers(0, 45)))
+            calendar_dates_txt += f"V{rng.integers(0, 4)},{exception_date:%Y%m%d},{rng.integers(1, 3)}\n"
+
+        trips_txt = "route_id,service_id,trip_id,trip_headsign,direction_id,block_id,shape_id\n"
+        trip = 0
+        for route in present:
+            for direction in (0, 1):
+                if (route, direction) not in patterns or rng.random() < 0.3:
+                    patterns[route, direction] = (rng.choice(shapes), rng.choice(headsigns))
+                for _ in range(int(rng.integers(1, 4))):
+                    shape, headsign = (patterns[route, direction] if rng.random() < 0.7
+                                       else (rng.choice(shapes), rng.choice(headsigns)))
+                    trips_txt += f"{route},V{rng.integers(0, 4)},t{trip},{headsign},{direction},,{shape}\n"
+                    trip += 1
+
+        shapes_txt = "shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled\n"
+        for shape in shapes:
+            for point in range(1, 4):
+                shapes_txt += f"{shape},47.{point}{feed_index},19.{point},{point},{point * 10.0}\n"
+
+        files = {'routes.txt': routes_txt, 'calendar.txt': calendar_txt, 'calendar_dates.txt': calendar_dates_txt,
+                 'trips.txt': trips_txt, 'shapes.txt': shapes_txt}
+        name = date.strftime('%Y%m%d')
+        if feed_index % 2:
+            with zipfile.ZipFile(os.path.join(raw_folder, name + '.zip'), 'w') as archive:
+                for filename, text in files.items():
+                    archive.writestr(filename, text)
+        else:
+            os.makedirs(os.path.join(raw_folder, name))
+            for filename, text in files.items():
+                with open(os.path.join(raw_folder, name, filename), 'w') as f:
+                    f.write(text)
+    return [date.strftime('%Y%m%d') for date in dates]
+
+
+def read_processed_tables(data_folder):
+    """Read the processed CSV tables as strings, so comparisons are exact."""
+    return {name: pd.read_csv(os.path.join(data_folder, f'{name}.csv'), dtype=str, keep_default_na=False)
+            for name in PROCESSED_TABLES}
+
+
+def tables_by_content(folder):
+    """The processed tables with version and variant ids replaced by the rows they name."""
+    def value(v):
+        return None if pd.isna(v) else str(v)
+
+    versions = {row.version_id: tuple(value(getattr(row, col)) for col in VERSION_COLUMNS)
+                for row in read_processed_table('route_versions', folder).itertuples()}
+    variants = {row.shape_variant_id: (versions[row.version_id], value(row.shape_id),
+                                       value(row.trip_headsign), value(row.is_main))
+                for row in read_processed_table('shape_variants', folder).itertuples()}
+    activations = read_processed_table('shape_variant_activations', folder)
+    routes = read_processed_table('routes', folder)
+    return {
+        'route_versions': sorted(versions.values(), key=repr),
+        'shape_variants': sorted(variants.values(), key=repr),
+        'shape_variant_activations': sorted(((row.date, variants[row.shape_variant_id], value(row.exception_type))
+                                             for row in activations.itertuples()), key=repr),
+        'routes': sorted((tuple(value(v) for v in row) for row in routes.itertuples(index=False)), key=repr),
+    }
+
+
+@pytest.fixture(scope='module')
+def raw_feeds(tmp_path_factory):
+    """Folder of synthetic raw feeds, and their dates."""
+    raw_folder = str(tmp_path_factory.mktemp('raw'))
+    return raw_folder, write_synthetic_feeds(raw_folder, seed=4)
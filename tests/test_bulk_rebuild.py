@@ -0,0 +1,27 @@
+import contextlib
+import io
+
+import pandas as pd
+import pytest
+
+from conftest import read_processed_tables
+from data_processor import FlexibleDateProcessor
+from data_processor.bulk_rebuild import BulkRebuilder
+
+
+@pytest.mark.parametrize('trim_horizon', [False, True])
+def test_rebuild_matches_processing_the_feeds_one_by_one(raw_feeds, tmp_path, trim_horizon):
+    raw_folder, dates = raw_feeds
+    serial_folder, rebuilt_folder = str(tmp_path / 'serial'), str(tmp_path / 'rebuilt')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        serial = FlexibleDateProcessor(serial_folder, raw_folder, trim_horizon=trim_horizon).process_dates(
+            {}, progress='none'
+        )
+        rebuilt = BulkRebuilder(rebuilt_folder, raw_folder, trim_horizon=trim_horizon).rebuild(show_progress=False)
+
+    assert {date: result['status'] for date, result in rebuilt.items()} == dict.fromkeys(dates, 'success')
+    assert {date: result['status'] for date, result in serial.items()} == dict.fromkeys(dates, 'success')
+    serial_tables = read_processed_tables(serial_folder)
+    for name, table in read_processed_tables(rebuilt_folder).items():
+        pd.testing.assert_frame_equal(table, serial_tables[name], obj=name)
@@ -0,0 +1,73 @@
+import contextlib
+import io
+
+import pandas as pd
+import pytest
+
+from conftest import read_processed_tables
+from data_processor import FlexibleDateProcessor
+from data_processor.change_log import ChangeLog
+from data_processor.feed_insertion import FeedInserter
+
+
+def _process(data_folder, raw_folder, dates, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        FlexibleDateProcessor(data_folder, raw_folder, **kwargs).process_dates(dates, progress='none')
+
+
+def _rollback(data_folder, raw_folder, date):
+    with contextlib.redirect_stdout(io.StringIO()):
+        FlexibleDateProcessor(data_folder, raw_folder).rollback_to(date, progress=False)
+
+
+def _assert_same_tables(data_folder, expected_folder):
+    expected = read_processed_tables(expected_folder)
+    for name, table in read_processed_tables(data_folder).items():
+        pd.testing.assert_frame_equal(table, expected[name], obj=name)
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_rollback_matches_processing_up_to_the_date(raw_feeds, tmp_path, concurrent):
+    raw_folder, dates = raw_feeds
+    rolled_back, fresh = str(tmp_path / 'rolled_back'), str(tmp_path / 'fresh')
+    _process(rolled_back, raw_folder, dates, concurrent=concurrent)
+    _process(fresh, raw_folder, dates[:3])
+
+    _rollback(rolled_back, raw_folder, dates[2])
+
+    _assert_same_tables(rolled_back, fresh)
+    # Processing the rolled back dates again continues from there
+    _process(rolled_back, raw_folder, dates[3:], concurrent=concurrent)
+    _process(fresh, raw_folder, dates[3:])
+    _assert_same_tables(rolled_back, fresh)
+
+
+def test_rollback_undoes_an_insertion(raw_feeds, tmp_path):
+    raw_folder, dates = raw_feeds
+    held = dates[1]
+    rolled_back, fresh = str(tmp_path / 'rolled_back'), str(tmp_path / 'fresh')
+    _process(rolled_back, raw_folder, [date for date in dates if date != held])
+    with contextlib.redirect_stdout(io.StringIO()):
+        FeedInserter(rolled_back, raw_folder).insert(held)
+    _process(fresh, raw_folder, [dates[0]] + dates[2:5])
+
+    _rollback(rolled_back, raw_folder, dates[4])
+
+    _assert_same_tables(rolled_back, fresh)
+
+
+def test_only_the_latest_dates_are_kept(raw_feeds, tmp_path):
+    raw_folder, dates = raw_feeds
+    rolled_back, fresh = str(tmp_path / 'rolled_back'), str(tmp_path / 'fresh')
+    date_processor = FlexibleDateProcessor(rolled_back, raw_folder)
+    date_processor.processor.change_log = ChangeLog(rolled_back, max_dates=3)
+    with contextlib.redirect_stdout(io.StringIO()):
+        date_processor.process_dates(dates, progress='none')
+
+    assert ChangeLog(rolled_back).dates() == dates[-3:]
+    with pytest.raises(ValueError):
+        _rollback(rolled_back, raw_folder, dates[-4])
+
+    _rollback(rolled_back, raw_folder, dates[-3])
+    _process(fresh, raw_folder, dates[:-2])
+    _assert_same_tables(rolled_back, fresh)
@@ -0,0 +1,57 @@
+import contextlib
+import io
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import read_processed_tables
+from data_processor import FlexibleDateProcessor
+from data_processor.config import Config
+from data_processor.data_loader import load_processed_data
+from data_processor.data_saver import read_save_manifest, save_tables_atomic
+
+
+def _process(data_folder, raw_folder, dates):
+    with contextlib.redirect_stdout(io.StringIO()):
+        FlexibleDateProcessor(data_folder, raw_folder).process_dates(dates, progress='none')
+
+
+def _interrupt_save(data_folder, monkeypatch):
+    """Save the current tables again, dying after the first rename."""
+    tables = dict(zip(Config.PROCESSED_TABLES, load_processed_data(data_folder)))
+    replace = os.replace
+    renamed = []
+
+    def dying_replace(src, dst):
+        if renamed:
+            raise KeyboardInterrupt
+        renamed.append(dst)
+        replace(src, dst)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'replace', dying_replace)
+        with pytest.raises(KeyboardInterrupt):
+            save_tables_atomic(tables, data_folder)
+
+
+def test_readers_leave_an_interrupted_save_to_the_writer(raw_feeds, tmp_path, monkeypatch):
+    raw_folder, dates = raw_feeds
+    interrupted, fresh = str(tmp_path / 'interrupted'), str(tmp_path / 'fresh')
+    _process(interrupted, raw_folder, dates[:2])
+    _interrupt_save(interrupted, monkeypatch)
+    files = sorted(os.listdir(interrupted))
+
+    monkeypatch.setattr(Config, 'CONSISTENT_READ_RETRIES', 2)
+    with pytest.raises(RuntimeError):
+        load_processed_data(interrupted)
+    assert sorted(os.listdir(interrupted)) == files
+    assert read_save_manifest(interrupted)['state'] == 'committing'
+
+    # The next merge completes the save before reading the tables
+    _process(interrupted, raw_folder, dates[2:4])
+    _process(fresh, raw_folder, dates[:4])
+    assert read_save_manifest(interrupted)['state'] == 'committed'
+    expected = read_processed_tables(fresh)
+    for name, table in read_processed_tables(interrupted).items():
+        pd.testing.assert_frame_equal(table, expected[name], obj=name)
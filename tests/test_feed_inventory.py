@@ -0,0 +1,32 @@
+import os
+import zipfile
+
+from data_processor.feed_inventory import FeedInventory
+
+
+def _data_rows(raw_folder, date, filename):
+    path = os.path.join(raw_folder, date)
+    if os.path.isdir(path):
+        with open(os.path.join(path, filename)) as f:
+            return len(f.read().splitlines()) - 1
+    with zipfile.ZipFile(path + '.zip') as archive:
+        return len(archive.read(filename).splitlines()) - 1
+
+
+def test_rows_are_only_counted_when_asked_for(raw_feeds, tmp_path, monkeypatch):
+    raw_folder, dates = raw_feeds
+    inventory = FeedInventory(raw_folder, str(tmp_path))
+
+    def no_count(handle):
+        raise AssertionError('refresh must not count rows')
+
+    monkeypatch.setattr(FeedInventory, '_count_rows', staticmethod(no_count))
+    inventory.refresh()
+    assert inventory.dates() == dates
+    monkeypatch.undo()
+
+    # One folder feed and one zip feed
+    for date in dates[:2]:
+        assert inventory.row_count(date, 'trips.txt') == _data_rows(raw_folder, date, 'trips.txt')
+    assert FeedInventory(raw_folder, str(tmp_path)).get_feed(dates[1])['files']['trips.txt']['rows'] is not None
+    assert inventory.row_count(dates[0], 'missing.txt') is None
@@ -0,0 +1,43 @@
+import contextlib
+import io
+import os
+import shutil
+
+import pytest
+
+from conftest import tables_by_content
+from data_processor import FlexibleDateProcessor
+from data_processor.pipeline import TransitDataProcessor
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+@pytest.mark.parametrize('failure', ['prepare', 'merge'])
+def test_trimmed_feed_before_a_failed_date_covers_its_dates(raw_feeds, tmp_path, monkeypatch, failure, concurrent):
+    raw_folder, dates = raw_feeds
+    failed = dates[3]
+    if failure == 'prepare':
+        broken_raw_folder = str(tmp_path / 'raw')
+        shutil.copytree(raw_folder, broken_raw_folder)
+        with open(os.path.join(broken_raw_folder, failed + '.zip'), 'wb') as f:
+            f.write(b'not a zip')
+    else:
+        broken_raw_folder = raw_folder
+        merge_feed = TransitDataProcessor.merge_feed
+
+        def failing_merge_feed(self, feed_data, *args, **kwargs):
+            if feed_data['date'] == failed:
+                raise RuntimeError('merge failed')
+            return merge_feed(self, feed_data, *args, **kwargs)
+
+        monkeypatch.setattr(TransitDataProcessor, 'merge_feed', failing_merge_feed)
+
+    expected_folder, processed_folder = str(tmp_path / 'expected'), str(tmp_path / 'processed')
+    with contextlib.redirect_stdout(io.StringIO()):
+        FlexibleDateProcessor(expected_folder, raw_folder, trim_horizon=True).process_dates(
+            [date for date in dates if date != failed], progress='none'
+        )
+        results = FlexibleDateProcessor(processed_folder, broken_raw_folder, trim_horizon=True,
+                                        concurrent=concurrent).process_dates(dates, progress='none')
+
+    assert [date for date, result in results.items() if result['status'] == 'failed'] == [failed]
+    assert tables_by_content(processed_folder) == tables_by_content(expected_folder)
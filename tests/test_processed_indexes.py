@@ -0,0 +1,38 @@
+import contextlib
+import io
+import os
+
+import pandas as pd
+
+from data_processor import FlexibleDateProcessor
+from data_processor.data_loader import read_processed_table
+from data_processor.key_index import ProcessedKeyIndex
+from data_processor.variant_index import ShapeVariantIndex
+
+
+def _edit_table(folder, name, column, row, value):
+    """Change one value of a processed CSV, keeping its row count and ids."""
+    path = os.path.join(folder, f'{name}.csv')
+    df = pd.read_csv(path, dtype=str, keep_default_na=False)
+    df.loc[row, column] = value
+    df.to_csv(path, index=False)
+
+
+def test_indexes_are_rebuilt_after_edits_keeping_the_row_counts(raw_feeds, tmp_path):
+    raw_folder, dates = raw_feeds
+    folder = str(tmp_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        FlexibleDateProcessor(folder, raw_folder).process_dates(dates[:4], progress='none')
+
+    _edit_table(folder, 'shape_variants', 'trip_headsign', 0, 'Edited')
+    shape_variants_df = read_processed_table('shape_variants', folder)
+    index = ShapeVariantIndex.load(shape_variants_df, folder)
+    assert index.ids == ShapeVariantIndex.from_variants(shape_variants_df).ids
+
+    route_versions_df = read_processed_table('route_versions', folder)
+    active = route_versions_df.index[route_versions_df['valid_to'].isna()][0]
+    _edit_table(folder, 'route_versions', 'main_shape_id', active, 'Edited')
+    tables = (read_processed_table('shapes', folder, columns=['shape_id']),
+              read_processed_table('routes', folder), read_processed_table('route_versions', folder))
+    key_index = ProcessedKeyIndex.load(*tables, folder)
+    assert key_index.active_versions == ProcessedKeyIndex.from_tables(*tables).active_versions
@@ -0,0 +1,75 @@
+import json
+import os
+import zipfile
+
+from data_processor.config import Config
+from data_processor.processing_tracker import ProcessingTracker
+
+
+def _write_legacy_history(folder):
+    history = {
+        'processed_dates': ['20131018', '20131019'],
+        'failed_dates': ['20131020'],
+        'processing_sessions': [
+            {'start_date': '20131018', 'end_date': '20131020', 'successful_dates': ['20131018', '20131019'],
+             'failed_dates': ['20131020']}
+        ],
+        'last_update': '2013-10-21T00:00:00',
+        'last_successful_date': '20131019'
+    }
+    path = os.path.join(folder, Config.PROCESSING_HISTORY_FILE)
+    with open(path, 'w') as f:
+        json.dump(history, f)
+    return path, history
+
+
+def test_loading_a_legacy_history_does_not_change_it(tmp_path):
+    path, history = _write_legacy_history(tmp_path)
+
+    tracker = ProcessingTracker(str(tmp_path))
+
+    assert tracker.processed_dates == {'20131018', '20131019'}
+    assert tracker.failed_dates == {'20131020'}
+    assert tracker.history['session_count'] == 1
+    assert [session['start_date'] for session in tracker.iter_sessions()] == ['20131018']
+    with open(path) as f:
+        assert json.load(f) == history
+    assert sorted(os.listdir(tmp_path)) == [Config.PROCESSING_HISTORY_FILE]
+
+
+def test_legacy_history_is_converted_on_the_first_write(tmp_path):
+    _write_legacy_history(tmp_path)
+
+    ProcessingTracker(str(tmp_path)).record_processing_session('20131021', '20131021', ['20131021'], [])
+
+    tracker = ProcessingTracker(str(tmp_path))
+    assert tracker.processed_dates == {'20131018', '20131019', '20131021'}
+    assert tracker.failed_dates == {'20131020'}
+    assert tracker.history['session_count'] == 2
+    assert [session['start_date'] for session in tracker.iter_sessions()] == ['20131018', '20131021']
+
+
+def test_manual_marks_are_counted_as_sessions(tmp_path):
+    tracker = ProcessingTracker(str(tmp_path))
+    tracker.record_processing_session('20131018', '20131018', ['20131018'], [])
+    tracker.mark_date_as_processed('20131019')
+
+    tracker = ProcessingTracker(str(tmp_path))
+    assert tracker.history['session_count'] == 2
+    assert len(list(tracker.iter_sessions())) == 2
+    assert tracker.processed_dates == {'20131018', '20131019'}
+
+
+def test_summary_only_lists_the_raw_folder(raw_feeds, tmp_path, monkeypatch):
+    raw_folder, dates = raw_feeds
+    _write_legacy_history(tmp_path)
+
+    def no_open(*args, **kwargs):
+        raise AssertionError('status must not open the feeds')
+
+    monkeypatch.setattr(zipfile, 'ZipFile', no_open)
+    monkeypatch.setattr(Config, 'get_default_raw_data_folder', staticmethod(lambda: raw_folder))
+    summary = ProcessingTracker(str(tmp_path)).get_processing_summary()
+
+    assert summary['total_available_dates'] == len(dates)
+    assert sorted(os.listdir(tmp_path)) == [Config.PROCESSING_HISTORY_FILE]
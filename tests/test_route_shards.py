@@ -0,0 +1,53 @@
+import contextlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+from conftest import read_processed_tables
+from data_processor import FlexibleDateProcessor
+from data_processor.route_shards import RouteShards
+
+
+@pytest.fixture(scope='module')
+def serial_tables(raw_feeds, tmp_path_factory):
+    raw_folder, _ = raw_feeds
+    data_folder = str(tmp_path_factory.mktemp('serial'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        FlexibleDateProcessor(data_folder, raw_folder).process_dates({}, progress='none')
+    return read_processed_tables(data_folder)
+
+
+def _assert_same_tables(data_folder, expected):
+    for name, table in read_processed_tables(data_folder).items():
+        pd.testing.assert_frame_equal(table, expected[name], obj=name)
+
+
+@pytest.mark.parametrize('shard_count', [1, 2, 3])
+def test_sharded_merge_matches_serial_merge(raw_feeds, serial_tables, tmp_path, shard_count):
+    raw_folder, _ = raw_feeds
+    shards = RouteShards(shard_count, ThreadPoolExecutor(max_workers=shard_count))
+    route_ids = serial_tables['routes']['route_id'].drop_duplicates()
+    assert len(set(shards.shard_of(route_ids))) == shard_count
+
+    date_processor = FlexibleDateProcessor(str(tmp_path), raw_folder)
+    date_processor.processor.route_shards = shards
+    with contextlib.redirect_stdout(io.StringIO()):
+        date_processor.process_dates({}, progress='none')
+
+    _assert_same_tables(str(tmp_path), serial_tables)
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_sharded_merge_in_worker_processes(raw_feeds, serial_tables, tmp_path, concurrent):
+    raw_folder, dates = raw_feeds
+    with FlexibleDateProcessor(str(tmp_path), raw_folder, merge_shards=2, concurrent=concurrent) as date_processor:
+        for batch in (dates[:4], dates[4:]):
+            with contextlib.redirect_stdout(io.StringIO()):
+                date_processor.process_dates(batch, progress='none')
+            # The pools are stopped after each call, and started again by the next one
+            assert date_processor.processor.route_shards._executor is None
+            assert date_processor.processor._executor is None
+
+    _assert_same_tables(str(tmp_path), serial_tables)
@@ -0,0 +1,101 @@
+import importlib
+import os
+import sys
+
+from conftest import write_synthetic_feeds
+from data_processor import pipeline, shape_processor, stage_graph
+from data_processor.stage_graph import Stage, StageGraph
+
+FINGERPRINTS = {'date': '20240101', 'raw_data_folder': 'feed', 'route_versions': 'versions',
+                'horizon': 'none', 'show_progress': 'False'}
+
+
+def _write_package(root, factor):
+    package = root / 'stagepkg'
+    package.mkdir(exist_ok=True)
+    (package / '__init__.py').write_text('')
+    (package / 'helpers.py').write_text(f'def scale(value):\n    return value * {factor}\n')
+    (package / 'stages.py').write_text(
+        'from .helpers import scale\n\n\ndef compute(value):\n    return scale(value)\n'
+    )
+
+
+def test_editing_a_helper_misses_the_cache(tmp_path, monkeypatch):
+    _write_package(tmp_path, 2)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    import stagepkg.stages
+    cache_folder = str(tmp_path / 'cache')
+
+    def run():
+        stages = importlib.import_module('stagepkg.stages')
+        graph = StageGraph([Stage('result', stages.compute, ['value'], code=[stages])], cache_folder)
+        return graph.run(['result'], {'value': 5}, {'value': 'five'})['result']
+
+    try:
+        assert run() == 10
+        assert run() == 10
+
+        # Only the helper's module changes, not the stage function
+        _write_package(tmp_path, 100)
+        importlib.reload(sys.modules['stagepkg.helpers'])
+        importlib.reload(sys.modules['stagepkg.stages'])
+        assert run() == 500
+    finally:
+        for name in ['stagepkg.stages', 'stagepkg.helpers', 'stagepkg']:
+            sys.modules.pop(name, None)
+
+
+def test_feed_stage_keys_cover_their_helpers(monkeypatch):
+    keys = pipeline.build_stage_graph().keys(FINGERPRINTS)
+
+    source = stage_graph._source
+    edited = {}
+
+    def edited_source(item):
+        text = source(item)
+        for module, name in edited.items():
+            if item is module:
+                text = text.replace(name, name + b'_edited', 1)
+        return text
+
+    monkeypatch.setattr(stage_graph, '_source', edited_source)
+
+    # A helper the stages call, not listed anywhere
+    edited = {shape_processor: b'_first_active_dates'}
+    helper_keys = pipeline.build_stage_graph().keys(FINGERPRINTS)
+    assert helper_keys['service_dates'] == keys['service_dates']
+    assert helper_keys['latest_routes'] == keys['latest_routes']
+    for name in ['service_ranges', 'df_exceptions', 'shape_variant_data']:
+        assert helper_keys[name] != keys[name]
+
+    # The loader feeds every stage
+    edited = {pipeline.data_loader: b'GTFS_SHAPES_DTYPES'}
+    loader_keys = pipeline.build_stage_graph().keys(FINGERPRINTS)
+    assert all(loader_keys[name] != keys[name] for name in keys)
+
+
+def test_rewriting_a_folder_feed_file_misses_the_cache(tmp_path):
+    raw_folder = str(tmp_path / 'raw')
+    date = write_synthetic_feeds(raw_folder, seed=1, feed_count=2)[0]
+    trips_path = os.path.join(raw_folder, date, 'trips.txt')
+    processor = pipeline.TransitDataProcessor(str(tmp_path / 'processed'), raw_folder)
+    assert set(processor.prepare_feed(date, False)['latest_routes']['trip_headsign']) != {'Z'}
+
+    # Same size, same folder mtime: only the file's own mtime changes
+    with open(trips_path) as f:
+        lines = f.read().splitlines(keepends=True)
+    columns = lines[0].split(',')
+    rows = [line.split(',') for line in lines[1:]]
+    for row in rows:
+        row[columns.index('trip_headsign')] = 'Z'
+    folder_stat = os.stat(raw_folder)
+    with open(trips_path, 'w') as f:
+        f.write(lines[0] + ''.join(','.join(row) for row in rows))
+    trips_stat = os.stat(trips_path)
+    os.utime(trips_path, ns=(trips_stat.st_atime_ns, trips_stat.st_mtime_ns + 10 ** 9))
+    os.utime(raw_folder, ns=(folder_stat.st_atime_ns, folder_stat.st_mtime_ns))
+
+    assert set(processor.prepare_feed(date, False)['latest_routes']['trip_headsign']) == {'Z'}
+    reopened = pipeline.TransitDataProcessor(str(tmp_path / 'processed'), raw_folder)
+    assert set(reopened.prepare_feed(date, False)['latest_routes']['trip_headsign']) == {'Z'}
@@ -0,0 +1,42 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from data_processor.config import Config
+from data_processor.string_dictionary import StringDictionary
+
+
+def _intern(data_folder, worker):
+    dictionary = StringDictionary(data_folder)
+    codes = {}
+    for batch in range(20):
+        strings = [f'shared{batch}', f'w{worker}_{batch}_a', f'w{worker}_{batch}_b']
+        codes.update(zip(strings, dictionary.encode(strings).tolist()))
+    return codes
+
+
+def test_concurrent_appends_keep_codes_on_their_lines(tmp_path):
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(_intern, [str(tmp_path)] * 4, range(4)))
+
+    reloaded = StringDictionary(str(tmp_path))
+    assert len(reloaded) == len(set(reloaded.strings)) == 20 + 4 * 20 * 2
+    for codes in results:
+        for string, code in codes.items():
+            assert reloaded.strings[code] == string
+
+
+def test_readers_leave_a_partial_line_alone(tmp_path):
+    dictionary = StringDictionary(str(tmp_path))
+    dictionary.encode(['R1', 'R2'])
+    path = os.path.join(tmp_path, Config.STRING_DICTIONARY_FILE)
+    with open(path, 'ab') as f:
+        f.write(b'"R3')  # Another process's append in flight
+
+    reader = StringDictionary(str(tmp_path))
+    assert reader.strings == ['R1', 'R2']
+    with open(path, 'rb') as f:
+        assert f.read().endswith(b'"R3')
+
+    with open(path, 'ab') as f:
+        f.write(b'"\n')
+    assert reader.decode([2]).tolist() == ['R3']